@@ -0,0 +1,100 @@
+"""Synthetic catalogue-scale fixtures for the benchmarks
+
+The sizes are scaled by $TESS_BENCH_SCALE (e.g. 0.01 for a quick run).
+Besides the timings of pytest-benchmark, benchmarks run with `measure`
+record the peak memory of one extra call (Python and NumPy allocations,
+traced with tracemalloc), shown at the end of the run and saved in the
+extra_info of --benchmark-json.
+"""
+import importlib.util
+import os
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+import pytest
+
+TESTS_DIR = os.path.join(os.path.dirname(__file__), "..", "tests")
+__spec = importlib.util.spec_from_file_location(
+    "tests_conftest", os.path.join(TESTS_DIR, "conftest.py")
+)
+tests_conftest = importlib.util.module_from_spec(__spec)
+__spec.loader.exec_module(tests_conftest)
+generate_toi_files = tests_conftest.generate_toi_files
+make_fake_executable = tests_conftest.make_fake_executable
+
+SCALE = float(os.environ.get("TESS_BENCH_SCALE", 1))
+N_TOI_DIRS = [10_000, 100_000]
+N_SACCT_ROWS = 2_000_000
+SACCT_START, SACCT_END = "2023-01-01", "2023-01-07"  # (one shard)
+SACCT_STATES = ["COMPLETED", "FAILED", "TIMEOUT", "OUT_OF_MEMORY"]
+ROUNDS = 3
+
+PEAK_MEMORY = {}  # benchmark name -> peak memory (MB)
+
+
+def scaled(n: int) -> int:
+    return max(int(n * SCALE), 1)
+
+
+def measure(benchmark, fn, setup=None, rounds=ROUNDS):
+    """Benchmark fn (called with the (args, kwargs) returned by setup) and
+    record its peak memory"""
+    setup = setup or (lambda: ((), {}))
+    args, kwargs = setup()
+    tracemalloc.start()
+    try:
+        fn(*args, **kwargs)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    benchmark.extra_info["peak_mem_mb"] = peak / 1024**2
+    PEAK_MEMORY[benchmark.name] = peak / 1024**2
+    return benchmark.pedantic(fn, setup=setup, rounds=rounds, iterations=1)
+
+
+def pytest_terminal_summary(terminalreporter):
+    if PEAK_MEMORY:
+        terminalreporter.section("peak memory (tracemalloc)")
+        for name, peak in PEAK_MEMORY.items():
+            terminalreporter.write_line(f"{name}: {peak:,.1f} MB")
+
+
+@pytest.fixture(scope="session", params=N_TOI_DIRS, ids=lambda n: f"{n}dirs")
+def toi_outdir(request, tmp_path_factory):
+    """An outdir with n analysed TOIs -> (outdir, n)"""
+    n = scaled(request.param)
+    outdir = tmp_path_factory.mktemp(f"outdir_{n}")
+    generate_toi_files(str(outdir), range(1, n + 1))
+    return str(outdir), n
+
+
+@pytest.fixture(scope="session")
+def sacct_dump(tmp_path_factory):
+    """A --parsable2 sacct dump of N_SACCT_ROWS jobs (most of them 'toi'
+    jobs, as array tasks), each followed by its batch step (with MaxRSS)"""
+    n = scaled(N_SACCT_ROWS)
+    rng = np.random.default_rng(0)
+    task = np.arange(n)
+    submit = pd.Timestamp(SACCT_START) + pd.to_timedelta(
+        rng.integers(0, 5 * 24 * 3600, n), unit="s"
+    )
+    jobs = pd.DataFrame(
+        dict(
+            JobID=[f"{1000 + i // 2048}_{i % 2048}" for i in task],
+            JobName=rng.choice(["toi_pe", "toi_gen", "other_job"], n),
+            Submit=submit.strftime("%Y-%m-%dT%H:%M:%S"),
+            CPUTimeRAW=rng.integers(60, 36_000, n),
+            State=rng.choice(SACCT_STATES, n, p=[0.85, 0.05, 0.05, 0.05]),
+            MaxRSS=[f"{kb}K" for kb in rng.integers(100_000, 2_000_000, n)],
+            ReqMem="1500M",
+            AllocCPUS=rng.choice([1, 2], n),
+        )
+    )
+    steps = jobs.assign(JobID=jobs.JobID + ".batch", JobName="batch")
+    data = pd.concat([jobs.assign(MaxRSS=""), steps]).sort_index(
+        kind="stable"
+    )
+    fname = tmp_path_factory.mktemp("sacct") / "sacct_dump.txt"
+    data.to_csv(fname, sep="|", index=False)
+    return str(fname), n
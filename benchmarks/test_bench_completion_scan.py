@@ -0,0 +1,35 @@
+"""Benchmarks for finding the unprocessed TOIs of outdirs with 10k-100k
+analysed TOIs
+
+Run with:
+    pytest benchmarks/test_bench_completion_scan.py --benchmark-only
+"""
+from conftest import measure
+from tess_atlas_slurm_utils.toi_data_interface import (
+    get_unprocessed_toi_numbers,
+)
+
+N_NEW = 1000  # TOIs without results
+
+
+def test_full_completion_scan(benchmark, toi_outdir):
+    outdir, n = toi_outdir
+    tois = list(range(1, n + N_NEW + 1))
+    unprocessed = measure(
+        benchmark,
+        get_unprocessed_toi_numbers,
+        lambda: ((tois, outdir), dict(rescan=True)),
+    )
+    assert len(unprocessed) == N_NEW
+
+
+def test_incremental_completion_scan(benchmark, toi_outdir):
+    outdir, n = toi_outdir
+    tois = list(range(1, n + N_NEW + 1))
+    get_unprocessed_toi_numbers(tois, outdir)  # (builds the index)
+    unprocessed = measure(
+        benchmark,
+        get_unprocessed_toi_numbers,
+        lambda: ((tois, outdir), {}),
+    )
+    assert len(unprocessed) == N_NEW
@@ -0,0 +1,44 @@
+"""Microbenchmarks for slurm file generation
+
+Run with:
+    pytest benchmarks --benchmark-only
+"""
+import pytest
+from tess_atlas_slurm_utils.file_generators import SlurmFileRenderer
+from tess_atlas_slurm_utils.slurm_job_generator import (
+    ANALYSIS_JOB_SETTINGS,
+    CMD,
+)
+
+N_SCRIPTS = 50_000
+
+
+def __jobs(n):
+    settings = {**ANALYSIS_JOB_SETTINGS, "jobname": "bench"}
+    cmd = CMD.format(srun="srun", outdir="outdir")
+    return [
+        dict(**settings, jobid=i, array_job=True, array_args=[i], command=cmd)
+        for i in range(n)
+    ]
+
+
+@pytest.fixture
+def renderer(tmpdir):
+    submit_dir = tmpdir.mkdir("submit")
+    return SlurmFileRenderer(str(tmpdir), "mod 1", str(submit_dir))
+
+
+def test_render_50k_job_scripts(benchmark, renderer):
+    jobs = __jobs(N_SCRIPTS)
+    fnames = benchmark.pedantic(
+        renderer.write_many, args=(jobs,), rounds=1, iterations=1
+    )
+    assert len(fnames) == N_SCRIPTS
+
+
+def test_rerender_50k_unchanged_job_scripts(benchmark, renderer):
+    jobs = __jobs(N_SCRIPTS)
+    renderer.write_many(jobs)  # the re-render only has to compare the files
+    benchmark.pedantic(
+        renderer.write_many, args=(jobs,), rounds=1, iterations=1
+    )
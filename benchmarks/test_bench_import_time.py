@@ -0,0 +1,29 @@
+"""Benchmarks for the startup time of the entry points (each imported in a
+fresh interpreter, as on every make_slurm_job/tess_jobstats call)
+
+Run with:
+    pytest benchmarks/test_bench_import_time.py --benchmark-only
+"""
+import subprocess
+import sys
+
+import pytest
+
+ENTRY_POINTS = [
+    "tess_atlas_slurm_utils.cli",
+    "tess_atlas_slurm_utils.jobstats_collector",
+    "tess_atlas_slurm_utils.jobstats_report",
+    "tess_atlas_slurm_utils.monitor",
+    "tess_atlas_slurm_utils.resubmission",
+]
+
+
+@pytest.mark.parametrize("module", ENTRY_POINTS)
+def test_import_time(benchmark, module):
+    benchmark.pedantic(
+        subprocess.run,
+        args=([sys.executable, "-c", f"import {module}"],),
+        kwargs=dict(check=True),
+        rounds=5,
+        iterations=1,
+    )
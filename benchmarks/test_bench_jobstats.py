@@ -0,0 +1,43 @@
+"""Benchmarks for ingesting sacct dumps with millions of jobs
+
+Run with:
+    pytest benchmarks/test_bench_jobstats.py --benchmark-only
+"""
+import os
+
+from conftest import (
+    SACCT_END,
+    SACCT_START,
+    make_fake_executable,
+    measure,
+)
+from tess_atlas_slurm_utils import jobstats_collector
+from tess_atlas_slurm_utils.jobstats_collector import sync_accounting_store
+
+parse_sacct = getattr(jobstats_collector, "__slurm_raw_data_to_dataframe")
+
+
+def __n_parsed_rows(fname):
+    with open(fname) as f:
+        return sum(len(chunk) for chunk in parse_sacct(f))
+
+
+def test_parse_sacct_dump(benchmark, sacct_dump):
+    fname, n = sacct_dump
+    n_rows = measure(benchmark, __n_parsed_rows, lambda: ((fname,), {}))
+    assert 0 < n_rows < n  # (only the 'toi' jobs)
+
+
+def test_sync_accounting_store(benchmark, sacct_dump, tmpdir, monkeypatch):
+    fname, _ = sacct_dump
+    bindir = str(tmpdir / "bin")
+    make_fake_executable(bindir, "sacct", f"cat {fname}\n")
+    monkeypatch.setenv("PATH", bindir + os.pathsep + os.environ["PATH"])
+    stores = iter(range(1000))
+
+    def setup():  # a new store each round (so the shard is fetched)
+        store = str(tmpdir / f"jobstats_{next(stores)}.sqlite")
+        return (SACCT_START, SACCT_END, "user", store), {}
+
+    n_shards = measure(benchmark, sync_accounting_store, setup)
+    assert n_shards == 1
@@ -0,0 +1,53 @@
+"""Benchmarks for indexing the logs of a catalogue run (with 5k failures)
+
+Run with:
+    pytest benchmarks/test_bench_log_harvester.py --benchmark-only
+"""
+import pytest
+from conftest import measure, scaled
+from tess_atlas_slurm_utils.log_harvester import (
+    harvest_logs,
+    load_log_index,
+    summarise_failures,
+)
+
+N_LOGS = 20_000
+N_FAILED = 5_000
+PROGRESS = "Sampling: {}%\n" * 50
+FAILED_LOG = PROGRESS + (
+    "Traceback (most recent call last):\n"
+    '  File "/home/user/run_toi.py", line 10, in <module>\n'
+    "ValueError: bad value {} for TOI {}\n"
+)
+
+
+@pytest.fixture(scope="module")
+def log_outdir(tmp_path_factory):
+    outdir = tmp_path_factory.mktemp("logs")
+    log_dir = outdir / "log_pe"
+    log_dir.mkdir()
+    n_logs, n_failed = scaled(N_LOGS), scaled(N_FAILED)
+    for i in range(n_logs):
+        txt = FAILED_LOG if i < n_failed else PROGRESS
+        (log_dir / f"pe_{1000 + i // 2048}_{i % 2048}.log").write_text(
+            txt.format(*range(50), i % 7, i)
+        )
+    return str(outdir)
+
+
+def test_harvest_logs(benchmark, log_outdir):
+    measure(
+        benchmark,
+        harvest_logs,
+        lambda: ((log_outdir,), dict(reindex=True)),
+    )
+
+
+def test_triage_failures(benchmark, log_outdir):
+    index = harvest_logs(log_outdir)
+
+    def triage():
+        return summarise_failures(load_log_index(index))
+
+    failures = measure(benchmark, triage)
+    assert failures.n_logs.sum() == scaled(N_FAILED)
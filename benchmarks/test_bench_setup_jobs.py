@@ -0,0 +1,29 @@
+"""Benchmark for generating the jobs of 50k TOIs
+
+Run with:
+    pytest benchmarks/test_bench_setup_jobs.py --benchmark-only
+"""
+import os
+
+from conftest import measure, scaled
+from tess_atlas_slurm_utils.slurm_job_generator import setup_jobs
+
+N_TOIS = 50_000
+
+
+def test_setup_50k_toi_jobs(benchmark, tmpdir):
+    tois = list(range(1, scaled(N_TOIS) + 1))
+    outdirs = iter(range(1000))
+
+    def setup():  # a new outdir each round (so every file is written)
+        outdir = str(tmpdir / f"out_{next(outdirs)}")
+        return (), dict(
+            toi_numbers=tois,
+            outdir=outdir,
+            module_loads="mod 1",
+            submit=False,
+            clean=True,
+        )
+
+    measure(benchmark, setup_jobs, setup)
+    assert os.path.isfile(tmpdir / "out_0" / "submit" / "submit.sh")
@@ -0,0 +1,48 @@
+"""Benchmark for sweeping 100 configs of a 7k TOI catalogue run
+
+Run with:
+    pytest benchmarks/test_bench_simulator.py --benchmark-only
+"""
+import numpy as np
+import pandas as pd
+
+from conftest import SACCT_STATES, measure, scaled
+from tess_atlas_slurm_utils.job_settings import ANALYSIS, GENERATION
+from tess_atlas_slurm_utils.simulator import config_grid, simulate
+
+N_TOIS = 7_000
+
+
+def runtime_history(n_tois: int) -> pd.DataFrame:
+    """Previous runs of every TOI (lognormal costs)"""
+    rng = np.random.default_rng(42)
+    stages = np.repeat([GENERATION, ANALYSIS], n_tois)
+    return pd.DataFrame(
+        dict(
+            stage=stages,
+            TOI=np.tile(np.arange(1, n_tois + 1), 2),
+            cpu_seconds=np.where(
+                stages == GENERATION,
+                rng.lognormal(np.log(600), 0.5, 2 * n_tois),
+                rng.lognormal(np.log(7200), 1.0, 2 * n_tois),
+            ),
+            mem_mb=rng.lognormal(np.log(1000), 0.3, 2 * n_tois),
+            state=rng.choice(
+                SACCT_STATES, 2 * n_tois, p=[0.85, 0.05, 0.05, 0.05]
+            ),
+        )
+    )
+
+
+def test_sweep_100_configs(benchmark):
+    n_tois = scaled(N_TOIS)
+    history = runtime_history(n_tois)
+    configs = config_grid(
+        nodes=[25, 50, 100, 200],
+        analysis_throttle=[None, 100, 500, 1000, 2000],
+        mem=["1500MB", "2GB", "4GB", "8GB", "16GB"],
+    )
+    args = (list(range(1, n_tois + 1)), history, configs)
+    results = measure(benchmark, simulate, lambda: (args, {}))
+    assert len(results) == 100
+    assert (results.completed <= n_tois).all()
@@ -31,6 +31,41 @@ def parse_args():
         help="The TOI number to be analysed (e.g. 103). Cannot be passed with toi-csv",
         default=None,
     )
+    parser.add_argument(
+        "--toi_range",
+        type=float,
+        nargs=2,
+        metavar=("MIN", "MAX"),
+        default=None,
+        help="Only TOIs with numbers in [MIN, MAX]",
+    )
+    parser.add_argument(
+        "--disposition",
+        nargs="+",
+        default=None,
+        help="Only TOIs with these TFOPWG dispositions (e.g. PC CP KP)",
+    )
+    parser.add_argument(
+        "--mag_range",
+        type=float,
+        nargs=2,
+        metavar=("MIN", "MAX"),
+        default=None,
+        help="Only TOIs with a TESS mag in [MIN, MAX] (use inf for no max)",
+    )
+    parser.add_argument(
+        "--period_range",
+        type=float,
+        nargs=2,
+        metavar=("MIN", "MAX"),
+        default=None,
+        help="Only TOIs with a period (days) in [MIN, MAX] (use inf for no max)",
+    )
+    parser.add_argument(
+        "--updated_since",
+        default=None,
+        help="Only TOIs updated in the catalogue since this date (YYYY-MM-DD)",
+    )
     parser.add_argument(
         "--outdir",
         help=(
@@ -45,6 +80,30 @@ def parse_args():
         action="store_true",  # False by default
         help="Run all TOIs (even those that have completed analysis)",
     )
+    parser.add_argument(
+        "--rescan",
+        action="store_true",  # False by default
+        help="Rebuild the index of completed TOIs in the outdir from scratch",
+    )
+    parser.add_argument(
+        "--delta",
+        action="store_true",  # False by default
+        help="Also rerun completed TOIs whose catalogue rows (planets, "
+        "ephemerides, sectors) changed since their results were made",
+    )
+    parser.add_argument(
+        "--offline",
+        action="store_true",  # False by default
+        help="Only use the locally cached TOI catalogue (no network access)",
+    )
+    parser.add_argument(
+        "--jobstats",
+        default=None,
+        help="jobstats CSV of previous runs (from tess_jobstats --submit_dir). "
+        "If passed, each stage's time/mem are right-sized from the p95 of its "
+        "previous jobs, and TOIs are grouped into array jobs by their "
+        "predicted time/mem",
+    )
     parser.add_argument(
         "--module_loads",
         default="git/2.18.0 gcc/9.2.0 openmpi/4.0.2 python/3.8.5",
@@ -55,6 +114,12 @@ def parse_args():
         action="store_true",  # False by default
         help="Submit once files created",
     )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",  # False by default
+        help="Only print the planned array jobs and their resource requests "
+        "(no slurm files are written)",
+    )
     parser.add_argument(
         "--email",
         default="",
@@ -70,13 +135,89 @@ def parse_args():
         action="store_true",  # False by default
         help="Adds the --quickrun flag to the run_toi command (only meant for testing)",
     )
+    parser.add_argument(
+        "--bundle_size",
+        type=int,
+        default=1,
+        help="Number of TOIs run by each array task (default: 1)",
+    )
+    parser.add_argument(
+        "--bundle_parallel",
+        action="store_true",  # False by default
+        help="Run the TOIs of a bundle concurrently (up to the task's CPUs)",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",  # False by default
+        help="Log each TOI's wall time, peak RSS, $JOBFS use and Theano "
+        "compile time to {outdir}/profiling.jsonl",
+    )
+    parser.add_argument(
+        "--theano_cache",
+        action="store_true",  # False by default
+        help="Build a Theano compile cache once (in {outdir}/theano_cache) "
+        "and unpack it in each analysis task instead of recompiling",
+    )
+    parser.add_argument(
+        "--layout",
+        default="array",
+        choices=["array", "node"],
+        help="array: one small allocation per analysis task (default). "
+        "node: each analysis task gets a whole node and runs a pool of TOIs",
+    )
+    parser.add_argument(
+        "--node_cores",
+        type=int,
+        default=32,
+        help="Cores per node (to size the node pools of the 'node' layout)",
+    )
+    parser.add_argument(
+        "--node_mem",
+        default="180GB",
+        help="Usable mem per node (to size the node pools of the 'node' layout)",
+    )
+    parser.add_argument(
+        "--staging",
+        action="store_true",  # False by default
+        help="Run each TOI's analysis in $JOBFS and move its results to the "
+        "outdir once done (--tmp is sized from the TOIs already analysed)",
+    )
+    parser.add_argument(
+        "--generation_throttle",
+        type=int,
+        default=None,
+        help="Max number of generation tasks running at once per array",
+    )
+    parser.add_argument(
+        "--analysis_throttle",
+        type=int,
+        default=None,
+        help="Max number of analysis tasks running at once per array",
+    )
+    parser.add_argument(
+        "--max_queued",
+        type=int,
+        default=None,
+        help="With --submit: only submit each batch once your queued + "
+        "running tasks leave room for it (waits for the queue to drain)",
+    )
     return parser.parse_args()
 
 
 def main():
     args = parse_args()
     os.makedirs(args.outdir, exist_ok=True)
-    toi_numbers = parse_toi_numbers(args.toi_csv, args.toi_number, args.outdir)
+    toi_numbers = parse_toi_numbers(
+        args.toi_csv,
+        args.toi_number,
+        args.outdir,
+        offline=args.offline or None,
+        toi_range=args.toi_range,
+        dispositions=args.disposition,
+        mag_range=args.mag_range,
+        period_range=args.period_range,
+        updated_since=args.updated_since,
+    )
     setup_jobs(
         toi_numbers=toi_numbers,
         outdir=args.outdir,
@@ -85,6 +226,23 @@ def main():
         clean=args.clean,
         email=args.email,
         skip_gen=args.skip_gen,
+        quickrun=args.quickrun,
+        rescan=args.rescan,
+        delta=args.delta,
+        offline=args.offline or None,
+        jobstats=args.jobstats,
+        bundle_size=args.bundle_size,
+        bundle_parallel=args.bundle_parallel,
+        profile=args.profile,
+        theano_cache=args.theano_cache,
+        layout=args.layout,
+        node_cores=args.node_cores,
+        node_mem=args.node_mem,
+        dry_run=args.dry_run,
+        staging=args.staging,
+        generation_throttle=args.generation_throttle,
+        analysis_throttle=args.analysis_throttle,
+        max_queued=args.max_queued,
     )
 
 
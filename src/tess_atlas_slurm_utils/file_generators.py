@@ -1,23 +1,207 @@
+from __future__ import annotations
+
+import functools
+import hashlib
+import math
 import os
-from typing import List, Optional
+import re
+from typing import TYPE_CHECKING, Dict, Iterable, List, Optional, Tuple
 
-import jinja2
-from jinja2 import Template
+from .profiler import PROFILE_LOG, profile_command
+from .staging import staged_command
+from .utils import (
+    get_python_source_command,
+    mkdir,
+    replace_symlink,
+    to_str_list,
+    write_if_changed,
+)
 
-from .utils import get_python_source_command, to_str_list, mkdir
+if TYPE_CHECKING:
+    from jinja2 import Template
 
 SLURM_TEMPLATE = "slurm_template.sh"
 SUBMIT_TEMPLATE = "submit_template.sh"
+SUBMITTED_JOBS_LEDGER = "submitted_jobs.txt"
+SCRIPTS_DIR = "scripts"  # content-addressed slurm files (in the submit dir)
+SCRIPT_HASH_LENGTH = 16  # (of the hex digest, in the slurm file names)
+SCRIPT_RESOURCES = ["cpu_per_task", "time", "mem", "tmp_mem", "throttle"]
 TEMPLATE_DIR = os.path.join(os.path.dirname(__file__), "templates")
 
 
-def __load_template(template_file: str) -> Template:
+@functools.lru_cache(maxsize=None)
+def load_template(template_file: str) -> Template:
+    import jinja2
+
     template_loader = jinja2.FileSystemLoader(searchpath=TEMPLATE_DIR)
     template_env = jinja2.Environment(loader=template_loader)
     template = template_env.get_template(template_file)
     return template
 
 
+class SlurmFileRenderer:
+    """Renders (and writes) many slurm files sharing an outdir/env setup
+
+    The template is only compiled once, the python env activation is
+    resolved once, and each log dir is created once, so rendering thousands
+    of slurm files is cheap.
+
+    Slurm files are content-addressed: each is written once (atomically) to
+    {submit_dir}/scripts/slurm_{jobname}_{hash}.sh, and never changed after,
+    so files already in the queue can't change under it. The usual
+    {submit_dir}/slurm_{jobname}_{jobid}_job.sh is a link to the latest one.
+    The written files are listed in `scripts` (for the manifest).
+
+    :param outdir: Base output directory (will generate {outdir}/log_{jobname})
+    :param module_loads: Module loads to include in the slurm files
+    :param submit_dir: Directory to save the slurm files to
+    :param email: Email address to send notifications to
+    :param account: Account to charge the jobs to
+    """
+
+    def __init__(
+        self,
+        outdir: str,
+        module_loads: str,
+        submit_dir: str,
+        email: Optional[str] = "",
+        account: Optional[str] = "",
+    ):
+        self.outdir = os.path.abspath(outdir)
+        self.submit_dir = submit_dir
+        self.scripts_dir = os.path.abspath(mkdir(submit_dir, SCRIPTS_DIR))
+        self.scripts: List[Dict] = []
+        self.template = load_template(SLURM_TEMPLATE)
+        self.common_kwargs = dict(
+            outdir=self.outdir,
+            module_loads=module_loads,
+            load_env=get_python_source_command(),
+            email=email,
+            account=account,
+        )
+        self.log_dirs = {}
+
+    def log_dir(self, jobname: str) -> str:
+        if jobname not in self.log_dirs:
+            self.log_dirs[jobname] = os.path.abspath(
+                mkdir(self.outdir, f"log_{jobname}")
+            )
+        return self.log_dirs[jobname]
+
+    def render(
+        self,
+        jobname: str,
+        cpu_per_task: int,
+        time: str,
+        mem: str,
+        jobid: Optional[int] = None,
+        array_args: Optional[List[int]] = None,
+        array_job: Optional[bool] = False,
+        command: Optional[str] = None,
+        tmp_mem: Optional[str] = "",
+        bundle_size: Optional[int] = 1,
+        max_parallel: Optional[int] = 1,
+        profile: Optional[bool] = False,
+        theano_cache: Optional[str] = "",
+        mode: Optional[str] = "",
+        node_pool: Optional[bool] = False,
+        throttle: Optional[int] = None,
+        staging: Optional[bool] = False,
+    ) -> Tuple[str, str]:
+        """Render a slurm file (see make_slurm_file for the args)
+
+        :return: (path to the slurm file, slurm file contents)
+        """
+        log_dir = self.log_dir(jobname)
+        if profile:
+            command = profile_command(
+                command, jobname, os.path.join(self.outdir, PROFILE_LOG)
+            )
+        if staging:
+            command = staged_command(command)
+        array_kwargs = dict(
+            array_end=None,
+            array_args=None,
+            log_file=os.path.join(log_dir, f"{jobname}_%j.log"),
+        )
+        if array_job:
+            array_kwargs = dict(
+                array_end=str(math.ceil(len(array_args) / bundle_size) - 1),
+                array_args=to_str_list(array_args),
+                log_file=os.path.join(log_dir, f"{jobname}_%A_%a.log"),
+                exit_codes=os.path.join(
+                    log_dir,
+                    f"{jobname}_${{SLURM_ARRAY_JOB_ID}}_"
+                    f"${{SLURM_ARRAY_TASK_ID}}.exit_codes",
+                ),
+                toi_log=os.path.join(
+                    log_dir,
+                    f"{jobname}_${{SLURM_ARRAY_JOB_ID}}_"
+                    f"${{SLURM_ARRAY_TASK_ID}}_toi${{TOI}}.log",
+                ),
+            )
+        file_contents = self.template.render(
+            **self.common_kwargs,
+            **array_kwargs,
+            jobname=f"toi_{jobname}" + (f"_{mode}" if mode else ""),
+            time=time,
+            cpu_per_task=cpu_per_task,
+            mem=mem,
+            array_job=str(array_job),
+            command=command,
+            tmp_mem=tmp_mem,
+            bundle_size=bundle_size,
+            max_parallel=max_parallel,
+            theano_cache=theano_cache,
+            node_pool=node_pool,
+            throttle=throttle,
+            staging=staging,
+        )
+        jobid_str = f"_{jobid}" if jobid is not None else ""
+        jobfile_name = os.path.join(
+            self.submit_dir, f"slurm_{jobname}{jobid_str}_job.sh"
+        )
+        return os.path.abspath(jobfile_name), file_contents
+
+    def write(self, **job_kwargs) -> str:
+        """Render and write a slurm file (see make_slurm_file for the args)
+
+        :return: path to the (content-addressed) slurm file
+        """
+        jobfile_name, file_contents = self.render(**job_kwargs)
+        script_hash = hashlib.sha1(file_contents.encode()).hexdigest()
+        jobname = job_kwargs["jobname"]
+        script = os.path.join(
+            self.scripts_dir,
+            f"slurm_{jobname}_{script_hash[:SCRIPT_HASH_LENGTH]}.sh",
+        )
+        if not os.path.exists(script):
+            write_if_changed(script, file_contents)
+        replace_symlink(script, jobfile_name)
+        array_args = job_kwargs.get("array_args") or []
+        bundle_size = job_kwargs.get("bundle_size") or 1
+        self.scripts.append(
+            dict(
+                slurm_file=script,
+                hash=script_hash,
+                jobname=jobname,
+                batch=job_kwargs.get("jobid"),
+                tasks=[
+                    array_args[i : i + bundle_size]
+                    for i in range(0, len(array_args), bundle_size)
+                ]
+                if job_kwargs.get("array_job")
+                else [],
+                **{k: job_kwargs.get(k) for k in SCRIPT_RESOURCES},
+            )
+        )
+        return script
+
+    def write_many(self, jobs: Iterable[Dict]) -> List[str]:
+        """Render and write a slurm file for each dict of job kwargs"""
+        return [self.write(**job_kwargs) for job_kwargs in jobs]
+
+
 def make_slurm_file(
     outdir: str,
     module_loads: str,
@@ -33,9 +217,19 @@ def make_slurm_file(
     email: Optional[str] = "",
     tmp_mem: Optional[str] = "",
     account: Optional[str] = "",
+    bundle_size: Optional[int] = 1,
+    max_parallel: Optional[int] = 1,
+    profile: Optional[bool] = False,
+    theano_cache: Optional[str] = "",
+    mode: Optional[str] = "",
+    node_pool: Optional[bool] = False,
+    throttle: Optional[int] = None,
+    staging: Optional[bool] = False,
 ) -> str:
     """Make a slurm file for submitting a job to the cluster
 
+    (To make many slurm files, reuse a SlurmFileRenderer instead.)
+
     :param outdir: Base output directory (will generate {outdir}/log_{jobname})
     :param module_loads: Module loads to include in the slurm file
     :param jobname: Name of the job
@@ -50,47 +244,51 @@ def make_slurm_file(
     :param email: Email address to send notifications to
     :param tmp_mem: Temporary mem (tmp dir accessible via $JOBFS) (eg 1000M, or 1G)
     :param account: Account to charge the job to
+    :param bundle_size: Number of array args (TOIs) run by each array task
+        (the command is run once per TOI, with $TOI set; exit codes are logged
+        to {outdir}/log_{jobname}/{jobname}_%A_%a.exit_codes)
+    :param max_parallel: Max number of TOIs of a bundle run concurrently
+    :param profile: Run each TOI's command through the profiler, which
+        appends its wall time, peak RSS, $JOBFS usage and Theano compile
+        time to {outdir}/profiling.jsonl
+    :param theano_cache: Theano compile cache tarball to unpack into $JOBFS
+        (see theano_cache.py)
+    :param mode: Run mode (e.g. quickrun) appended to the sbatch job name
+    :param node_pool: Each array task gets a whole node, and runs its bundle of
+        TOIs max_parallel at a time (each in its own srun step, refilling the
+        slots as TOIs finish). Each TOI's output goes to
+        {outdir}/log_{jobname}/{jobname}_%A_%a_toi{TOI}.log
+    :param throttle: Max number of array tasks running at once (%N)
+    :param staging: Run each TOI in $JOBFS/stage_$TOI (the command's
+        --outdir must be staging.STAGE_OUTDIR): its generation outputs are
+        copied in, and its results are moved back to {outdir}/toi_N_files
+        in one rename once it succeeded (see staging.py). The tmp_mem must
+        leave room for the TOI's outputs.
 
 
     """
-    log_dir = os.path.abspath(mkdir(outdir, f"log_{jobname}"))
-    common_kwargs = dict(
-        jobname=f"toi_{jobname}",
-        time=time,
-        outdir=os.path.abspath(outdir),
-        module_loads=module_loads,
+    renderer = SlurmFileRenderer(
+        outdir, module_loads, submit_dir, email=email, account=account
+    )
+    return renderer.write(
+        jobname=jobname,
         cpu_per_task=cpu_per_task,
-        load_env=get_python_source_command(),
+        time=time,
         mem=mem,
-        array_job=str(array_job),
+        jobid=jobid,
+        array_args=array_args,
+        array_job=array_job,
         command=command,
-        email=email,
         tmp_mem=tmp_mem,
-        account=account,
+        bundle_size=bundle_size,
+        max_parallel=max_parallel,
+        profile=profile,
+        theano_cache=theano_cache,
+        mode=mode,
+        node_pool=node_pool,
+        throttle=throttle,
+        staging=staging,
     )
-    array_kwargs = dict(
-        array_end=None,
-        array_args=None,
-        log_file=os.path.abspath(mkdir(log_dir, f"{jobname}_%j.log")),
-    )
-    if array_job:
-        array_kwargs = dict(
-            array_end=str(len(array_args) - 1),
-            array_args=to_str_list(array_args),
-            log_file=mkdir(log_dir, f"{jobname}_%A_%a.log"),
-        )
-
-    file_contents = __load_template(SLURM_TEMPLATE).render(
-        **common_kwargs, **array_kwargs
-    )
-
-    jobid_str = f"_{jobid}" if jobid is not None else ""
-    jobfile_name = os.path.join(
-        submit_dir, f"slurm_{jobname}{jobid_str}_job.sh"
-    )
-    with open(jobfile_name, "w") as f:
-        f.write(file_contents)
-    return os.path.abspath(jobfile_name)
 
 
 def __remove_null_values(l):
@@ -98,19 +296,47 @@ def __remove_null_values(l):
 
 
 def make_main_submitter(
-    generation_fns, analysis_fns, submit_dir, partition=""
+    generation_fns,
+    analysis_fns,
+    submit_dir,
+    partition="",
+    cache_fn=None,
+    dependency="aftercorr",
 ):
-    """Make a submit.sh file which submits all the jobs"""
+    """Make a submit.sh file which submits all the jobs
+
+    If a cache_fn (Theano cache job) is passed, it is submitted after the
+    first generation task, and all analysis jobs depend on it.
+    The analysis jobs depend on their generation job with the dependency
+    type (aftercorr: task by task, afterany: once the whole array is done).
+    """
     generation_fns = __remove_null_values(generation_fns)
     analysis_fns = __remove_null_values(analysis_fns)
 
-    template = __load_template(SUBMIT_TEMPLATE)
+    template = load_template(SUBMIT_TEMPLATE)
     file_contents = template.render(
         generation_fns=to_str_list(generation_fns),
         analysis_fns=to_str_list(analysis_fns),
         partition=partition,
+        cache_fn=cache_fn or "",
+        dependency=dependency,
+        ledger=os.path.abspath(
+            os.path.join(submit_dir, SUBMITTED_JOBS_LEDGER)
+        ),
     )
     subfn = os.path.join(submit_dir, "submit.sh")
-    with open(subfn, "w") as f:
-        f.write(file_contents)
+    write_if_changed(subfn, file_contents)
     return os.path.abspath(subfn)
+
+
+def read_array_args(slurm_file: str) -> List[List[int]]:
+    """Read the ARRAY_ARGS (TOI numbers) of each array task of a slurm file"""
+    with open(slurm_file) as f:
+        txt = f.read()
+    match = re.search(r"^ARRAY_ARGS=\((.*)\)$", txt, re.MULTILINE)
+    args = [int(i) for i in match.group(1).split()] if match else []
+    match = re.search(r"^BUNDLE_SIZE=(\d+)$", txt, re.MULTILINE)
+    bundle_size = int(match.group(1)) if match else 1
+    return [
+        args[i : i + bundle_size] for i in range(0, len(args), bundle_size)
+    ]
@@ -0,0 +1,146 @@
+"""This module resolves the resources requested by the jobs of each stage.
+
+The defaults can't be modified (they are read-only mappings): each call to
+resolve_job_settings returns a new dict for that stage and run mode. When a
+jobstats CSV of previous runs is given, the time/mem (and tmp_mem, if the
+profiling log was merged into the jobstats) are right-sized to a percentile
+of the previous COMPLETED jobs of the same stage and mode, plus headroom.
+Over-requesting lowers the jobs' priority and their chances of backfilling.
+"""
+import math
+from types import MappingProxyType
+from typing import Dict, Optional
+
+from .utils import logger, minutes_to_slurm_time
+
+__all__ = [
+    "ANALYSIS_JOB_SETTINGS",
+    "GENERATION_JOB_SETTINGS",
+    "resolve_job_settings",
+]
+
+ANALYSIS = "analysis"
+GENERATION = "generation"
+QUICKRUN = "quickrun"
+
+ANALYSIS_JOB_SETTINGS = MappingProxyType(
+    dict(
+        cpu_per_task=2,
+        time="300:00",
+        jobname=f"pe",
+        mem="1500MB",
+        tmp_mem="500M",
+    )
+)
+
+GENERATION_JOB_SETTINGS = MappingProxyType(
+    dict(
+        cpu_per_task=1,
+        time="20:00",
+        jobname=f"gen",
+        mem="1000MB",
+    )
+)
+
+QUICKRUN_OVERRIDES = MappingProxyType(
+    {
+        ANALYSIS: MappingProxyType(
+            dict(time="20:00", mem="1000MB", cpu_per_task=1)
+        ),
+        GENERATION: MappingProxyType({}),
+    }
+)
+
+DEFAULTS = MappingProxyType(
+    {ANALYSIS: ANALYSIS_JOB_SETTINGS, GENERATION: GENERATION_JOB_SETTINGS}
+)
+
+PERCENTILE = 0.95
+HEADROOM = 1.2  # requested = HEADROOM * percentile of previous jobs
+MIN_JOBS = 20  # min number of previous jobs to right-size from
+MEM_STEP_MB = 100  # mem requests are rounded up to a multiple of this
+
+
+def resolve_job_settings(
+    stage: str,
+    quickrun: bool = False,
+    jobstats: Optional[str] = None,
+    percentile: float = PERCENTILE,
+    headroom: float = HEADROOM,
+    min_jobs: int = MIN_JOBS,
+) -> Dict:
+    """Get the slurm settings of a stage's jobs
+
+    :param stage: 'analysis' or 'generation'
+    :param quickrun: Settings for quickrun jobs (their sbatch job names get
+        a '_quickrun' suffix, so their history is kept apart)
+    :param jobstats: jobstats CSV of previous runs to right-size from
+    :param percentile: Percentile of the previous jobs' usage to request
+    :param headroom: Factor applied to the percentile
+    :param min_jobs: Min number of previous COMPLETED jobs needed to right-size
+    :return: a new dict of settings (cpu_per_task, time, jobname, mem, ...)
+    """
+    settings = dict(DEFAULTS[stage])
+    if quickrun:
+        settings.update(QUICKRUN_OVERRIDES[stage], mode=QUICKRUN)
+    if jobstats:
+        settings.update(
+            __right_size(settings, jobstats, percentile, headroom, min_jobs)
+        )
+    return settings
+
+
+def job_name(settings: Dict) -> str:
+    """The sbatch job name of the jobs made with these settings"""
+    mode = settings.get("mode", "")
+    return f"toi_{settings['jobname']}" + (f"_{mode}" if mode else "")
+
+
+def __right_size(
+    settings: Dict,
+    jobstats: str,
+    percentile: float,
+    headroom: float,
+    min_jobs: int,
+) -> Dict:
+    """time/mem/tmp_mem from the previous jobs (only those with enough data)
+
+    If a larger fraction than (1 - percentile) of the previous jobs hit
+    TIMEOUT (or OUT_OF_MEMORY), their time (or mem) isn't known, so the
+    current request is kept.
+    """
+    from .jobstats_collector import load_slurm_stats
+
+    stats = load_slurm_stats(jobstats)
+    stats = stats[stats.JobName == job_name(settings)]
+    state = stats.State.astype(str).str.split().str[0]
+    completed = stats[state == "COMPLETED"]
+    if len(completed) < min_jobs:
+        return {}
+
+    resolved = {}
+    if (state == "TIMEOUT").mean() < 1 - percentile:
+        minutes = completed.CPUTimeRAW / settings["cpu_per_task"] / 60
+        minutes = minutes.quantile(percentile) * headroom
+        if math.isfinite(minutes):
+            resolved["time"] = minutes_to_slurm_time(minutes)
+    if (state == "OUT_OF_MEMORY").mean() < 1 - percentile:
+        mem_mb = completed.MaxRSS.quantile(percentile) / 1024**2
+        if math.isfinite(mem_mb):
+            mem_mb = math.ceil(mem_mb * headroom / MEM_STEP_MB) * MEM_STEP_MB
+            resolved["mem"] = f"{mem_mb}MB"
+        else:  # (MaxRSS is only reported by the job steps)
+            logger.warning(
+                f"No MaxRSS for the {job_name(settings)} jobs of {jobstats} "
+                "(made from the allocation rows only?): mem not right-sized"
+            )
+    if "tmp_mem" in settings and "JobFSPeak" in completed:
+        jobfs = completed.JobFSPeak.dropna()
+        if len(jobfs) >= min_jobs:
+            tmp_mb = jobfs.quantile(percentile) * headroom / 1024**2
+            resolved["tmp_mem"] = f"{max(math.ceil(tmp_mb), 1)}M"
+    logger.info(
+        f"Right-sized {job_name(settings)} from {len(completed)} jobs: "
+        f"{resolved}"
+    )
+    return resolved
@@ -1,54 +1,405 @@
 import os
 import argparse
-from datetime import datetime
+import shlex
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
 import subprocess
+from typing import IO, Iterator, List, Optional, Tuple
 import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
 
-SLURM_STATS_FNAME = "jobstats.txt"
+from .file_generators import SUBMITTED_JOBS_LEDGER, read_array_args
+from .manifest import load_task_map
+from .utils import expand_array_task_ids, get_pyplot, logger
+
+# (with the job steps: MaxRSS is only reported for the steps of a job)
 STATS_COMMAND = (
-    "sacct -S {start} -E {end} -u {user} -X -o 'jobname%-40,cputimeraw,State,MaxRSS' --parsable2 > "
-    + SLURM_STATS_FNAME
+    "sacct -S {start} -E {end} -u {user} "
+    "-o jobid,jobname%-40,submit,cputimeraw,State,MaxRSS,ReqMem,AllocCPUS "
+    "--parsable2"
 )
+STORE_FNAME = "jobstats.sqlite"
+SHARD_DAYS = 7
+MAX_WORKERS = 4
+CHUNK_SIZE = 100_000
+SACCT_DTYPES = {
+    "JobID": "string",
+    "JobName": "string",
+    "Submit": "string",
+    "CPUTimeRAW": "float64",
+    "State": "category",
+    "MaxRSS": "float64",
+    "ReqMem": "float64",
+    "AllocCPUS": "float64",
+}
+STATS_DTYPES = {**SACCT_DTYPES, "TOI": "Int64"}
+PROFILING_DTYPES = {
+    "JobID": "string",
+    "TOI": "Int64",
+    "JobName": "string",
+    "Host": "string",
+    "Start": "string",
+    "WallTime": "float64",
+    "ExitCode": "Int64",
+    "PeakRSS": "float64",
+    "JobFSPeak": "float64",
+    "JobFSEnd": "float64",
+    "TheanoCacheSize": "float64",
+    "TheanoModules": "Int64",
+    "TheanoCompileTime": "float64",
+}
+# jobs in these states can still change, so their shard gets re-fetched
+OPEN_STATES = [
+    "PENDING",
+    "RUNNING",
+    "REQUEUED",
+    "RESIZING",
+    "SUSPENDED",
+    "CONFIGURING",
+    "COMPLETING",
+]
+MEM_UNITS = {
+    "": 1,
+    "K": 1024,
+    "M": 1024**2,
+    "G": 1024**3,
+    "T": 1024**4,
+    "P": 1024**5,
+}
+DATE_FMT = "%Y-%m-%d"
+# version of the store's rows (1: MaxRSS from the job steps)
+STORE_VERSION = 1
 
 SEC_IN_HR = 60.0 * 60.0
 
 
-def create_slurm_stats_file(start: str, end: str, user: str, fname: str):
-    """This function creates a file called jobstats.txt in the current directory
-    which contains the job stats for the given user between the given dates.
+def create_slurm_stats_file(
+    start: str,
+    end: str,
+    user: str,
+    fname: str,
+    store: str = STORE_FNAME,
+    shard_days: int = SHARD_DAYS,
+    max_workers: int = MAX_WORKERS,
+    submit_dir: Optional[str] = None,
+    profiling_log: Optional[str] = None,
+):
+    """This function creates a CSV with the job stats (of 'toi' jobs) for the
+    given user, for jobs submitted between the given dates.
 
     Useful for debugging/checking job stats.
 
-    The file is created by running the following command:
-    sacct -S {start} -E {end} -u {user} {extra_args} -o \
-    'jobname%-40,cputimeraw,State,MaxRSS' --parsable2 > jobstats.txt
+    The stats are pulled into a local accounting store (see
+    sync_accounting_store) by running the following command per date-shard:
+    sacct -S {start} -E {end} -u {user} \
+    -o 'jobid,jobname%-40,submit,cputimeraw,State,MaxRSS,ReqMem,AllocCPUS' \
+    --parsable2
+
+    Only shards missing from the store (or that still had running jobs)
+    are re-queried, so repeated calls are incremental.
 
     - cputimeraw is the total CPU time used by the job in seconds.
-    - MaxRSS is the maximum resident set size of all tasks in the job.
+    - MaxRSS is the maximum resident set size of the job's steps (bytes).
+    - ReqMem is the memory requested for the job (bytes, per-CPU requests
+      are multiplied by AllocCPUS).
+    - AllocCPUS is the number of CPUs allocated to the job.
     - State is the current state of the job (e.g. COMPLETED, FAILED, TIMEOUT).
 
     :param start: Date in YYYY-MM-DD format
     :param end: Date in YYYY-MM-DD format (must be greater than start)
     :param user: username
-    :param store_mem: yes is mem data to be stored
+    :param fname: Output CSV filename
+    :param store: SQLite file to cache the accounting data in
+    :param shard_days: Number of days queried per sacct call
+    :param max_workers: Max number of concurrent sacct calls
+    :param submit_dir: Submit dir of the jobs (to add the TOI of each array task)
+    :param profiling_log: Profiling log of the jobs (see profiler) to merge in
     """
-    cmd = STATS_COMMAND.format(start=start, end=end, user=user)
-    process = subprocess.Popen(cmd, shell=True)
-    process.wait()
-    data = __slurm_raw_data_to_dataframe()
-    # remove all non 'toi' jobs
-    data = data[data["JobName"].str.contains("toi")]
-    data.to_csv(fname, index=False)
+    sync_accounting_store(start, end, user, store, shard_days, max_workers)
+    task_map = load_array_task_map(submit_dir) if submit_dir else None
+    profiling = load_profiling_log(profiling_log) if profiling_log else None
+    if os.path.exists(fname):
+        os.remove(fname)
+    with sqlite3.connect(store) as conn:
+        chunks = pd.read_sql_query(
+            f"SELECT {','.join(SACCT_DTYPES)} FROM jobs WHERE User = ? "
+            "AND Submit >= ? AND Submit < ? ORDER BY Submit",
+            conn,
+            params=(user, start, __next_day(end)),
+            chunksize=CHUNK_SIZE,
+        )
+        for i, chunk in enumerate(chunks):
+            chunk = add_toi_numbers(chunk, task_map)
+            if profiling is not None:
+                chunk = merge_profiling_log(chunk, profiling)
+            chunk.to_csv(fname, mode="a", header=i == 0, index=False)
+    if not os.path.exists(fname):  # no toi jobs in range
+        pd.DataFrame(columns=list(STATS_DTYPES)).to_csv(fname, index=False)
     plot_jobs_runtime_histogram(fname)
-    os.remove(SLURM_STATS_FNAME)
     print(f"Jobstats saved in: {os.path.abspath(fname)}")
 
 
+def sync_accounting_store(
+    start: str,
+    end: str,
+    user: str,
+    store: str = STORE_FNAME,
+    shard_days: int = SHARD_DAYS,
+    max_workers: int = MAX_WORKERS,
+) -> int:
+    """Fetch the 'toi' job stats between start and end into an SQLite store.
+
+    The date range is split into shards of shard_days, and the shards that
+    are not yet in the store (or are still 'open': not over when fetched,
+    or with jobs that were still pending/running) are queried concurrently
+    with at most max_workers sacct calls. A fetched shard replaces the
+    user's rows submitted in its date range. Rows are keyed by JobID (and
+    tagged with the user), so jobs seen in several shards are only stored
+    once: the row of the shard written last is kept.
+
+    :return: Number of shards fetched
+    """
+    conn = __connect_store(store)
+    closed = {
+        (s, e)
+        for s, e in conn.execute(
+            "SELECT start, end FROM shards WHERE user=? AND closed=1", (user,)
+        )
+    }
+    shards = __date_shards(start, end, shard_days)
+    todo = [s for s in shards if s not in closed]
+    logger.info(
+        f"Accounting store {store}: fetching {len(todo)}/{len(shards)} "
+        "sacct shards"
+    )
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(__fetch_shard, s, e, user): (s, e)
+            for s, e in todo
+        }
+        for future in as_completed(futures):
+            shard_start, shard_end = futures[future]
+            data = future.result()
+            is_open = data["State"].isin(OPEN_STATES).any() or (
+                shard_end >= __today()
+            )
+            with conn:
+                # (a re-fetched shard replaces its rows: e.g. the row of
+                # pending array tasks '5_[1-3]' once they ran as '5_1'...)
+                conn.execute(
+                    "DELETE FROM jobs WHERE User = ? AND Submit >= ? "
+                    "AND Submit < ?",
+                    (user, shard_start, shard_end),
+                )
+                conn.executemany(
+                    f"INSERT OR REPLACE INTO jobs "
+                    f"(User, {','.join(SACCT_DTYPES)}) "
+                    f"VALUES (?, {','.join('?' * len(SACCT_DTYPES))})",
+                    (
+                        (user, *row)
+                        for row in data.astype(object)
+                        .where(data.notna(), None)
+                        .itertuples(index=False, name=None)
+                    ),
+                )
+                conn.execute(
+                    "INSERT OR REPLACE INTO shards VALUES (?, ?, ?, ?, ?)",
+                    (
+                        user,
+                        shard_start,
+                        shard_end,
+                        datetime.now().isoformat(),
+                        int(not is_open),
+                    ),
+                )
+    conn.close()
+    return len(todo)
+
+
+def __connect_store(store: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(store)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS jobs (JobID TEXT PRIMARY KEY, "
+        "JobName TEXT, Submit TEXT, CPUTimeRAW REAL, State TEXT, "
+        "MaxRSS REAL, ReqMem REAL, AllocCPUS REAL, User TEXT)"
+    )
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS shards (user TEXT, start TEXT, "
+        "end TEXT, fetched TEXT, closed INTEGER, "
+        "PRIMARY KEY (user, start, end))"
+    )
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(jobs)")]
+    new_columns = [c for c in [*SACCT_DTYPES, "User"] if c not in columns]
+    if new_columns:
+        # store made by an older version: add the columns, and re-open all
+        # the shards so that they are re-fetched with the new columns
+        with conn:
+            for c in new_columns:
+                kind = "TEXT" if c == "User" else "REAL"
+                conn.execute(f"ALTER TABLE jobs ADD COLUMN {c} {kind}")
+            conn.execute("UPDATE shards SET closed=0")
+    (version,) = conn.execute("PRAGMA user_version").fetchone()
+    if version < STORE_VERSION:
+        # (rows fetched without the job steps have no MaxRSS)
+        with conn:
+            conn.execute("UPDATE shards SET closed=0")
+            conn.execute(f"PRAGMA user_version = {STORE_VERSION}")
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS user_submit_idx ON jobs (User, Submit)"
+    )
+    return conn
+
+
+def __date_shards(
+    start: str, end: str, shard_days: int
+) -> List[Tuple[str, str]]:
+    """Split [start, end] into consecutive (start, end) date shards"""
+    shard_start = datetime.strptime(start, DATE_FMT)
+    final = datetime.strptime(__next_day(end), DATE_FMT)
+    shards = []
+    while shard_start < final:
+        shard_end = min(shard_start + timedelta(days=shard_days), final)
+        shards.append(
+            (shard_start.strftime(DATE_FMT), shard_end.strftime(DATE_FMT))
+        )
+        shard_start = shard_end
+    return shards
+
+
+def __next_day(date: str) -> str:
+    next_day = datetime.strptime(date, DATE_FMT) + timedelta(days=1)
+    return next_day.strftime(DATE_FMT)
+
+
+def __fetch_shard(start: str, end: str, user: str) -> pd.DataFrame:
+    """Stream one sacct call into a (typed) dataframe of 'toi' jobs"""
+    cmd = STATS_COMMAND.format(start=start, end=end, user=user)
+    process = subprocess.Popen(
+        shlex.split(cmd), stdout=subprocess.PIPE, text=True
+    )
+    with process.stdout:
+        chunks = list(__slurm_raw_data_to_dataframe(process.stdout))
+    if process.wait() != 0:
+        raise subprocess.CalledProcessError(process.returncode, cmd)
+    if len(chunks) == 0:
+        return pd.DataFrame(columns=list(SACCT_DTYPES)).astype(SACCT_DTYPES)
+    return pd.concat(chunks, ignore_index=True)
+
+
+def load_array_task_map(submit_dir: str) -> pd.DataFrame:
+    """Map the array tasks of the jobs submitted from submit_dir to TOIs
+
+    Uses the manifest of the submit dir (see manifest.py), and the
+    ARRAY_ARGS of the submitted slurm files that aren't in it (made by
+    older versions).
+
+    :return: dataframe with columns ArrayJobID|TaskID|TOI
+    """
+    ledger = os.path.join(submit_dir, SUBMITTED_JOBS_LEDGER)
+    columns = ["ArrayJobID", "TaskID", "TOI"]
+    if not os.path.exists(ledger):
+        logger.warning(f"No submitted jobs ledger found at {ledger}")
+        return pd.DataFrame(columns=columns)
+    jobs = pd.read_csv(
+        ledger, sep=" ", names=["ArrayJobID", "slurm_file"], dtype=str
+    ).drop_duplicates("ArrayJobID", keep="last")
+    manifest_map = load_task_map(submit_dir)
+    jobs = jobs[~jobs.ArrayJobID.isin(manifest_map.ArrayJobID)]
+    task_map = [
+        (job_id, task_id, toi)
+        for job_id, fn in jobs.itertuples(index=False)
+        if os.path.exists(fn)
+        for task_id, tois in enumerate(read_array_args(fn))
+        for toi in tois
+    ]
+    if len(task_map) > 0:  # (jobs submitted before the manifest existed)
+        manifest_map = pd.concat(
+            [manifest_map, pd.DataFrame(task_map, columns=columns)],
+            ignore_index=True,
+        )
+    return manifest_map[columns]
+
+
+def add_toi_numbers(
+    stats: pd.DataFrame, task_map: Optional[pd.DataFrame]
+) -> pd.DataFrame:
+    """Add a TOI column to the stats (using the JobID -> TOI task_map)
+
+    Pending array tasks (reported by sacct as one row, e.g. '123_[4-10]')
+    are expanded to one row per task. Tasks that ran a bundle of TOIs get
+    one row per TOI, with the CPUTimeRAW split evenly between them.
+    """
+    stats = stats.drop(columns="TOI", errors="ignore")
+    if task_map is None or len(task_map) == 0:
+        return stats.assign(TOI=pd.NA)
+    ids = stats["JobID"].astype(str)
+    pending = ids.str.contains("[", regex=False)
+    if pending.any():
+        ids = ids.where(~pending, ids[pending].map(expand_array_task_ids))
+        stats = stats.assign(JobID=ids).explode("JobID")
+        stats["JobID"] = stats["JobID"].astype(SACCT_DTYPES["JobID"])
+    stats = stats.reset_index(drop=True)
+    ids = stats["JobID"].astype(str).str.extract(r"^(\d+)_(\d+)$")
+    keys = pd.DataFrame(
+        dict(ArrayJobID=ids[0], TaskID=pd.to_numeric(ids[1]))
+    ).reset_index()
+    task_map = task_map.astype(dict(ArrayJobID=str, TaskID="float64"))
+    task_map["n_tois"] = task_map.groupby(["ArrayJobID", "TaskID"])[
+        "TOI"
+    ].transform("size")
+    keys = keys.merge(task_map, how="left", on=["ArrayJobID", "TaskID"])
+    stats = stats.loc[keys["index"]].assign(TOI=keys["TOI"].values)
+    n_tois = keys["n_tois"].fillna(1).values
+    stats["CPUTimeRAW"] = stats["CPUTimeRAW"] / n_tois
+    return stats.reset_index(drop=True)
+
+
+def load_profiling_log(fname: str) -> pd.DataFrame:
+    """Load a profiling log (JSON lines written by the profiler)
+
+    Only the last record of each (JobID, TOI) is kept (earlier ones are from
+    requeued runs).
+    """
+    profiling = pd.read_json(fname, lines=True, dtype=dict(JobID=str))
+    if len(profiling) == 0:
+        return pd.DataFrame(columns=list(PROFILING_DTYPES))
+    profiling = profiling.astype(PROFILING_DTYPES)
+    return profiling.drop_duplicates(["JobID", "TOI"], keep="last")
+
+
+def merge_profiling_log(
+    stats: pd.DataFrame, profiling: pd.DataFrame
+) -> pd.DataFrame:
+    """Add the per-TOI profiling columns to the stats
+
+    Rows are matched on JobID and TOI (or on JobID alone if the stats have
+    no TOIs, in which case bundled tasks get one row per profiled TOI).
+    """
+    profiling = profiling.drop(columns="JobName")
+    if "TOI" in stats and stats["TOI"].notna().any():
+        on = ["JobID", "TOI"]
+        stats = stats.astype(dict(TOI="Int64"))
+    else:
+        on = ["JobID"]
+        stats = stats.drop(columns="TOI", errors="ignore")
+    stats = stats.astype(dict(JobID=str))
+    return stats.merge(profiling.astype(dict(JobID=str)), how="left", on=on)
+
+
+def load_slurm_stats(fname: str) -> pd.DataFrame:
+    """Load a jobstats CSV (from create_slurm_stats_file) with typed columns"""
+    return pd.read_csv(fname, dtype={**PROFILING_DTYPES, **STATS_DTYPES})
+
+
 def plot_jobs_runtime_histogram(fname: str):
     """Plot a histogram of the job runtimes"""
-    data = pd.read_csv(fname)
+    plt = get_pyplot()
+    data = pd.read_csv(
+        fname,
+        usecols=["CPUTimeRAW", "State"],
+        dtype={k: STATS_DTYPES[k] for k in ["CPUTimeRAW", "State"]},
+    )
     total_cpu_hrs = data["CPUTimeRAW"].sum() / SEC_IN_HR
     data = data[data["State"] == "COMPLETED"]
     data = data[data["CPUTimeRAW"] > 0]
@@ -70,26 +421,87 @@ def plot_jobs_runtime_histogram(fname: str):
     plt.savefig(fname.replace(".csv", ".png"))
 
 
-def __slurm_raw_data_to_dataframe() -> pd.DataFrame:
+def parse_mem_to_bytes(
+    mem: pd.Series, cpus: Optional[pd.Series] = None
+) -> pd.Series:
+    """Convert sacct memory strings (e.g. '1024K', '1.5G') to bytes
+
+    The legacy per-CPU requests of ReqMem (e.g. '4000Mc') are multiplied by
+    cpus (per-node requests, e.g. '4000Mn', are kept as they are).
+    """
+    parts = mem.astype("string").str.extract(
+        r"^\s*([\d.]+)\s*([KMGTP]?)([cn]?)"
+    )
+    mem_bytes = pd.to_numeric(parts[0], errors="coerce") * parts[1].map(
+        MEM_UNITS
+    ).astype("float64")
+    if cpus is not None:
+        per_cpu = parts[2].eq("c").fillna(False).to_numpy(bool)
+        mem_bytes[per_cpu] *= pd.to_numeric(cpus, errors="coerce")[per_cpu]
+    return mem_bytes
+
+
+def __slurm_raw_data_to_dataframe(
+    stream: IO[str], chunksize: int = CHUNK_SIZE
+) -> Iterator[pd.DataFrame]:
     """
-    Returns dataframe with the following columns:
-    JobName|CPUTimeRAW|State|MaxRSS
+    Yields typed dataframes (of at most ~chunksize rows) of 'toi' jobs
+    with the following columns:
+    JobID|JobName|Submit|CPUTimeRAW|State|MaxRSS|ReqMem|AllocCPUS
+    (columns missing from sacct's output are left empty)
+
+    Only the rows of the jobs are kept (not those of their steps, e.g.
+    '123_4.batch'), with the max MaxRSS of their steps.
     """
-    with open(SLURM_STATS_FNAME, "r") as f:
-        filecontents = f.read().split("\n")
-    header = filecontents[0].split("|")
-    data = filecontents[1:]
-    data = [d for d in data if len(d) > 1]
-    data = np.array([np.array(row.split("|")) for row in data])
-    data = data.T
-    data_dict = {header[i]: data[i] for i in range(len(header))}
-    data = pd.DataFrame(data_dict)
-    data["CPUTimeRAW"] = data["CPUTimeRAW"].astype("float64")
-    return data
+    try:
+        reader = pd.read_csv(
+            stream,
+            sep="|",
+            dtype=str,
+            keep_default_na=False,
+            chunksize=chunksize,
+        )
+    except pd.errors.EmptyDataError:  # sacct printed nothing
+        return
+    rest = None
+    for data in reader:
+        if rest is not None:
+            data = pd.concat([rest, data], ignore_index=True)
+        if len(data) == 0:
+            continue
+        # (the steps of the last job may continue in the next chunk)
+        job_ids = data["JobID"].str.split(".", n=1).str[0]
+        last = (job_ids == job_ids.iloc[-1]).to_numpy()
+        rest = data[last]
+        data = __job_rows(data[~last])
+        if len(data) > 0:
+            yield data
+    if rest is not None and len(rest) > 0:
+        data = __job_rows(rest)
+        if len(data) > 0:
+            yield data
+
+
+def __job_rows(data: pd.DataFrame) -> pd.DataFrame:
+    """The typed rows of the 'toi' jobs of a chunk of sacct rows (jobs
+    followed by their steps)"""
+    data = data.reindex(columns=list(SACCT_DTYPES), fill_value="")
+    job_ids = data["JobID"].str.split(".", n=1).str[0]
+    max_rss = parse_mem_to_bytes(data["MaxRSS"]).groupby(job_ids).max()
+    # remove the steps and all non 'toi' jobs
+    data = data[~data["JobID"].str.contains(".", regex=False)]
+    data = data[data["JobName"].str.contains("toi", regex=False)]
+    data = data.assign(
+        CPUTimeRAW=pd.to_numeric(data["CPUTimeRAW"], errors="coerce"),
+        MaxRSS=data["JobID"].map(max_rss),
+        ReqMem=parse_mem_to_bytes(data["ReqMem"], data["AllocCPUS"]),
+        AllocCPUS=pd.to_numeric(data["AllocCPUS"], errors="coerce"),
+    )
+    return data[list(SACCT_DTYPES)].astype(SACCT_DTYPES)
 
 
 def __today() -> str:
-    return datetime.today().strftime("%Y-%m-%d")
+    return datetime.today().strftime(DATE_FMT)
 
 
 def main():
@@ -115,8 +527,48 @@ def main():
         required=False,
         default="jobstats.csv",
     )
+    parser.add_argument(
+        "--store",
+        help="SQLite file caching the accounting data between runs",
+        required=False,
+        default=STORE_FNAME,
+    )
+    parser.add_argument(
+        "--shard_days",
+        help="Number of days per sacct query",
+        type=int,
+        default=SHARD_DAYS,
+    )
+    parser.add_argument(
+        "--max_workers",
+        help="Max number of concurrent sacct queries",
+        type=int,
+        default=MAX_WORKERS,
+    )
+    parser.add_argument(
+        "--submit_dir",
+        help="Submit dir of the jobs (adds the TOI of each array task)",
+        required=False,
+        default=None,
+    )
+    parser.add_argument(
+        "--profiling_log",
+        help="Profiling log of the jobs (outdir/profiling.jsonl) to merge in",
+        required=False,
+        default=None,
+    )
     args = parser.parse_args()
-    create_slurm_stats_file(args.start, args.end, args.user, args.fname)
+    create_slurm_stats_file(
+        args.start,
+        args.end,
+        args.user,
+        args.fname,
+        store=args.store,
+        shard_days=args.shard_days,
+        max_workers=args.max_workers,
+        submit_dir=args.submit_dir,
+        profiling_log=args.profiling_log,
+    )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,277 @@
+"""This module summarises the accounting data (see jobstats_collector) into
+the numbers needed to tune the job settings and justify allocations:
+
+- CPU-hours by State and by array job
+- percentiles of the runtimes (of COMPLETED jobs)
+- MaxRSS vs requested mem efficiency
+- TIMEOUT/OOM/failure fractions over time
+- core-hours wasted on failed jobs
+
+The tables are computed from one typed dataframe of the jobs, and saved as
+a JSON summary (optionally also as Parquet tables) with a summary plot.
+"""
+import argparse
+import getpass
+import json
+import sqlite3
+from typing import Dict, Optional
+
+import pandas as pd
+
+from .jobstats_collector import SACCT_DTYPES, SEC_IN_HR, STORE_FNAME
+from .utils import get_pyplot
+
+__all__ = [
+    "load_accounting_data",
+    "summarise_jobstats",
+    "save_report",
+    "plot_report",
+]
+
+PERCENTILES = [0.5, 0.9, 0.95, 0.99]
+FAILED_STATES = [
+    "FAILED",
+    "TIMEOUT",
+    "OUT_OF_MEMORY",
+    "CANCELLED",
+    "NODE_FAIL",
+    "PREEMPTED",
+    "BOOT_FAIL",
+    "DEADLINE",
+]
+FREQ = "W"  # time bins of the failure fractions
+MB = 1024**2
+
+
+def load_accounting_data(
+    store: str = STORE_FNAME,
+    start: Optional[str] = None,
+    end: Optional[str] = None,
+    user: Optional[str] = None,
+) -> pd.DataFrame:
+    """Load the (typed) jobs of the user (default: all the users of the
+    store) submitted in [start, end) from the store"""
+    conditions, params = [], []
+    if user is not None:
+        conditions.append("User = ?")
+        params.append(user)
+    if start or end:
+        conditions.append("Submit >= ? AND Submit < ?")
+        params += [start or "", end or "9999"]
+    query = "SELECT * FROM jobs"
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    with sqlite3.connect(store) as conn:
+        data = pd.read_sql_query(query, conn, params=params)
+    return data.reindex(columns=list(SACCT_DTYPES)).astype(SACCT_DTYPES)
+
+
+def summarise_jobstats(
+    stats: pd.DataFrame, freq: str = FREQ
+) -> Dict[str, pd.DataFrame]:
+    """Summary tables of the jobs
+
+    :param stats: Jobs with the SACCT_DTYPES columns
+    :param freq: Time bins (pandas offset alias) of the failure fractions
+    :return: dict of tables: totals, by_state, by_array, runtime_percentiles,
+        mem_efficiency, failures_over_time
+    """
+    state = stats["State"].astype(str).str.split().str[0]
+    jobs = pd.DataFrame(
+        dict(
+            JobName=stats["JobName"].astype(str),
+            ArrayJobID=stats["JobID"].astype(str).str.split("_").str[0],
+            State=state,
+            Submit=pd.to_datetime(stats["Submit"], errors="coerce"),
+            cpu_hrs=stats["CPUTimeRAW"] / SEC_IN_HR,
+            wall_hrs=stats["CPUTimeRAW"] / stats["AllocCPUS"] / SEC_IN_HR,
+            max_rss_mb=stats["MaxRSS"] / MB,
+            req_mem_mb=stats["ReqMem"] / MB,
+            failed=state.isin(FAILED_STATES),
+            timeout=state == "TIMEOUT",
+            oom=state == "OUT_OF_MEMORY",
+        )
+    )
+    jobs["mem_efficiency"] = jobs["max_rss_mb"] / jobs["req_mem_mb"]
+    jobs["wasted_cpu_hrs"] = jobs["cpu_hrs"].where(jobs["failed"], 0.0)
+
+    by_state = jobs.groupby("State").agg(
+        n_jobs=("cpu_hrs", "size"), cpu_hrs=("cpu_hrs", "sum")
+    )
+    by_array = jobs.groupby(["ArrayJobID", "JobName"]).agg(
+        submit=("Submit", "min"),
+        n_tasks=("cpu_hrs", "size"),
+        n_failed=("failed", "sum"),
+        cpu_hrs=("cpu_hrs", "sum"),
+        wasted_cpu_hrs=("wasted_cpu_hrs", "sum"),
+    )
+
+    completed = jobs[jobs["State"] == "COMPLETED"].groupby("JobName")
+    runtimes = completed["wall_hrs"].quantile(PERCENTILES).unstack()
+    runtimes = runtimes.reindex(columns=PERCENTILES)
+    runtimes.columns = [f"p{int(q * 100)}_hrs" for q in PERCENTILES]
+    runtimes["max_hrs"] = completed["wall_hrs"].max()
+    runtimes["n_jobs"] = completed.size()
+
+    by_name = jobs.groupby("JobName")
+    mem_efficiency = pd.DataFrame(
+        dict(
+            req_mem_median_mb=by_name["req_mem_mb"].median(),
+            max_rss_p95_mb=by_name["max_rss_mb"].quantile(0.95),
+            max_rss_max_mb=by_name["max_rss_mb"].max(),
+            efficiency_median=by_name["mem_efficiency"].median(),
+            efficiency_p95=by_name["mem_efficiency"].quantile(0.95),
+        )
+    )
+
+    failures = (
+        jobs.dropna(subset=["Submit"])
+        .set_index("Submit")
+        .resample(freq)
+        .agg(
+            dict(
+                cpu_hrs="size",
+                timeout="mean",
+                oom="mean",
+                failed="mean",
+                wasted_cpu_hrs="sum",
+            )
+        )
+        .rename(
+            columns=dict(
+                cpu_hrs="n_jobs",
+                timeout="timeout_fraction",
+                oom="oom_fraction",
+                failed="failed_fraction",
+            )
+        )
+    )
+
+    total_cpu_hrs = jobs["cpu_hrs"].sum()
+    wasted_cpu_hrs = jobs["wasted_cpu_hrs"].sum()
+    totals = pd.DataFrame(
+        [
+            dict(
+                n_jobs=len(jobs),
+                n_failed=int(jobs["failed"].sum()),
+                cpu_hrs=total_cpu_hrs,
+                wasted_cpu_hrs=wasted_cpu_hrs,
+                wasted_fraction=(
+                    wasted_cpu_hrs / total_cpu_hrs if total_cpu_hrs else 0.0
+                ),
+            )
+        ]
+    )
+    return dict(
+        totals=totals,
+        by_state=by_state,
+        by_array=by_array,
+        runtime_percentiles=runtimes,
+        mem_efficiency=mem_efficiency,
+        failures_over_time=failures,
+    )
+
+
+def save_report(
+    summary: Dict[str, pd.DataFrame], prefix: str, parquet: bool = False
+) -> str:
+    """Save the summary tables as {prefix}_summary.json
+
+    :param parquet: Also save each table as {prefix}_{table}.parquet
+        (needs pyarrow or fastparquet)
+    :return: Path to the JSON summary
+    """
+    tables = {}
+    for name, table in summary.items():
+        table = table if name == "totals" else table.reset_index()
+        tables[name] = json.loads(
+            table.to_json(orient="records", date_format="iso")
+        )
+        if parquet:
+            table.to_parquet(f"{prefix}_{name}.parquet", index=False)
+    tables["totals"] = tables["totals"][0]
+    fname = f"{prefix}_summary.json"
+    with open(fname, "w") as f:
+        json.dump(tables, f, indent=2)
+    return fname
+
+
+def plot_report(summary: Dict[str, pd.DataFrame], fname: str):
+    """Plot the CPU-hrs by state, runtimes, mem efficiency and failures"""
+    plt = get_pyplot()
+    fig, axes = plt.subplots(2, 2, figsize=(12, 8))
+    totals = summary["totals"].iloc[0]
+    panels = [
+        (summary["by_state"][["cpu_hrs"]], "bar", "CPU Hrs"),
+        (
+            summary["runtime_percentiles"].filter(like="_hrs"),
+            "bar",
+            "Runtime of COMPLETED jobs (Hrs)",
+        ),
+        (
+            summary["mem_efficiency"][["efficiency_median", "efficiency_p95"]],
+            "bar",
+            "MaxRSS / ReqMem",
+        ),
+        (
+            summary["failures_over_time"].filter(like="_fraction"),
+            "line",
+            "Fraction of jobs",
+        ),
+    ]
+    for ax, (table, kind, label) in zip(axes.flat, panels):
+        if table.notna().any().any():  # (nothing to plot otherwise)
+            table.plot(kind=kind, ax=ax)
+        ax.set_ylabel(label)
+    axes[0, 0].set_title(
+        f"Total {totals.cpu_hrs:,.0f} CPU Hrs "
+        f"({totals.wasted_fraction:.0%} on failed jobs)"
+    )
+    plt.tight_layout()
+    plt.savefig(fname)
+    plt.close(fig)
+
+
+def main():
+    parser = argparse.ArgumentParser("Summarise the jobstats store")
+    parser.add_argument(
+        "--store",
+        default=STORE_FNAME,
+        help="SQLite accounting store (made by tess_jobstats)",
+    )
+    parser.add_argument(
+        "--user",
+        default=getpass.getuser(),
+        help="User whose jobs are summarised (default: you)",
+    )
+    parser.add_argument(
+        "--start", default=None, help="Start date in YYYY-MM-DD format"
+    )
+    parser.add_argument(
+        "--end", default=None, help="End date (exclusive) in YYYY-MM-DD format"
+    )
+    parser.add_argument(
+        "--prefix",
+        default="jobstats",
+        help="Prefix of the output files ({prefix}_summary.json, ...)",
+    )
+    parser.add_argument(
+        "--freq",
+        default=FREQ,
+        help="Time bins of the failure fractions (e.g. D, W, M)",
+    )
+    parser.add_argument(
+        "--parquet",
+        action="store_true",
+        help="Also save each table as a Parquet file",
+    )
+    args = parser.parse_args()
+    stats = load_accounting_data(args.store, args.start, args.end, args.user)
+    summary = summarise_jobstats(stats, args.freq)
+    fname = save_report(summary, args.prefix, args.parquet)
+    plot_report(summary, f"{args.prefix}_report.png")
+    print(f"Jobstats summary saved in: {fname}")
+
+
+if __name__ == "__main__":
+    main()
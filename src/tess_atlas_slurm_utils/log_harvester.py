@@ -0,0 +1,374 @@
+"""Failure triage over the job logs of an outdir (tess_logs)
+
+The logs in the outdir's log_{jobname} dirs are parsed (in parallel, with a
+process pool) into an index (an SQLite file in the outdir). Each harvest
+only parses the logs whose size or mtime changed since the last one. From
+the tail of each log the status (ok/error/timeout/oom/cancelled), the
+traceback signature (exception type + message, with numbers and paths
+masked) and the last progress line are extracted. The array tasks are
+mapped back to their TOIs with the ledger of submitted jobs and the
+ARRAY_ARGS of their slurm files, so failures can be grouped by signature.
+"""
+import argparse
+import os
+import re
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional
+
+import pandas as pd
+
+from .jobstats_collector import load_array_task_map
+from .utils import logger
+
+__all__ = [
+    "parse_log",
+    "harvest_logs",
+    "load_log_index",
+    "summarise_failures",
+]
+
+LOG_INDEX = ".log_index.sqlite"
+LOG_DIR_PREFIX = "log_"
+# {jobname}_%A_%a.log, {jobname}_%A_%a_toi{TOI}.log (node pools) and
+# {jobname}_%j.log (non-array jobs)
+LOG_REGEX = re.compile(
+    r"^(?P<stage>.+?)_(?P<job_id>\d+)(?:_(?P<task_id>\d+))?"
+    r"(?:_toi(?P<toi>\d+))?\.log$"
+)
+EXIT_CODES_REGEX = re.compile(
+    r"^.+?_(?P<job_id>\d+)_(?P<task_id>\d+)\.exit_codes$"
+)
+TAIL_BYTES = 64 * 1024  # only the end of each log is parsed
+MAX_WORKERS = os.cpu_count()
+MIN_POOL_SIZE = 256  # fewer logs than this are parsed in-process
+MAX_LINE_LENGTH = 200
+
+OK, ERROR, TIMEOUT, OOM, CANCELLED = (
+    "ok",
+    "error",
+    "timeout",
+    "oom",
+    "cancelled",
+)
+FAILED_STATUSES = [ERROR, TIMEOUT, OOM, CANCELLED]
+# (pattern, status) checked in order against the tail of the log
+STATUS_PATTERNS = [
+    (re.compile(r"DUE TO TIME LIMIT"), TIMEOUT),
+    (re.compile(r"oom[-_]kill|Out Of Memory|MemoryError"), OOM),
+    (re.compile(r"\*\*\* (JOB|STEP) .* CANCELLED"), CANCELLED),
+    (re.compile(r"^Traceback \(most recent call last\)", re.M), ERROR),
+    (re.compile(r"^(srun|slurmstepd): error:", re.M), ERROR),
+]
+EXCEPTION_REGEX = re.compile(
+    r"^(?P<type>[A-Za-z_][\w.]*(Error|Exception|Interrupt|Exit)\b):?"
+    r"\s*(?P<msg>.*)$"
+)
+MASKS = [  # (pattern, replacement) to make signatures comparable across TOIs
+    (re.compile(r"(/[\w.\-]+)+"), "<path>"),
+    (re.compile(r"0x[0-9a-fA-F]+"), "<hex>"),
+    (re.compile(r"\d+(\.\d+)?"), "<n>"),
+]
+INDEX_COLUMNS = [
+    "path",
+    "size",
+    "mtime_ns",
+    "stage",
+    "job_id",
+    "task_id",
+    "toi",
+    "status",
+    "signature",
+    "last_line",
+]
+
+
+def parse_log(path: str) -> Dict:
+    """Get the status, traceback signature and last progress line of a log
+
+    :return: dict with status|signature|last_line (signature is None if
+        the log has no traceback)
+    """
+    with open(path, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        f.seek(max(f.tell() - TAIL_BYTES, 0))
+        tail = f.read().decode(errors="replace")
+    status = next((s for p, s in STATUS_PATTERNS if p.search(tail)), OK)
+    lines = [line.rstrip() for line in tail.splitlines() if line.strip()]
+
+    signature, progress = None, lines
+    traceback_start = tail.rfind("Traceback (most recent call last)")
+    if traceback_start >= 0:
+        before, traceback = tail[:traceback_start], tail[traceback_start:]
+        progress = [l for l in before.splitlines() if l.strip()]
+        signature = __traceback_signature(traceback.splitlines())
+    elif status != OK:  # e.g. the slurmstepd TIME LIMIT/oom-kill line
+        signature = __status_line_signature(lines, status)
+    last_line = progress[-1].strip() if progress else ""
+    return dict(
+        status=status,
+        signature=signature,
+        last_line=last_line[:MAX_LINE_LENGTH],
+    )
+
+
+def __traceback_signature(lines: List[str]) -> Optional[str]:
+    """'ExceptionType: masked message' of the traceback's last exception"""
+    for line in reversed(lines):
+        match = EXCEPTION_REGEX.match(line.strip())
+        if match:
+            message = __mask(match.group("msg"))[:MAX_LINE_LENGTH]
+            return f"{match.group('type')}: {message}".rstrip(": ")
+    return "Traceback (no exception line)"
+
+
+def __status_line_signature(lines: List[str], status: str) -> str:
+    """The (masked) line of the log that gave its status"""
+    patterns = [p for p, s in STATUS_PATTERNS if s == status]
+    line = next(l for l in lines if any(p.search(l) for p in patterns))
+    return __mask(line)[:MAX_LINE_LENGTH]
+
+
+def __mask(text: str) -> str:
+    for pattern, replacement in MASKS:
+        text = pattern.sub(replacement, text)
+    return text.strip()
+
+
+def harvest_logs(
+    outdir: str,
+    submit_dir: Optional[str] = None,
+    max_workers: Optional[int] = MAX_WORKERS,
+    reindex: bool = False,
+) -> str:
+    """Parse the new/changed logs of the outdir's log dirs into the index
+
+    :param outdir: Outdir of the jobs (with the log_{jobname} dirs)
+    :param submit_dir: Submit dir of the jobs (to map array tasks to TOIs,
+        default: {outdir}/submit)
+    :param max_workers: Number of processes parsing the logs
+    :param reindex: Rebuild the index from scratch
+    :return: Path to the index
+    """
+    index = os.path.join(outdir, LOG_INDEX)
+    if reindex and os.path.exists(index):
+        os.remove(index)
+    conn = sqlite3.connect(index)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS logs (path TEXT PRIMARY KEY, "
+        "size INTEGER, mtime_ns INTEGER, stage TEXT, job_id TEXT, "
+        "task_id INTEGER, toi INTEGER, status TEXT, signature TEXT, "
+        "last_line TEXT)"
+    )
+    known = {
+        path: (size, mtime_ns)
+        for path, size, mtime_ns in conn.execute(
+            "SELECT path, size, mtime_ns FROM logs"
+        )
+    }
+    logs, exit_codes = __scan_log_dirs(outdir)
+    changed = [
+        (path, stat, match)
+        for path, (stat, match) in logs.items()
+        if known.get(path) != stat
+    ]
+    paths = [path for path, _, _ in changed]
+    if max_workers == 1 or len(paths) < MIN_POOL_SIZE:
+        parsed = list(map(parse_log, paths))
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            chunksize = max(len(paths) // (4 * (max_workers or 1)), 1)
+            parsed = list(
+                executor.map(parse_log, paths, chunksize=chunksize)
+            )
+    rows = [
+        (
+            path,
+            *stat,
+            match["stage"],
+            match["job_id"],
+            int(match["task_id"]) if match["task_id"] else None,
+            int(match["toi"]) if match["toi"] else None,
+            result["status"],
+            result["signature"],
+            result["last_line"],
+        )
+        for (path, stat, match), result in zip(changed, parsed)
+    ]
+    removed = [(path,) for path in set(known) - set(logs)]
+    submit_dir = submit_dir or os.path.join(outdir, "submit")
+    with conn:
+        conn.executemany("DELETE FROM logs WHERE path=?", removed)
+        conn.executemany(
+            f"INSERT OR REPLACE INTO logs VALUES "
+            f"({', '.join('?' * len(INDEX_COLUMNS))})",
+            rows,
+        )
+        __load_exit_codes(exit_codes).to_sql(
+            "exit_codes", conn, if_exists="replace", index=False
+        )
+        load_array_task_map(submit_dir).to_sql(
+            "tasks", conn, if_exists="replace", index=False
+        )
+    conn.close()
+    logger.info(
+        f"Log index {index}: {len(rows)} logs parsed, {len(removed)} removed "
+        f"({len(logs)} logs)"
+    )
+    return index
+
+
+def __scan_log_dirs(outdir: str):
+    """-> ({log path: ((size, mtime_ns), LOG_REGEX groups)}, exit codes
+    paths)"""
+    logs, exit_codes = {}, []
+    with os.scandir(outdir) as log_dirs:
+        for log_dir in log_dirs:
+            is_log_dir = log_dir.name.startswith(LOG_DIR_PREFIX)
+            if not (is_log_dir and log_dir.is_dir()):
+                continue
+            with os.scandir(log_dir.path) as entries:
+                for entry in entries:
+                    if entry.name.endswith(".exit_codes"):
+                        exit_codes.append(entry.path)
+                        continue
+                    match = LOG_REGEX.match(entry.name)
+                    if match and entry.is_file():
+                        stat = entry.stat()
+                        logs[entry.path] = (
+                            (stat.st_size, stat.st_mtime_ns),
+                            match.groupdict(),
+                        )
+    return logs, exit_codes
+
+
+def __load_exit_codes(paths: List[str]) -> pd.DataFrame:
+    """Exit code of each TOI of the bundled/node-pool tasks
+
+    :return: dataframe with columns job_id|task_id|toi|exit_code
+    """
+    rows = []
+    for path in paths:
+        match = EXIT_CODES_REGEX.match(os.path.basename(path))
+        if match is None:
+            continue
+        with open(path) as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) == 2 and all(p.isdigit() for p in parts):
+                    rows.append(
+                        (
+                            match["job_id"],
+                            int(match["task_id"]),
+                            int(parts[0]),
+                            int(parts[1]),
+                        )
+                    )
+    columns = ["job_id", "task_id", "toi", "exit_code"]
+    return pd.DataFrame(rows, columns=columns)
+
+
+def load_log_index(index: str) -> pd.DataFrame:
+    """Load the logs of the index, one row per (log, TOI)
+
+    The TOIs of array task logs come from the ledger of submitted jobs (a
+    bundled task's log has a row for each of its TOIs, and those with a
+    zero exit code are marked ok).
+    """
+    with sqlite3.connect(index) as conn:
+        logs = pd.read_sql_query(
+            """
+            SELECT logs.path, logs.stage, logs.job_id, logs.task_id,
+                COALESCE(logs.toi, tasks.TOI) AS toi, logs.status,
+                logs.signature, logs.last_line, exit_codes.exit_code
+            FROM logs
+            LEFT JOIN tasks ON logs.toi IS NULL
+                AND tasks.ArrayJobID = logs.job_id
+                AND tasks.TaskID = logs.task_id
+            LEFT JOIN exit_codes ON exit_codes.job_id = logs.job_id
+                AND exit_codes.task_id = logs.task_id
+                AND exit_codes.toi = COALESCE(logs.toi, tasks.TOI)
+            """,
+            conn,
+        )
+    conn.close()
+    ok = logs.exit_code == 0
+    logs.loc[ok, ["status", "signature"]] = [OK, None]
+    return logs.astype({"toi": "Int64", "exit_code": "Int64"})
+
+
+def __join_tois(tois: pd.Series) -> str:
+    return " ".join(map(str, sorted(tois.dropna().unique())))
+
+
+def summarise_failures(logs: pd.DataFrame) -> pd.DataFrame:
+    """Group the failed logs by signature (most common first)
+
+    :return: dataframe indexed by signature with columns
+        n_logs|n_tois|statuses|stages|tois|example
+    """
+    failed = logs[logs.status.isin(FAILED_STATUSES)]
+    failed = failed.assign(signature=failed.signature.fillna(failed.status))
+    groups = failed.groupby("signature").agg(
+        n_logs=("path", "nunique"),
+        n_tois=("toi", "nunique"),
+        statuses=("status", lambda s: ",".join(sorted(set(s)))),
+        stages=("stage", lambda s: ",".join(sorted(set(s)))),
+        tois=("toi", __join_tois),
+        example=("path", "first"),
+    )
+    return groups.sort_values("n_logs", ascending=False)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        "Index the job logs and group the failures by signature"
+    )
+    parser.add_argument(
+        "--outdir",
+        default="tess_atlas_catalog",
+        help="outdir of the jobs (with the log_{jobname} dirs)",
+    )
+    parser.add_argument(
+        "--submit_dir",
+        default=None,
+        help="Submit dir of the jobs (default: {outdir}/submit)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=MAX_WORKERS,
+        help="Number of processes parsing the logs",
+    )
+    parser.add_argument(
+        "--reindex",
+        action="store_true",
+        help="Rebuild the log index from scratch",
+    )
+    parser.add_argument(
+        "--signature",
+        default=None,
+        help="List the logs (and TOIs) of the failures with this signature",
+    )
+    parser.add_argument(
+        "--csv",
+        default=None,
+        help="Save the (log, TOI) rows of the index to this CSV",
+    )
+    args = parser.parse_args()
+    index = harvest_logs(
+        args.outdir, args.submit_dir, args.workers, args.reindex
+    )
+    logs = load_log_index(index)
+    if args.csv:
+        logs.to_csv(args.csv, index=False)
+    if args.signature:
+        matching = logs[logs.signature == args.signature]
+        print(matching[["toi", "status", "path", "last_line"]].to_string())
+    else:
+        with pd.option_context("display.max_colwidth", 60):
+            print(summarise_failures(logs).to_string())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+"""Versioned manifest of the slurm files made in a submit dir
+
+Slurm files are content-addressed (see SlurmFileRenderer.write), and each
+run of the job generation adds a new generation to the manifest (an SQLite
+file in the submit dir) with:
+- the script (hash, path, resources) of each (stage, batch)
+- the TOIs of each array task of the scripts
+- the job IDs of the submitted scripts (synced from the ledger of submitted
+  jobs, so jobs submitted by submit.sh are included)
+
+Array tasks are then mapped to TOIs with indexed lookups, instead of
+parsing the ARRAY_ARGS of every submitted slurm file.
+"""
+from __future__ import annotations
+
+import os
+import sqlite3
+from datetime import datetime
+from typing import TYPE_CHECKING, Dict, List, Optional
+
+from .file_generators import SCRIPT_RESOURCES, SUBMITTED_JOBS_LEDGER
+from .utils import logger
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+__all__ = ["write_manifest", "sync_job_ids", "load_task_map", "task_tois"]
+
+MANIFEST = "manifest.sqlite"
+SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS generations (generation INTEGER PRIMARY "
+    "KEY AUTOINCREMENT, created TEXT, n_scripts INTEGER, n_new INTEGER)",
+    "CREATE TABLE IF NOT EXISTS scripts (hash TEXT PRIMARY KEY, slurm_file "
+    "TEXT UNIQUE, jobname TEXT, cpu_per_task INTEGER, time TEXT, mem TEXT, "
+    "tmp_mem TEXT, throttle INTEGER, n_tasks INTEGER)",
+    "CREATE TABLE IF NOT EXISTS batches (generation INTEGER, jobname TEXT, "
+    "batch INTEGER, hash TEXT)",
+    "CREATE TABLE IF NOT EXISTS tasks (hash TEXT, task_id INTEGER, "
+    "toi INTEGER, PRIMARY KEY (hash, task_id, toi)) WITHOUT ROWID",
+    "CREATE INDEX IF NOT EXISTS tasks_toi ON tasks (toi)",
+    "CREATE TABLE IF NOT EXISTS jobs (job_id TEXT PRIMARY KEY, hash TEXT)",
+]
+
+
+def connect_manifest(submit_dir: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(os.path.join(submit_dir, MANIFEST))
+    for statement in SCHEMA:
+        conn.execute(statement)
+    return conn
+
+
+def write_manifest(submit_dir: str, scripts: List[Dict]) -> int:
+    """Add a generation (the scripts written by a SlurmFileRenderer) to the
+    manifest of the submit dir
+
+    :param scripts: dicts with the slurm_file|hash|jobname|batch|tasks (the
+        TOIs of each array task) and resources of each written script
+    :return: the generation number
+    """
+    conn = connect_manifest(submit_dir)
+    with conn:
+        known = {h for (h,) in conn.execute("SELECT hash FROM scripts")}
+        new = {s["hash"]: s for s in scripts if s["hash"] not in known}
+        generation = conn.execute(
+            "INSERT INTO generations (created, n_scripts, n_new) "
+            "VALUES (?, ?, ?)",
+            (datetime.now().isoformat(), len(scripts), len(new)),
+        ).lastrowid
+        conn.executemany(
+            "INSERT INTO scripts VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            [
+                (
+                    s["hash"],
+                    s["slurm_file"],
+                    s["jobname"],
+                    *[s[r] for r in SCRIPT_RESOURCES],
+                    len(s["tasks"]),
+                )
+                for s in new.values()
+            ],
+        )
+        conn.executemany(
+            "INSERT INTO tasks VALUES (?, ?, ?)",
+            [
+                (s["hash"], task_id, int(toi))
+                for s in new.values()
+                for task_id, tois in enumerate(s["tasks"])
+                for toi in tois
+            ],
+        )
+        conn.executemany(
+            "INSERT INTO batches VALUES (?, ?, ?, ?)",
+            [
+                (generation, s["jobname"], s["batch"], s["hash"])
+                for s in scripts
+            ],
+        )
+    conn.close()
+    logger.info(
+        f"Manifest generation {generation}: {len(scripts)} slurm files "
+        f"({len(scripts) - len(new)} unchanged)"
+    )
+    return generation
+
+
+def sync_job_ids(submit_dir: str) -> sqlite3.Connection:
+    """Record the job IDs of the submitted jobs ledger in the manifest
+
+    :return: the connection to the manifest
+    """
+    conn = connect_manifest(submit_dir)
+    ledger = os.path.join(submit_dir, SUBMITTED_JOBS_LEDGER)
+    if os.path.exists(ledger):
+        with open(ledger) as f:
+            jobs = [line.split() for line in f if line.strip()]
+        with conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO jobs SELECT ?, hash FROM scripts "
+                "WHERE slurm_file = ?",
+                [(job_id, os.path.realpath(fn)) for job_id, fn in jobs],
+            )
+    return conn
+
+
+def load_task_map(submit_dir: str) -> pd.DataFrame:
+    """Map the array tasks of the submitted jobs of the manifest to TOIs
+
+    :return: dataframe with columns ArrayJobID|TaskID|TOI
+    """
+    import pandas as pd
+
+    conn = sync_job_ids(submit_dir)
+    task_map = pd.read_sql_query(
+        "SELECT job_id AS ArrayJobID, task_id AS TaskID, toi AS TOI "
+        "FROM jobs JOIN tasks USING (hash)",
+        conn,
+    )
+    conn.close()
+    return task_map
+
+
+def task_tois(
+    submit_dir: str, job_id: str, task_id: Optional[int] = None
+) -> List[int]:
+    """TOIs of an array task (or of all the tasks of a job if no task_id)"""
+    conn = sync_job_ids(submit_dir)
+    query = "SELECT toi FROM jobs JOIN tasks USING (hash) WHERE job_id = ?"
+    args = [str(job_id)]
+    if task_id is not None:
+        query += " AND task_id = ?"
+        args.append(int(task_id))
+    tois = [toi for (toi,) in conn.execute(query + " ORDER BY toi", args)]
+    conn.close()
+    return tois
@@ -0,0 +1,258 @@
+"""Live progress monitor for the jobs of a submission (tess_monitor)
+
+Each poll makes one batched squeue call for all the submission's jobs.
+sacct is only queried when tasks leave the queue (to get their final
+states, until slurmdbd has recorded them), and the poll interval grows
+while nothing changes, so leaving the monitor running puts very little
+load on slurmctld/slurmdbd.
+Completed TOIs are confirmed from the netcdf files in the outdir (read
+incrementally through the completion index).
+"""
+import argparse
+import glob
+import json
+import os
+import subprocess
+import time
+from datetime import datetime
+from typing import Dict, List
+
+import pandas as pd
+
+from .file_generators import read_array_args
+from .submission import SUBMISSION_RECORD
+from .toi_data_interface import get_completed_toi_numbers
+from .utils import expand_array_task_ids, logger
+
+__all__ = [
+    "SubmissionMonitor",
+    "load_submission_record",
+    "query_job_states",
+]
+
+MIN_INTERVAL = 30.0  # seconds
+MAX_INTERVAL = 600.0
+INTERVAL_GROWTH = 1.5  # interval *= INTERVAL_GROWTH while nothing changes
+SQUEUE_COMMAND = ["squeue", "-h", "-o", "%i|%T", "-j"]
+SACCT_COMMAND = ["sacct", "-X", "-n", "-P", "-o", "JobID,State", "-j"]
+PENDING, RUNNING = "pending", "running"
+COMPLETED, FAILED = "completed", "failed"
+STATUSES = [PENDING, RUNNING, COMPLETED, FAILED]
+QUEUE_STATES = {
+    "PENDING": PENDING,
+    "REQUEUED": PENDING,
+    "RUNNING": RUNNING,
+    "CONFIGURING": RUNNING,
+    "COMPLETING": RUNNING,
+    "COMPLETED": COMPLETED,
+}
+# stages whose TOIs are followed (of submit_jobs, and of the pipelines)
+ANALYSIS_STAGES = ("analysis", "pe")
+
+
+def load_submission_record(submit_dir: str) -> str:
+    """Path to the latest submission record in the submit dir"""
+    pattern = SUBMISSION_RECORD.format(timestamp="*")
+    records = sorted(glob.glob(os.path.join(submit_dir, pattern)))
+    if len(records) == 0:
+        raise FileNotFoundError(f"No submission records in {submit_dir}")
+    return records[-1]
+
+
+def record_jobs(record: Dict) -> List[Dict]:
+    """The jobs of a submission record (of submit_jobs or a Pipeline)"""
+    if "jobs" in record:  # (pipeline record)
+        return record["jobs"]
+    return [
+        dict(batch[stage], stage=stage, batch=batch["batch"])
+        for batch in record["batches"]
+        for stage in ["generation", "cache", "analysis"]
+        if batch.get(stage)
+    ]
+
+
+def query_job_states(cmd: List[str], job_ids: List[str]) -> pd.DataFrame:
+    """Run squeue/sacct for the job_ids -> dataframe of JobID|State
+
+    Pending array ranges ('123_[4-9]') are expanded into one row per task.
+    """
+    result = subprocess.run(
+        cmd + [",".join(job_ids)], capture_output=True, text=True
+    )
+    if result.returncode != 0:
+        # squeue errors if none of the jobs are still in the queue
+        if "Invalid job id" not in result.stderr:
+            logger.warning(f"{cmd[0]} failed: {result.stderr.strip()}")
+        return pd.DataFrame(columns=["JobID", "State"])
+    rows = [
+        (task_id, state.split()[0] if state else "UNKNOWN")
+        for line in result.stdout.splitlines()
+        if line.strip()
+        for job_id, _, state in [line.strip().partition("|")]
+        for task_id in expand_array_task_ids(job_id)
+    ]
+    return pd.DataFrame(rows, columns=["JobID", "State"])
+
+
+class SubmissionMonitor:
+    """Follows the array jobs of a submission record
+
+    :param record: Path to a JSON submission record (see submit_jobs and
+        Pipeline.submit)
+    :param outdir: Outdir of the analyses (to confirm completed TOIs)
+    """
+
+    def __init__(self, record: str, outdir: str):
+        with open(record) as f:
+            record = json.load(f)
+        self.outdir = outdir
+        self.arrays = []  # one entry per submitted (array) job
+        for job in record_jobs(record):
+            tasks = read_array_args(job["slurm_file"])
+            self.arrays.append(
+                dict(
+                    job_id=str(job["job_id"]),
+                    stage=job["stage"],
+                    batch=job["batch"],
+                    n_tasks=max(len(tasks), 1),
+                    tois=[t for task in tasks for t in task],
+                )
+            )
+        self.job_ids = [a["job_id"] for a in self.arrays]
+        self.tois = {
+            toi
+            for a in self.arrays
+            if a["stage"] in ANALYSIS_STAGES
+            for toi in a["tois"]
+        }
+        self.finished = pd.DataFrame(columns=["JobID", "State"])
+        self.queued_ids = None
+        self.start = time.time()
+        self.n_completed_at_start = self.__n_completed_tois()
+
+    def __n_completed_tois(self) -> int:
+        completed = get_completed_toi_numbers(self.outdir)
+        return len(self.tois.intersection(completed))
+
+    def poll(self) -> pd.DataFrame:
+        """Get the number of pending/running/completed/failed tasks per array
+
+        :return: dataframe indexed by array job ID
+        """
+        queued = query_job_states(SQUEUE_COMMAND, self.job_ids)
+        queued_ids = set(queued.JobID)
+        finished = self.finished[~self.finished.JobID.isin(queued_ids)]
+        # (slurmdbd can still report tasks that left the queue as running)
+        unsettled = finished.State.map(QUEUE_STATES).isin([PENDING, RUNNING])
+        if (
+            self.queued_ids is None
+            or self.queued_ids - queued_ids
+            or unsettled.any()
+        ):
+            # some tasks left the queue: get their final states from sacct
+            self.finished = query_job_states(SACCT_COMMAND, self.job_ids)
+        self.queued_ids = queued_ids
+        finished = self.finished[~self.finished.JobID.isin(queued_ids)]
+        tasks = pd.concat([queued, finished], ignore_index=True)
+        tasks["status"] = tasks.State.map(QUEUE_STATES).fillna(FAILED)
+        tasks["ArrayJobID"] = tasks.JobID.str.split("_").str[0]
+
+        counts = pd.crosstab(tasks.ArrayJobID, tasks.status)
+        summary = pd.DataFrame(self.arrays).set_index("job_id")
+        summary = summary[["stage", "batch", "n_tasks"]].join(counts)
+        summary = summary.reindex(
+            columns=["stage", "batch", "n_tasks", *STATUSES]
+        )
+        return summary.fillna(0).astype({s: int for s in STATUSES})
+
+    def progress(self) -> Dict:
+        """TOIs completed (netcdf files), throughput and ETA"""
+        n_completed = self.__n_completed_tois()
+        hrs = (time.time() - self.start) / 3600
+        n_new = n_completed - self.n_completed_at_start
+        rate = n_new / hrs if hrs > 0 else 0.0
+        remaining = len(self.tois) - n_completed
+        return dict(
+            completed=n_completed,
+            total=len(self.tois),
+            tois_per_hr=rate,
+            eta_hrs=remaining / rate if rate > 0 else None,
+        )
+
+    def run(
+        self,
+        min_interval: float = MIN_INTERVAL,
+        max_interval: float = MAX_INTERVAL,
+        once: bool = False,
+    ):
+        """Print the progress until all the arrays are done"""
+        interval, last = min_interval, None
+        while True:
+            summary = self.poll()
+            progress = self.progress()
+            print(format_report(summary, progress), flush=True)
+            done = (summary[[PENDING, RUNNING]].sum().sum() == 0) and (
+                self.queued_ids is not None and len(self.queued_ids) == 0
+            )
+            if once or done:
+                return summary
+            changed = last is None or not summary.equals(last)
+            interval = (
+                min_interval
+                if changed
+                else min(interval * INTERVAL_GROWTH, max_interval)
+            )
+            last = summary
+            time.sleep(interval)
+
+
+def format_report(summary: pd.DataFrame, progress: Dict) -> str:
+    """Table of task counts per array + the TOI progress line"""
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    eta = progress["eta_hrs"]
+    eta = f"{eta:.1f} hrs" if eta is not None else "unknown"
+    return (
+        f"[{now}]\n{summary.to_string()}\n"
+        f"TOIs completed: {progress['completed']}/{progress['total']} | "
+        f"{progress['tois_per_hr']:.1f} TOIs/hr | ETA: {eta}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser("Monitor the progress of submitted jobs")
+    parser.add_argument(
+        "--outdir",
+        default="tess_atlas_catalog",
+        help="outdir of the jobs (the latest submission record is used)",
+    )
+    parser.add_argument(
+        "--record",
+        default=None,
+        help="Submission record to follow (default: latest in outdir/submit)",
+    )
+    parser.add_argument(
+        "--min_interval",
+        type=float,
+        default=MIN_INTERVAL,
+        help="Seconds between polls while the jobs are changing",
+    )
+    parser.add_argument(
+        "--max_interval",
+        type=float,
+        default=MAX_INTERVAL,
+        help="Max seconds between polls (while nothing changes)",
+    )
+    parser.add_argument(
+        "--once", action="store_true", help="Poll once and exit"
+    )
+    args = parser.parse_args()
+    record = args.record or load_submission_record(
+        os.path.join(args.outdir, "submit")
+    )
+    SubmissionMonitor(record, args.outdir).run(
+        args.min_interval, args.max_interval, args.once
+    )
+
+
+if __name__ == "__main__":
+    main()
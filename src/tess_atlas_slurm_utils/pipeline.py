@@ -0,0 +1,303 @@
+"""A small DAG of job stages (e.g. gen -> pe -> post-processing -> catalogue).
+
+Each stage declares its resources, partition and its dependencies on other
+stages (aftercorr/afterok/afterany, plus optionally singleton). Stages run
+per TOI (one array job per batch of TOIs) or once (a single job after all
+the batches). The pipeline orders the stages topologically, writes all the
+slurm files and a submit.sh, and can submit the whole DAG from Python.
+
+Example:
+    stages = standard_stages(outdir) + [
+        Stage("post", "srun post_process $TOI", dict(cpu_per_task=1,
+              time="10:00", mem="500MB"), after={"pe": "aftercorr"}),
+        Stage("catalogue", "srun build_catalogue", dict(cpu_per_task=1,
+              time="60:00", mem="2000MB"), after={"post": "afterany"},
+              per_toi=False, singleton=True),
+    ]
+    setup_jobs(toi_numbers, outdir, module_loads, submit=True, clean=False,
+               stages=stages)
+"""
+import json
+import os
+import subprocess
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from .file_generators import (
+    SUBMITTED_JOBS_LEDGER,
+    SlurmFileRenderer,
+    load_template,
+)
+from .submission import (
+    BACKOFF,
+    MAX_RETRIES,
+    MAX_WORKERS,
+    SUBMISSION_RECORD,
+    queued_jobs,
+    sbatch,
+)
+from .utils import logger, write_if_changed
+
+__all__ = ["Stage", "Pipeline"]
+
+DEPENDENCY_TYPES = ("aftercorr", "afterok", "afterany")
+PIPELINE_SUBMIT_TEMPLATE = "pipeline_submit_template.sh"
+
+
+@dataclass
+class Stage:
+    """A stage of the pipeline
+
+    :param name: Stage (and job) name
+    :param command: Command run by the stage ($TOI is set for per-TOI stages)
+    :param settings: Slurm settings (cpu_per_task, time, mem, [tmp_mem])
+    :param after: {upstream stage name: dependency type}
+    :param partition: Partition of the stage's jobs
+    :param throttle: Max number of the stage's array tasks running at once
+    :param per_toi: Run per TOI (array jobs), or once after all the batches
+    :param singleton: Only one job of the stage can run at a time
+    """
+
+    name: str
+    command: str
+    settings: Dict
+    after: Dict[str, str] = field(default_factory=dict)
+    partition: str = ""
+    throttle: Optional[int] = None
+    per_toi: bool = True
+    singleton: bool = False
+
+    def __post_init__(self):
+        for upstream, dependency in self.after.items():
+            if dependency not in DEPENDENCY_TYPES:
+                raise ValueError(
+                    f"Stage {self.name}: unknown dependency type "
+                    f"'{dependency}' (not in {DEPENDENCY_TYPES})"
+                )
+            if dependency == "aftercorr" and not self.per_toi:
+                raise ValueError(
+                    f"Stage {self.name}: aftercorr needs a per-TOI stage"
+                )
+
+
+class Pipeline:
+    """A DAG of stages
+
+    :param stages: The stages (in any order)
+    """
+
+    def __init__(self, stages: List[Stage]):
+        self.stages = {}
+        for stage in stages:
+            if stage.name in self.stages:
+                raise ValueError(f"Duplicate stage {stage.name}")
+            self.stages[stage.name] = stage
+        for stage in stages:
+            for upstream, dependency in stage.after.items():
+                if upstream not in self.stages:
+                    raise ValueError(
+                        f"Stage {stage.name} depends on unknown stage "
+                        f"{upstream}"
+                    )
+                upstream_per_toi = self.stages[upstream].per_toi
+                if dependency == "aftercorr" and not upstream_per_toi:
+                    raise ValueError(
+                        f"Stage {stage.name}: aftercorr needs a per-TOI "
+                        f"upstream stage ({upstream} isn't)"
+                    )
+
+    def order(self) -> List[Stage]:
+        """The stages in topological order (Kahn's algorithm)"""
+        n_upstream = {name: len(s.after) for name, s in self.stages.items()}
+        downstream = {name: [] for name in self.stages}
+        for name, stage in self.stages.items():
+            for upstream in stage.after:
+                downstream[upstream].append(name)
+        queue = deque(n for n, count in n_upstream.items() if count == 0)
+        order = []
+        while queue:
+            name = queue.popleft()
+            order.append(self.stages[name])
+            for child in downstream[name]:
+                n_upstream[child] -= 1
+                if n_upstream[child] == 0:
+                    queue.append(child)
+        if len(order) != len(self.stages):
+            cycle = [n for n, count in n_upstream.items() if count > 0]
+            raise ValueError(f"The stages have a dependency cycle: {cycle}")
+        return order
+
+    def write(
+        self, renderer: SlurmFileRenderer, toi_batches: List[List[int]]
+    ) -> List[Dict]:
+        """Write the slurm files of all the stages' jobs
+
+        :return: the jobs (in submission order), each a dict with
+            stage|batch|slurm_file|partition|dependencies (list of
+            (dependency type, index of the upstream job)) and singleton
+        """
+        jobs, index = [], {}  # (stage, batch) -> position in jobs
+        for stage in self.order():
+            batches = range(len(toi_batches)) if stage.per_toi else [None]
+            for batch in batches:
+                slurm_file = renderer.write(
+                    **stage.settings,
+                    jobname=stage.name,
+                    jobid=batch,
+                    array_job=stage.per_toi,
+                    array_args=toi_batches[batch] if stage.per_toi else None,
+                    command=stage.command,
+                    throttle=stage.throttle,
+                )
+                dependencies = [
+                    (dependency, index[(upstream, upstream_batch)])
+                    for upstream, dependency in stage.after.items()
+                    for upstream_batch in self.__upstream_batches(
+                        upstream, batch, len(toi_batches)
+                    )
+                ]
+                index[(stage.name, batch)] = len(jobs)
+                jobs.append(
+                    dict(
+                        stage=stage.name,
+                        batch=batch,
+                        slurm_file=slurm_file,
+                        partition=stage.partition,
+                        dependencies=dependencies,
+                        singleton=stage.singleton,
+                    )
+                )
+        return jobs
+
+    def __upstream_batches(self, upstream: str, batch, n_batches: int):
+        if not self.stages[upstream].per_toi:
+            return [None]
+        if batch is None:  # a once-off stage waits for all the batches
+            return range(n_batches)
+        return [batch]
+
+    @staticmethod
+    def make_submitter(jobs: List[Dict], submit_dir: str) -> str:
+        """Write a submit.sh that submits all the jobs (in order)"""
+        job_vars = [f"${{JOB_{i}}}" for i in range(len(jobs))]
+        file_contents = load_template(PIPELINE_SUBMIT_TEMPLATE).render(
+            jobs=[
+                dict(
+                    var=f"JOB_{i}",
+                    slurm_file=job["slurm_file"],
+                    args=" ".join(job_sbatch_args(job, job_vars)),
+                )
+                for i, job in enumerate(jobs)
+            ],
+            ledger=os.path.abspath(
+                os.path.join(submit_dir, SUBMITTED_JOBS_LEDGER)
+            ),
+        )
+        subfn = os.path.join(submit_dir, "submit.sh")
+        write_if_changed(subfn, file_contents)
+        return os.path.abspath(subfn)
+
+    @staticmethod
+    def submit(
+        jobs: List[Dict],
+        submit_dir: str,
+        max_workers: int = MAX_WORKERS,
+        retries: int = MAX_RETRIES,
+        backoff: float = BACKOFF,
+    ) -> str:
+        """Submit the jobs: the jobs of a stage are submitted concurrently,
+        once all their upstream jobs have IDs (jobs still queued from a
+        previous submission are reused, see queued_jobs)
+
+        If an sbatch fails, the later stages aren't submitted, and the jobs
+        already submitted are recorded before raising a RuntimeError.
+
+        :return: Path to the JSON record of the submitted jobs
+        """
+        submitted = datetime.now()
+        queued = queued_jobs(submit_dir)
+        job_ids = [None] * len(jobs)
+        stages = []
+        for i, job in enumerate(jobs):
+            if not stages or stages[-1][0] != job["stage"]:
+                stages.append((job["stage"], []))
+            stages[-1][1].append(i)
+        errors = []
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for _, stage_jobs in stages:
+                if errors:  # (their upstream jobs are missing)
+                    break
+                futures = [
+                    executor.submit(
+                        sbatch,
+                        jobs[i]["slurm_file"],
+                        job_sbatch_args(jobs[i], job_ids),
+                        retries,
+                        backoff,
+                        queued,
+                    )
+                    for i in stage_jobs
+                ]
+                for i, future in zip(stage_jobs, futures):
+                    try:
+                        job_ids[i] = future.result()
+                    except subprocess.CalledProcessError as e:
+                        error = (e.stderr or "").strip() or str(e)
+                        errors.append(f"{jobs[i]['slurm_file']}: {error}")
+
+        submitted_jobs = [
+            (job, job_id) for job, job_id in zip(jobs, job_ids) if job_id
+        ]
+        record = dict(
+            submitted=submitted.isoformat(),
+            jobs=[
+                dict(
+                    stage=job["stage"],
+                    batch=job["batch"],
+                    slurm_file=job["slurm_file"],
+                    job_id=job_id,
+                    dependency=job_dependency(job, job_ids),
+                )
+                for job, job_id in submitted_jobs
+            ],
+            errors=errors,
+        )
+        timestamp = submitted.strftime("%Y%m%d_%H%M%S")
+        fname = os.path.join(
+            submit_dir, SUBMISSION_RECORD.format(timestamp=timestamp)
+        )
+        with open(fname, "w") as f:
+            json.dump(record, f, indent=2)
+        with open(os.path.join(submit_dir, SUBMITTED_JOBS_LEDGER), "a") as f:
+            f.writelines(
+                f"{job_id} {job['slurm_file']}\n"
+                for job, job_id in submitted_jobs
+            )
+        logger.info(f"Submission record saved in {os.path.abspath(fname)}")
+        if errors:
+            raise RuntimeError(
+                f"Failed to submit {len(errors)} jobs: " + "; ".join(errors)
+            )
+        return os.path.abspath(fname)
+
+
+def job_dependency(job: Dict, job_ids: List[str]) -> Optional[str]:
+    """slurm --dependency of a job, e.g. 'aftercorr:12,afterok:13,singleton'"""
+    grouped: Dict[str, List[str]] = {}
+    for dependency, upstream in job["dependencies"]:
+        grouped.setdefault(dependency, []).append(job_ids[upstream])
+    dependencies = [f"{d}:{':'.join(ids)}" for d, ids in grouped.items()]
+    if job["singleton"]:
+        dependencies.append("singleton")
+    return ",".join(dependencies) or None
+
+
+def job_sbatch_args(job: Dict, job_ids: List[str]) -> List[str]:
+    args = [f"--partition={job['partition']}"] if job["partition"] else []
+    dependency = job_dependency(job, job_ids)
+    if dependency:
+        args.append(f"--dependency={dependency}")
+    return args
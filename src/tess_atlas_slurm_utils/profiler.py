@@ -0,0 +1,190 @@
+"""Profiles the analysis of a TOI (run inside the slurm jobs).
+
+Slurm files made with profile=True run each TOI's command through this
+module, e.g.
+    srun python -m tess_atlas_slurm_utils.profiler --toi $TOI \
+        --jobname pe --log {outdir}/profiling.jsonl -- run_toi $TOI ...
+
+which records the TOI's wall time, peak RSS, $JOBFS usage and the Theano
+compile-cache growth/compile time, and appends them as one JSON line to the
+(shared) profiling log. See jobstats_collector.merge_profiling_log to join
+the log with the sacct data.
+"""
+import argparse
+import fcntl
+import json
+import os
+import resource
+import socket
+import subprocess
+import sys
+import time
+from typing import Dict, List
+
+from .utils import dir_size
+
+PROFILE_LOG = "profiling.jsonl"
+SAMPLE_INTERVAL = 5.0  # seconds between RSS/$JOBFS samples
+PROFILER = "python -m tess_atlas_slurm_utils.profiler"
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+
+def profile_command(command: str, jobname: str, log: str) -> str:
+    """Wrap a TOI's command with the profiler
+
+    A leading 'srun [--options]' is kept in front of the profiler, so that
+    the profiler runs inside the job step (and sees the TOI's processes).
+    """
+    tokens = command.split(" ")
+    n_launcher = 0
+    if tokens[0] == "srun":
+        n_launcher = 1
+        while tokens[n_launcher].startswith("-"):
+            n_launcher += 1
+    launcher = " ".join(tokens[:n_launcher] + [""]) if n_launcher else ""
+    cmd = " ".join(tokens[n_launcher:])
+    return (
+        f"{launcher}{PROFILER} --toi $TOI --jobname {jobname} "
+        f"--log {log} -- {cmd}"
+    )
+
+
+def __tree_rss(pid: int) -> int:
+    """RSS (bytes) of a process and all its descendants (from /proc)"""
+    children, rss = {}, {}
+    for p in os.listdir("/proc"):
+        if not p.isdigit():
+            continue
+        try:
+            with open(f"/proc/{p}/stat") as f:
+                stat = f.read().rpartition(")")[2].split()
+        except OSError:  # process ended
+            continue
+        children.setdefault(int(stat[1]), []).append(int(p))
+        rss[int(p)] = int(stat[21]) * PAGE_SIZE
+    total, todo = 0, [pid]
+    while todo:
+        p = todo.pop()
+        total += rss.get(p, 0)
+        todo.extend(children.get(p, []))
+    return total
+
+
+def __theano_compiledir() -> str:
+    flags = os.environ.get("THEANO_FLAGS", "").split(",")
+    dirs = [f.split("=", 1)[1] for f in flags if f.startswith("compiledir=")]
+    return dirs[0] if dirs else ""
+
+
+def __compiled_modules(compiledir: str) -> Dict[str, float]:
+    """Compile time (.so mtime - source mtime) of each module in the cache"""
+    modules = {}
+    for root, _, files in os.walk(compiledir):
+        so = [f for f in files if f.endswith(".so")]
+        src = [f for f in files if f.startswith("mod.c")]
+        if so and src:
+            so_mtime = os.path.getmtime(os.path.join(root, so[0]))
+            src_mtime = os.path.getmtime(os.path.join(root, src[0]))
+            modules[root] = max(so_mtime - src_mtime, 0.0)
+    return modules
+
+
+def __task_id() -> str:
+    if "SLURM_ARRAY_JOB_ID" in os.environ:
+        return (
+            f"{os.environ['SLURM_ARRAY_JOB_ID']}_"
+            f"{os.environ['SLURM_ARRAY_TASK_ID']}"
+        )
+    return os.environ.get("SLURM_JOB_ID", "")
+
+
+def append_to_log(log: str, record: Dict):
+    """Append a JSON line to the log (locked, as many tasks share the log)"""
+    line = json.dumps(record) + "\n"
+    with open(log, "a") as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        except OSError:  # no flock on some network filesystems
+            pass
+        f.write(line)
+
+
+def profile(
+    cmd: List[str],
+    toi: int,
+    jobname: str,
+    log: str,
+    interval: float = SAMPLE_INTERVAL,
+) -> int:
+    """Run the command, append its resource usage to the log
+
+    :return: The command's exit code
+    """
+    jobfs = os.environ.get("JOBFS", "")
+    compiledir = __theano_compiledir()
+    modules_before = __compiled_modules(compiledir) if compiledir else {}
+    start = time.time()
+    proc = subprocess.Popen(cmd)
+    peak_rss, peak_jobfs = 0, 0
+    while True:
+        peak_rss = max(peak_rss, __tree_rss(proc.pid))
+        peak_jobfs = max(peak_jobfs, dir_size(jobfs) if jobfs else 0)
+        try:
+            proc.wait(timeout=interval)
+            break
+        except subprocess.TimeoutExpired:
+            pass
+    wall_time = time.time() - start
+    # ru_maxrss (kB) is the peak of the largest waited-for process
+    rusage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    peak_rss = max(peak_rss, rusage.ru_maxrss * 1024)
+    modules = __compiled_modules(compiledir) if compiledir else {}
+    new_modules = [m for m in modules if m not in modules_before]
+    exit_code = proc.returncode
+    if exit_code < 0:  # killed by a signal
+        exit_code = 128 - exit_code
+
+    append_to_log(
+        log,
+        dict(
+            JobID=__task_id(),
+            TOI=toi,
+            JobName=f"toi_{jobname}",
+            Host=socket.gethostname(),
+            Start=time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(start)),
+            WallTime=round(wall_time, 1),
+            ExitCode=exit_code,
+            PeakRSS=peak_rss,
+            JobFSPeak=peak_jobfs,
+            JobFSEnd=dir_size(jobfs) if jobfs else 0,
+            TheanoCacheSize=dir_size(compiledir) if compiledir else 0,
+            TheanoModules=len(new_modules),
+            TheanoCompileTime=round(sum(modules[m] for m in new_modules), 1),
+        ),
+    )
+    return exit_code
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        "Run a TOI's command and log its resource usage"
+    )
+    parser.add_argument("--toi", type=int, required=True, help="TOI number")
+    parser.add_argument("--jobname", default="", help="Name of the job")
+    parser.add_argument(
+        "--log", default=PROFILE_LOG, help="JSON-lines log to append to"
+    )
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=SAMPLE_INTERVAL,
+        help="Seconds between RSS/$JOBFS samples",
+    )
+    parser.add_argument("cmd", nargs=argparse.REMAINDER, help="-- command")
+    args = parser.parse_args()
+    cmd = args.cmd[1:] if args.cmd[:1] == ["--"] else args.cmd
+    sys.exit(profile(cmd, args.toi, args.jobname, args.log, args.interval))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""This module predicts the cost of analysing each TOI from the jobstats of
+previous runs, and bins the TOIs into resource classes (time/mem requests)."""
+from typing import Dict, List, Tuple
+
+import numpy as np
+import pandas as pd
+
+from .jobstats_collector import load_slurm_stats
+from .utils import logger, mem_to_mb, slurm_time_to_minutes
+
+__all__ = ["predict_toi_costs", "assign_resource_classes"]
+
+TIME_CLASSES = ["60:00", "150:00", "300:00", "600:00"]
+MEM_CLASSES = ["1000MB", "1500MB", "2500MB", "4000MB"]
+HEADROOM = 1.3  # requested = HEADROOM * predicted
+ANALYSIS_JOBNAME = "toi_pe"
+
+
+def predict_toi_costs(jobstats: str, cpu_per_task: int) -> pd.DataFrame:
+    """Predict the runtime and peak mem of each TOI's analysis
+
+    The prediction is the max over the TOI's previous analysis runs (in a
+    jobstats CSV made by create_slurm_stats_file with a submit_dir). Runs
+    that hit TIMEOUT/OUT_OF_MEMORY predict an infinite cost (so the TOI is
+    put in the largest class).
+
+    :param jobstats: jobstats CSV (with a TOI column)
+    :param cpu_per_task: CPUs of the analysis jobs (to get walltime from CPUTimeRAW)
+    :return: dataframe indexed by TOI with columns minutes|mem_mb (NaN if unknown)
+    """
+    stats = load_slurm_stats(jobstats)
+    stats = stats[(stats.JobName == ANALYSIS_JOBNAME) & stats.TOI.notna()]
+    state = stats.State.astype(str)
+    minutes = (stats.CPUTimeRAW / cpu_per_task / 60).where(
+        state == "COMPLETED"
+    )
+    minutes = minutes.mask(state == "TIMEOUT", np.inf)
+    mem_mb = (stats.MaxRSS / 1024**2).mask(state == "OUT_OF_MEMORY", np.inf)
+    if (state == "COMPLETED").any() and mem_mb.isna().all():
+        logger.warning(
+            f"No MaxRSS (reported by the job steps) in {jobstats}: the TOIs "
+            "get the default mem"
+        )
+    costs = pd.DataFrame(
+        dict(TOI=stats.TOI.astype(int), minutes=minutes, mem_mb=mem_mb)
+    )
+    return costs.groupby("TOI").max()
+
+
+def __bin(values: pd.Series, classes: List[str], to_num) -> np.ndarray:
+    """Smallest class that fits HEADROOM * value (largest if none fit)"""
+    limits = np.array([to_num(c) for c in classes])
+    idx = np.searchsorted(limits, values.to_numpy(float) * HEADROOM)
+    return np.array(classes)[np.minimum(idx, len(classes) - 1)]
+
+
+def assign_resource_classes(
+    toi_numbers: List[int], costs: pd.DataFrame, default: Dict
+) -> List[Tuple[Dict, List[int]]]:
+    """Bin the TOIs by their predicted cost into (time, mem) classes
+
+    TOIs without a history get the default time/mem.
+
+    :param toi_numbers: TOIs to bin
+    :param costs: Output of predict_toi_costs
+    :param default: Default settings (with 'time' and 'mem')
+    :return: List of (dict(time=..., mem=...), TOIs) per resource class
+    """
+    costs = costs.reindex(pd.Index(toi_numbers, name="TOI"))
+    classes = pd.DataFrame(
+        dict(
+            time=np.where(
+                costs.minutes.isna(),
+                default["time"],
+                __bin(costs.minutes, TIME_CLASSES, slurm_time_to_minutes),
+            ),
+            mem=np.where(
+                costs.mem_mb.isna(),
+                default["mem"],
+                __bin(costs.mem_mb, MEM_CLASSES, mem_to_mb),
+            ),
+        ),
+        index=costs.index,
+    )
+    groups = []
+    for (time, mem), tois in classes.groupby(["time", "mem"]).groups.items():
+        tois = sorted(int(t) for t in tois)
+        groups.append((dict(time=time, mem=mem), tois))
+        logger.info(f"Resource class time={time}, mem={mem}: {len(tois)} TOIs")
+    return groups
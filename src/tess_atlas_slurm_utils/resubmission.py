@@ -0,0 +1,236 @@
+"""This module works out which TOIs need to be re-run (and with what
+resources) by joining the sacct job states with the completed TOI results.
+
+TOIs whose last analysis job hit TIMEOUT (or OUT_OF_MEMORY) are re-run with
+an escalated time (or mem) request, until they reach MAX_RETRIES attempts.
+TOIs that are completed, or still pending/running, are never resubmitted.
+"""
+import argparse
+import math
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from .jobstats_collector import OPEN_STATES, load_slurm_stats
+from .slurm_job_generator import ANALYSIS_JOB_SETTINGS, setup_jobs
+from .toi_data_interface import get_completed_toi_numbers, parse_toi_numbers
+from .utils import (
+    logger,
+    mem_to_mb,
+    minutes_to_slurm_time,
+    slurm_time_to_minutes,
+)
+
+__all__ = ["classify_tois", "get_resubmission_groups", "resubmit"]
+
+COMPLETED = "completed"
+RUNNING = "running"
+TIMEOUT = "timeout"
+OOM = "oom"
+FAILED = "failed"
+NEW = "new"  # never run
+RERUN_STATUSES = [TIMEOUT, OOM, FAILED, NEW]
+
+MAX_RETRIES = 3
+TIME_ESCALATION = 1.5  # time *= TIME_ESCALATION for each previous TIMEOUT
+MEM_ESCALATION = 1.5  # mem *= MEM_ESCALATION for each previous OOM
+MAX_TIME = "2880:00"
+MAX_MEM = "8000MB"
+ANALYSIS_JOBNAME = "toi_pe"
+
+
+def classify_tois(
+    toi_numbers: List[int], outdir: str, jobstats: str, rescan: bool = False
+) -> pd.DataFrame:
+    """Classify each TOI as completed, running, timeout, oom, failed or new
+
+    :param toi_numbers: TOIs to classify
+    :param outdir: Outdir of the analyses (searched for netcdf results)
+    :param jobstats: jobstats CSV with TOIs (tess_jobstats --submit_dir)
+    :param rescan: Rebuild the outdir's completion index from scratch
+    :return: dataframe indexed by TOI with columns
+        status|last_state|attempts|n_timeout|n_oom
+    """
+    stats = load_slurm_stats(jobstats)
+    stats = stats[(stats.JobName == ANALYSIS_JOBNAME) & stats.TOI.notna()]
+    state = stats.State.astype(str).str.split().str[0]  # 'CANCELLED by 1'
+    stats = pd.DataFrame(
+        dict(
+            TOI=stats.TOI.astype(int),
+            Submit=stats.Submit,
+            last_state=state,
+            attempts=1,
+            n_timeout=(state == "TIMEOUT").astype(int),
+            n_oom=(state == "OUT_OF_MEMORY").astype(int),
+        )
+    ).sort_values("Submit", kind="stable")
+    history = stats.groupby("TOI").agg(
+        dict(last_state="last", attempts="sum", n_timeout="sum", n_oom="sum")
+    )
+    history = history.reindex(pd.Index(toi_numbers, name="TOI"))
+    history[["attempts", "n_timeout", "n_oom"]] = (
+        history[["attempts", "n_timeout", "n_oom"]].fillna(0).astype(int)
+    )
+
+    completed = get_completed_toi_numbers(outdir, rescan)
+    completed = history.index.isin(list(completed))
+    last_state = history.last_state
+    history["status"] = np.select(
+        [
+            completed,
+            last_state.isin(OPEN_STATES),
+            last_state == "TIMEOUT",
+            last_state == "OUT_OF_MEMORY",
+            last_state.isna(),
+        ],
+        [COMPLETED, RUNNING, TIMEOUT, OOM, NEW],
+        default=FAILED,
+    )
+    counts = history.status.value_counts().to_dict()
+    logger.info(f"TOI statuses: {counts}")
+    return history
+
+
+def get_resubmission_groups(
+    classes: pd.DataFrame,
+    settings: Optional[Dict] = None,
+    max_retries: int = MAX_RETRIES,
+) -> List[Tuple[Dict, List[int]]]:
+    """Group the TOIs that need re-running by their (escalated) time/mem
+
+    :param classes: Output of classify_tois
+    :param settings: Base analysis settings (default: ANALYSIS_JOB_SETTINGS)
+    :param max_retries: TOIs with this many attempts are not re-run
+    :return: List of (dict(time=..., mem=...), TOIs)
+    """
+    settings = settings or ANALYSIS_JOB_SETTINGS
+    rerun = classes[classes.status.isin(RERUN_STATUSES)]
+    exhausted = rerun[rerun.attempts >= max_retries]
+    if len(exhausted):
+        logger.warning(
+            f"Not re-running {len(exhausted)} TOIs that already had "
+            f"{max_retries} attempts: {list(exhausted.index)}"
+        )
+    rerun = rerun[rerun.attempts < max_retries]
+
+    time = np.minimum(
+        slurm_time_to_minutes(settings["time"])
+        * TIME_ESCALATION**rerun.n_timeout,
+        slurm_time_to_minutes(MAX_TIME),
+    )
+    mem = np.minimum(
+        mem_to_mb(settings["mem"]) * MEM_ESCALATION**rerun.n_oom,
+        mem_to_mb(MAX_MEM),
+    )
+    resources = pd.DataFrame(
+        dict(
+            time=[minutes_to_slurm_time(t) for t in time],
+            mem=[f"{math.ceil(m)}MB" for m in mem],
+        ),
+        index=rerun.index,
+    )
+    groups = []
+    for (time, mem), tois in resources.groupby(["time", "mem"]).groups.items():
+        tois = sorted(int(t) for t in tois)
+        groups.append((dict(time=time, mem=mem), tois))
+        logger.info(f"Re-running {len(tois)} TOIs (time={time}, mem={mem})")
+    return groups
+
+
+def resubmit(
+    outdir: str,
+    jobstats: str,
+    module_loads: str,
+    toi_numbers: Optional[List[int]] = None,
+    max_retries: int = MAX_RETRIES,
+    submit: bool = False,
+    email: str = "",
+    partition: str = "",
+    rescan: bool = False,
+) -> pd.DataFrame:
+    """Make (and optionally submit) jobs for the TOIs that need re-running
+
+    :param toi_numbers: TOIs to consider (default: all TOIs in the jobstats)
+    :return: Output of classify_tois
+    """
+    if toi_numbers is None:
+        toi_numbers = sorted(
+            int(t) for t in load_slurm_stats(jobstats).TOI.dropna().unique()
+        )
+    classes = classify_tois(toi_numbers, outdir, jobstats, rescan)
+    groups = get_resubmission_groups(classes, max_retries=max_retries)
+    setup_jobs(
+        toi_numbers=[toi for _, tois in groups for toi in tois],
+        outdir=outdir,
+        module_loads=module_loads,
+        submit=submit,
+        clean=True,  # completed TOIs are already filtered out
+        email=email,
+        partition=partition,
+        resource_groups=groups,
+    )
+    return classes
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        "Resubmit the TOIs whose analyses timed out, ran out of mem or failed"
+    )
+    parser.add_argument(
+        "--outdir",
+        default="tess_atlas_catalog",
+        help="outdir of the analyses (also where the new jobs are made)",
+    )
+    parser.add_argument(
+        "--jobstats",
+        required=True,
+        help="jobstats CSV with TOIs (from tess_jobstats --submit_dir)",
+    )
+    parser.add_argument(
+        "--toi_csv",
+        default=None,
+        help="CSV with the toi numbers to consider (default: all in jobstats)",
+    )
+    parser.add_argument(
+        "--module_loads",
+        default="git/2.18.0 gcc/9.2.0 openmpi/4.0.2 python/3.8.5",
+        help="String containing all module loads in one line",
+    )
+    parser.add_argument(
+        "--max_retries",
+        type=int,
+        default=MAX_RETRIES,
+        help="TOIs with this many analysis attempts are not re-run",
+    )
+    parser.add_argument(
+        "--submit", action="store_true", help="Submit once files created"
+    )
+    parser.add_argument(
+        "--email", default="", help="email address to send job updates to"
+    )
+    parser.add_argument(
+        "--partition", default="", help="partition for the analysis jobs"
+    )
+    parser.add_argument(
+        "--rescan",
+        action="store_true",
+        help="Rebuild the index of completed TOIs in the outdir from scratch",
+    )
+    args = parser.parse_args()
+    toi_numbers = parse_toi_numbers(args.toi_csv) if args.toi_csv else None
+    resubmit(
+        outdir=args.outdir,
+        jobstats=args.jobstats,
+        module_loads=args.module_loads,
+        toi_numbers=toi_numbers,
+        max_retries=args.max_retries,
+        submit=args.submit,
+        email=args.email,
+        partition=args.partition,
+        rescan=args.rescan,
+    )
+
+
+if __name__ == "__main__":
+    main()
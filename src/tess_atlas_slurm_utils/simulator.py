@@ -0,0 +1,512 @@
+"""Offline simulator of catalogue runs (for what-if planning)
+
+The jobs that setup_jobs would make (see plan_jobs) are run on a simulated
+cluster, with the runtimes (CPU-seconds), peak mem and failures of each TOI
+drawn from the jobstats of previous runs: a TOI's last run if it has one,
+else a random previous job of the same stage. Each config (cluster size,
+array size, cpu/mem/time requests, throttles, queue wait) gets its
+makespan, core-hours and expected number of failed TOIs.
+
+The model:
+- every job waits in the queue for an exponential time (with the config's
+  mean queue wait) before its tasks are eligible
+- generation tasks run on the datamover partition (datamover_slots at
+  once), and analysis tasks on the nodes, each node fitting as many tasks
+  as its cores/mem allow (a whole node per task for the 'node' layout)
+- an analysis task starts after its generation task (aftercorr), or after
+  its whole generation array for the 'node' layout, and never runs if that
+  generation task failed
+- eligible tasks start first-come-first-served (no backfill), and each
+  array runs at most its throttle of tasks at once
+- a task's TOIs run one after the other (or max_parallel at once), and the
+  TOIs still running at the time limit time out. TOIs whose peak mem is
+  over the request run out of mem, and TOIs that failed before fail again.
+- CPU-seconds are conserved: a TOI's walltime is its previous CPU-seconds
+  over its CPUs (the walltime of previous TIMEOUTs is only a lower bound)
+
+The TOI draws and the queue waits are shared by all the configs (common
+random numbers), and each stage is simulated with vectorised per-TOI maths
+and a single heap pass over its tasks, so sweeps of hundreds of configs
+over the whole catalogue take seconds.
+"""
+import argparse
+import heapq
+import itertools
+from dataclasses import asdict, dataclass, fields
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+from .job_settings import (
+    ANALYSIS,
+    ANALYSIS_JOB_SETTINGS,
+    GENERATION,
+    GENERATION_JOB_SETTINGS,
+    job_name,
+)
+from .jobstats_collector import load_slurm_stats
+from .slurm_job_generator import ARRAY_LAYOUT, NODE_LAYOUT, plan_jobs
+from .toi_data_interface import parse_toi_numbers
+from .utils import logger, mem_to_mb, slurm_time_to_minutes
+
+__all__ = [
+    "SimConfig",
+    "config_grid",
+    "load_runtime_history",
+    "simulate",
+]
+
+HISTORY_STATES = ["COMPLETED", "FAILED", "TIMEOUT", "OUT_OF_MEMORY"]
+# peak mem of a previous OUT_OF_MEMORY job ~ OOM_FACTOR * its request
+OOM_FACTOR = 1.01
+SEC_IN_HR = 3600.0
+
+
+@dataclass(frozen=True)
+class SimConfig:
+    """A cluster and job settings to simulate
+
+    :param max_array_size: Max number of tasks per array job
+    :param cpu_per_task: CPUs of the analysis tasks (None: the default)
+    :param mem: Mem of the analysis tasks (None: the default)
+    :param time: Time limit of the analysis tasks (None: the default)
+    :param bundle_size: Number of TOIs run by each array task
+    :param layout: 'array' or 'node' (see setup_jobs)
+    :param generation_throttle: Max running tasks per generation array
+    :param analysis_throttle: Max running tasks per analysis array
+    :param nodes: Number of nodes available for the analysis jobs
+    :param cores_per_node: Cores per node
+    :param mem_per_node: Usable mem per node
+    :param datamover_slots: Max running generation tasks
+    :param queue_wait: Mean time (minutes) a job waits in the queue
+    """
+
+    max_array_size: int = 2048
+    cpu_per_task: Optional[int] = None
+    mem: Optional[str] = None
+    time: Optional[str] = None
+    bundle_size: int = 1
+    layout: str = ARRAY_LAYOUT
+    generation_throttle: Optional[int] = None
+    analysis_throttle: Optional[int] = None
+    nodes: int = 50
+    cores_per_node: int = 32
+    mem_per_node: str = "180GB"
+    datamover_slots: int = 8
+    queue_wait: float = 10.0
+
+
+def config_grid(**options: Sequence) -> List[SimConfig]:
+    """All the combinations of the options (lists of SimConfig values)"""
+    names = list(options)
+    return [
+        SimConfig(**dict(zip(names, values)))
+        for values in itertools.product(*options.values())
+    ]
+
+
+def load_runtime_history(jobstats: str) -> pd.DataFrame:
+    """The CPU-seconds, peak mem and outcome of the previous generation and
+    analysis jobs (oldest first)
+
+    :param jobstats: jobstats CSV (from tess_jobstats, ideally with TOIs)
+    :return: dataframe with columns stage|TOI|cpu_seconds|mem_mb|state
+    """
+    stats = load_slurm_stats(jobstats)
+    stages = {
+        job_name(GENERATION_JOB_SETTINGS): GENERATION,
+        job_name(ANALYSIS_JOB_SETTINGS): ANALYSIS,
+    }
+    state = stats.State.astype(str).str.split().str[0]  # 'CANCELLED by 1'
+    keep = stats.JobName.isin(list(stages)) & state.isin(HISTORY_STATES)
+    stats, state = stats[keep], state[keep]
+    mem_mb = stats.MaxRSS / 1024**2
+    oom_mem_mb = np.fmax(stats.MaxRSS, stats.ReqMem) / 1024**2 * OOM_FACTOR
+    if (state == "COMPLETED").any() and mem_mb.isna().all():
+        logger.warning(
+            f"No MaxRSS (reported by the job steps) in {jobstats}: only the "
+            "jobs that ran out of memory are simulated as OOM"
+        )
+    history = pd.DataFrame(
+        dict(
+            stage=stats.JobName.map(stages).astype(str),
+            TOI=stats.TOI,
+            cpu_seconds=stats.CPUTimeRAW.fillna(0).to_numpy(),
+            mem_mb=mem_mb.where(state != "OUT_OF_MEMORY", oom_mem_mb)
+            .fillna(0)
+            .to_numpy(),
+            state=state,
+            Submit=stats.Submit,
+        )
+    )
+    return history.sort_values("Submit", kind="stable").drop(
+        columns="Submit"
+    )
+
+
+def sample_tois(
+    history: pd.DataFrame,
+    stage: str,
+    toi_numbers: Sequence[int],
+    rng: np.random.Generator,
+) -> pd.DataFrame:
+    """Draw the cost of each TOI's stage: its last run if it has one, else
+    a random previous job of the stage
+
+    :return: dataframe (in the order of toi_numbers) with columns
+        cpu_seconds|mem_mb|failed
+    """
+    stage_history = history[history.stage == stage]
+    if len(stage_history) == 0:
+        raise ValueError(f"No previous {stage} jobs in the jobstats")
+    last_runs = (
+        stage_history.dropna(subset=["TOI"])
+        .groupby("TOI")
+        .last()
+        .reindex(pd.Index(toi_numbers, dtype="Int64"))
+    )
+    unknown = last_runs.cpu_seconds.isna().to_numpy()
+    draws = stage_history.iloc[
+        rng.integers(0, len(stage_history), int(unknown.sum()))
+    ]
+    samples = pd.DataFrame(
+        dict(
+            cpu_seconds=last_runs.cpu_seconds.to_numpy(float),
+            mem_mb=last_runs.mem_mb.to_numpy(float),
+            failed=(last_runs.state == "FAILED").to_numpy(bool),
+        )
+    )
+    samples.loc[unknown, "cpu_seconds"] = draws.cpu_seconds.to_numpy(float)
+    samples.loc[unknown, "mem_mb"] = draws.mem_mb.to_numpy(float)
+    samples.loc[unknown, "failed"] = (draws.state == "FAILED").to_numpy()
+    return samples
+
+
+def simulate(
+    toi_numbers: Sequence[int],
+    history: pd.DataFrame,
+    configs: Sequence[SimConfig],
+    seed: int = 0,
+) -> pd.DataFrame:
+    """Simulate the run of the TOIs for each config
+
+    :param toi_numbers: TOIs to run (e.g. from parse_toi_numbers)
+    :param history: Output of load_runtime_history
+    :param configs: Configs to simulate (e.g. from config_grid)
+    :param seed: Seed of the TOI draws and queue waits
+    :return: dataframe with the config and the results of each simulation:
+        makespan_hrs|core_hrs|wait_hrs (mean queue wait of the tasks) and
+        the number of completed|timeout|oom|failed|blocked (never run, as
+        their generation failed) TOIs
+    """
+    toi_numbers = np.asarray(toi_numbers, dtype=int)
+    rng = np.random.default_rng(seed)
+    samples = {
+        stage: sample_tois(history, stage, toi_numbers, rng)
+        for stage in [GENERATION, ANALYSIS]
+    }
+    n_jobs = 2 * len(toi_numbers) + 2  # (max number of jobs of a config)
+    waits = rng.exponential(1.0, n_jobs)  # (scaled by each queue_wait)
+    results = []
+    for config in configs:
+        result = simulate_config(toi_numbers, samples, config, waits)
+        results.append(dict(asdict(config), **result))
+    return pd.DataFrame(results)
+
+
+def simulate_config(
+    toi_numbers: np.ndarray,
+    samples: Dict[str, pd.DataFrame],
+    config: SimConfig,
+    waits: np.ndarray,
+) -> Dict:
+    """Simulate the run of the TOIs with one config (see simulate)
+
+    :param samples: Costs of each stage's TOIs (see sample_tois)
+    :param waits: Queue wait of each job (in units of the mean wait)
+    """
+    overrides = {
+        k: getattr(config, k)
+        for k in ["cpu_per_task", "mem", "time"]
+        if getattr(config, k) is not None
+    }
+    generation_jobs, analysis_jobs = plan_jobs(
+        toi_numbers.tolist(),
+        outdir=".",
+        bundle_size=config.bundle_size,
+        resource_groups=[(overrides, toi_numbers.tolist())],
+        layout=config.layout,
+        node_cores=config.cores_per_node,
+        node_mem=config.mem_per_node,
+        generation_throttle=config.generation_throttle,
+        analysis_throttle=config.analysis_throttle,
+        max_array_size=config.max_array_size,
+    )
+    positions = pd.Index(toi_numbers)
+    n_tois, n_gen = len(toi_numbers), len(generation_jobs)
+    waits = waits * config.queue_wait * 60
+
+    gen = __stage_tasks(
+        generation_jobs, samples[GENERATION], positions, config
+    )
+    gen_start, gen_end = __schedule(
+        waits[:n_gen][gen["job"]],
+        gen["duration"],
+        gen["job"],
+        gen["throttles"],
+        config.datamover_slots,
+    )
+
+    # analysis tasks wait for (and need) the generation of their TOIs
+    pe = __stage_tasks(analysis_jobs, samples[ANALYSIS], positions, config)
+    toi_gen_end = np.zeros(n_tois)
+    toi_gen_end[gen["toi"]] = gen_end[gen["toi_task"]]
+    toi_gen_ok = np.ones(n_tois, dtype=bool)
+    toi_gen_ok[gen["toi"]] = gen["ok"][gen["toi_task"]]
+    n_pe_tasks = len(pe["duration"])
+    if config.layout == NODE_LAYOUT:  # (afterany on the generation array)
+        gen_job_end = np.zeros(n_gen)
+        np.maximum.at(gen_job_end, gen["job"], gen_end)
+        dependency_end = gen_job_end[pe["job"]]
+        skip = np.zeros(n_pe_tasks, dtype=bool)
+        blocked = ~toi_gen_ok[pe["toi"]]
+    else:  # (aftercorr, never run if the generation task failed)
+        dependency_end = np.zeros(n_pe_tasks)
+        np.maximum.at(dependency_end, pe["toi_task"], toi_gen_end[pe["toi"]])
+        skip = np.zeros(n_pe_tasks, dtype=bool)
+        np.logical_or.at(skip, pe["toi_task"], ~toi_gen_ok[pe["toi"]])
+        blocked = skip[pe["toi_task"]]
+    pe_ready = np.maximum(waits[n_gen:][pe["job"]], dependency_end)
+    pe_start, pe_end = __schedule(
+        pe_ready,
+        pe["duration"],
+        pe["job"],
+        pe["throttles"],
+        __analysis_slots(analysis_jobs, config),
+        skip,
+    )
+
+    ran = ~skip
+    timeout = pe["timeout"] & ~blocked
+    oom = pe["oom"] & ~blocked
+    failed = pe["failed"] & ~blocked
+    waited = np.concatenate(
+        [gen_start - waits[:n_gen][gen["job"]], (pe_start - pe_ready)[ran]]
+    )
+    return dict(
+        makespan_hrs=np.concatenate([gen_end, pe_end[ran]]).max(initial=0)
+        / SEC_IN_HR,
+        core_hrs=(
+            (gen["duration"] * gen["cores"]).sum()
+            + (pe["duration"] * pe["cores"])[ran].sum()
+        )
+        / SEC_IN_HR,
+        wait_hrs=waited.mean() / SEC_IN_HR if len(waited) else 0.0,
+        completed=int((~(blocked | timeout | oom | failed)).sum()),
+        timeout=int(timeout.sum()),
+        oom=int(oom.sum()),
+        failed=int(failed.sum()),
+        blocked=int(blocked.sum()),
+    )
+
+
+def __stage_tasks(
+    jobs: List[Dict],
+    samples: pd.DataFrame,
+    positions: pd.Index,
+    config: SimConfig,
+) -> Dict:
+    """The array tasks of a stage's jobs, and the outcome of their TOIs
+
+    :return: dict of arrays: per TOI (in the order of the jobs' array args)
+        toi (position in toi_numbers)|toi_task|timeout|oom|failed, per task
+        job|duration (seconds)|cores|ok, and the throttle of each job
+    """
+    jobs = [job for job in jobs if job is not None]
+    sizes = np.array([len(job["array_args"]) for job in jobs], dtype=int)
+    setting = lambda key: np.array([job.get(key) for job in jobs])
+    node_pool = setting("node_pool").astype(bool)
+    bundle_size = setting("bundle_size").astype(int)
+    max_parallel = setting("max_parallel").astype(float)
+    cpus = setting("cpu_per_task").astype(float)
+    limit = np.array([slurm_time_to_minutes(j["time"]) * 60 for j in jobs])
+    # (the TOIs of a parallel bundle each get a share of the task's mem)
+    mem_mb = np.array([mem_to_mb(job["mem"]) for job in jobs])
+    mem_mb = np.where(node_pool, mem_mb, mem_mb / max_parallel)
+    n_tasks = -(-sizes // np.maximum(bundle_size, 1))
+
+    toi = positions.get_indexer(
+        np.concatenate([job["array_args"] for job in jobs])
+        if jobs
+        else np.array([], dtype=int)
+    )
+    toi_job = np.repeat(np.arange(len(jobs)), sizes)
+    job_start = np.repeat(np.cumsum(sizes) - sizes, sizes)
+    index_in_job = np.arange(len(toi)) - job_start
+    toi_task = (np.cumsum(n_tasks) - n_tasks)[toi_job] + (
+        index_in_job // bundle_size[toi_job]
+    )
+
+    # the TOIs of a task run one after the other (max_parallel at once)
+    toi_cpus = np.where(
+        node_pool, cpus, np.maximum(cpus // max_parallel, 1)
+    )[toi_job]
+    wall = samples.cpu_seconds.to_numpy()[toi] / toi_cpus
+    elapsed = np.cumsum(wall)
+    first = np.flatnonzero(np.diff(toi_task, prepend=-1))
+    task_offset = (elapsed - wall)[first]
+    finish = np.maximum(
+        (elapsed - task_offset[toi_task]) / max_parallel[toi_job], wall
+    )
+    timeout = finish > limit[toi_job]
+    oom = ~timeout & (samples.mem_mb.to_numpy()[toi] > mem_mb[toi_job])
+    failed = ~timeout & ~oom & samples.failed.to_numpy(bool)[toi]
+
+    task_job = np.repeat(np.arange(len(jobs)), n_tasks)
+    duration = np.zeros(len(task_job))
+    np.maximum.at(duration, toi_task, np.minimum(finish, limit[toi_job]))
+    ok = np.ones(len(task_job), dtype=bool)
+    np.logical_and.at(ok, toi_task, ~(timeout | oom | failed))
+    cores = np.where(node_pool, config.cores_per_node, cpus)[task_job]
+    return dict(
+        toi=toi,
+        toi_task=toi_task,
+        timeout=timeout,
+        oom=oom,
+        failed=failed,
+        job=task_job,
+        duration=duration,
+        cores=cores,
+        ok=ok,
+        throttles=[job.get("throttle") for job in jobs],
+    )
+
+
+def __analysis_slots(jobs: List[Dict], config: SimConfig) -> int:
+    """Number of analysis tasks that fit on the nodes at once"""
+    if config.layout == NODE_LAYOUT or len(jobs) == 0:
+        return config.nodes
+    cpus = max(job["cpu_per_task"] for job in jobs)
+    mem_mb = max(mem_to_mb(job["mem"]) for job in jobs)
+    per_node = min(
+        config.cores_per_node // cpus,
+        int(mem_to_mb(config.mem_per_node) // mem_mb),
+    )
+    if per_node < 1:
+        raise ValueError(f"The analysis tasks don't fit on the nodes")
+    return config.nodes * per_node
+
+
+def __schedule(
+    ready: np.ndarray,
+    duration: np.ndarray,
+    task_job: np.ndarray,
+    throttles: List[Optional[int]],
+    capacity: int,
+    skip: Optional[np.ndarray] = None,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """First-come-first-served start of the tasks on capacity slots (and at
+    most the throttle of each job's tasks at once)
+
+    The tasks are ordered by the time they could start under their job's
+    throttle alone, then each takes the first free slot.
+
+    :return: (start, end) of each task (NaN for the skipped tasks)
+    """
+    start = np.full(len(ready), np.nan)
+    run = np.arange(len(ready)) if skip is None else np.flatnonzero(~skip)
+    throttled = {j: t for j, t in enumerate(throttles) if t}
+    earliest = ready.tolist()
+    durations, jobs = duration.tolist(), task_job.tolist()
+    order = run[np.argsort(ready[run], kind="stable")].tolist()
+    if throttled:
+        heaps = {j: [0.0] * t for j, t in throttled.items()}
+        for i in order:
+            heap = heaps.get(jobs[i])
+            if heap is not None:
+                earliest[i] = max(earliest[i], heap[0])
+                heapq.heapreplace(heap, earliest[i] + durations[i])
+        order = sorted(order, key=earliest.__getitem__)
+    if capacity >= len(order) and not throttled:
+        start[run] = ready[run]
+        return start, start + duration
+    free = [0.0] * min(capacity, len(order))
+    heaps = {j: [0.0] * t for j, t in throttled.items()}
+    starts = start.tolist()
+    for i in order:
+        t = max(earliest[i], free[0])
+        heap = heaps.get(jobs[i])
+        if heap is not None:
+            t = max(t, heap[0])
+            heapq.heapreplace(heap, t + durations[i])
+        heapq.heapreplace(free, t + durations[i])
+        starts[i] = t
+    start = np.array(starts, dtype=float)
+    return start, start + duration
+
+
+# types of the SimConfig fields that can be swept from the command line
+SWEEP_TYPES = dict(
+    max_array_size=int,
+    cpu_per_task=int,
+    mem=str,
+    time=str,
+    bundle_size=int,
+    layout=str,
+    generation_throttle=int,
+    analysis_throttle=int,
+    nodes=int,
+    cores_per_node=int,
+    mem_per_node=str,
+    datamover_slots=int,
+    queue_wait=float,
+)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        "Simulate catalogue runs (every combination of the values passed)"
+    )
+    parser.add_argument(
+        "--jobstats",
+        required=True,
+        help="jobstats CSV with TOIs (from tess_jobstats --submit_dir)",
+    )
+    parser.add_argument(
+        "--toi_csv",
+        default=None,
+        help="CSV with the toi numbers to run (default: all in jobstats)",
+    )
+    for field in fields(SimConfig):
+        parser.add_argument(
+            f"--{field.name}",
+            type=SWEEP_TYPES[field.name],
+            nargs="+",
+            default=[field.default],
+            help=f"(default: {field.default})",
+        )
+    parser.add_argument(
+        "--seed", type=int, default=0, help="Seed of the random draws"
+    )
+    parser.add_argument(
+        "--fname", default=None, help="CSV to save the results to"
+    )
+    args = parser.parse_args()
+    history = load_runtime_history(args.jobstats)
+    if args.toi_csv:
+        toi_numbers = parse_toi_numbers(args.toi_csv)
+    else:
+        toi_numbers = sorted(history.TOI.dropna().astype(int).unique())
+    names = [field.name for field in fields(SimConfig)]
+    configs = config_grid(**{name: getattr(args, name) for name in names})
+    logger.info(f"Simulating {len(configs)} configs ({len(toi_numbers)} TOIs)")
+    results = simulate(toi_numbers, history, configs, seed=args.seed)
+    results = results.sort_values("makespan_hrs")
+    if args.fname:
+        results.to_csv(args.fname, index=False)
+    print(results.to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
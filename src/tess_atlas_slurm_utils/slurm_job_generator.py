@@ -1,30 +1,57 @@
+import math
 import os
-from typing import List
+from typing import Dict, Iterable, List, Optional, Tuple
 
-from .utils import mkdir, logger
-from .file_generators import make_main_submitter, make_slurm_file
-from .toi_data_interface import get_unprocessed_toi_numbers
-
-MAX_ARRAY_SIZE = 2048
-
-CMD = "srun run_toi ${ARRAY_ARGS[$SLURM_ARRAY_TASK_ID]} --outdir {outdir}"
+from .utils import (
+    logger,
+    mem_to_mb,
+    minutes_to_slurm_time,
+    mkdir,
+    slurm_time_to_minutes,
+)
+from .file_generators import SlurmFileRenderer, make_main_submitter
+from .job_settings import (
+    ANALYSIS,
+    ANALYSIS_JOB_SETTINGS,
+    GENERATION,
+    GENERATION_JOB_SETTINGS,
+    resolve_job_settings,
+)
+from .manifest import write_manifest
+from .pipeline import Pipeline, Stage
+from .submission import (
+    GENERATION_PARTITION,
+    get_max_array_size,
+    submit_jobs,
+)
+from .staging import STAGE_OUTDIR, stage_mb, staged_tmp_mem
+from .theano_cache import analysis_tmp_mem, cache_job_settings, cache_tarball
+from .toi_data_interface import (
+    get_delta_toi_numbers,
+    get_unprocessed_toi_numbers,
+)
 
+MAX_ARRAY_SIZE: Optional[int] = None  # (read from the slurm config if None)
 
-ANALYSIS_JOB_SETTINGS = dict(
-    cpu_per_task=2,
-    time="300:00",
-    jobname=f"pe",
-    mem="1500MB",
-    tmp_mem="500M",
+# $TOI is set by the slurm file for each TOI of the array task
+CMD = "{srun} run_toi $TOI --outdir {outdir}"
+SRUN = "srun"
+# lets concurrent TOIs of a bundle share the task's CPUs (and its mem)
+BUNDLE_SRUN = (
+    "srun --exact --ntasks=1 --cpus-per-task=1 --mem={mem} "
+    "--export=ALL,OMP_NUM_THREADS=1"
 )
-
-GENERATION_JOB_SETTINGS = dict(
-    cpu_per_task=1,
-    time="20:00",
-    jobname=f"gen",
-    mem="1000MB",
+# runs each TOI of a node pool in its own slot of the node
+NODE_SRUN = (
+    "srun --exact --ntasks=1 --cpus-per-task={cpu_per_task} --mem={mem}"
 )
 
+ARRAY_LAYOUT = "array"  # one small allocation per array task
+NODE_LAYOUT = "node"  # one whole node per array task, running a pool of TOIs
+NODE_CORES = 32
+NODE_MEM = "180GB"
+NODE_ROUNDS = 4  # TOIs per slot of a node pool
+
 
 def setup_jobs(
     toi_numbers: List[int],
@@ -36,6 +63,24 @@ def setup_jobs(
     skip_gen: bool = False,
     quickrun: bool = False,
     partition: str = "",
+    rescan: bool = False,
+    jobstats: Optional[str] = None,
+    bundle_size: int = 1,
+    bundle_parallel: bool = False,
+    resource_groups: Optional[List[Tuple[Dict, List[int]]]] = None,
+    profile: bool = False,
+    theano_cache: bool = False,
+    layout: str = ARRAY_LAYOUT,
+    node_cores: int = NODE_CORES,
+    node_mem: str = NODE_MEM,
+    stages: Optional[List[Stage]] = None,
+    delta: bool = False,
+    offline: Optional[bool] = None,
+    dry_run: bool = False,
+    generation_throttle: Optional[int] = None,
+    analysis_throttle: Optional[int] = None,
+    max_queued: Optional[int] = None,
+    staging: bool = False,
 ) -> None:
     """
     Set up and submit a batch of jobs for processing TOIs.
@@ -48,14 +93,54 @@ def setup_jobs(
         submit (bool): Flag to submit the jobs (True to submit, False to generate job files only).
         email (str): Email address for job notifications.
         partition (str): The compute cluster partition to use for job submission.
+        rescan (bool): Rebuild the outdir's completion index from scratch (only used if not clean).
+        jobstats (str): jobstats CSV of previous runs (with TOIs). If passed, the default
+            time/mem of each stage are right-sized from the previous jobs (see job_settings),
+            and TOIs are binned into analysis array jobs by their predicted time/mem (TOIs
+            without history get the defaults).
+        bundle_size (int): Number of TOIs run (one after the other) by each array task. The
+            time requested per task is scaled accordingly.
+        bundle_parallel (bool): Run the TOIs of a bundle concurrently (up to cpu_per_task at once,
+            each in a 1-CPU srun step with the single-TOI mem; mem/tmp_mem are scaled to fit).
+        resource_groups (list): (analysis settings overrides, TOIs) pairs, each given its own
+            array jobs (used instead of the jobstats-based classes, e.g. for resubmissions).
+        profile (bool): Log the resource usage of each TOI to {outdir}/profiling.jsonl.
+        theano_cache (bool): Analysis tasks unpack a pre-warmed Theano compile cache into
+            $JOBFS (a job building the cache is added if it isn't in {outdir}/theano_cache yet).
+        layout (str): 'array' (default): one small allocation per array task. 'node': each
+            analysis array task requests a whole node and runs NODE_ROUNDS TOIs per slot,
+            filling the node's slots (sized to node_cores/node_mem) from a work queue. The
+            analysis arrays then start once their generation array is done (afterany).
+        node_cores (int): Cores of the nodes (for the 'node' layout).
+        node_mem (str): Usable mem of the nodes (for the 'node' layout).
+        stages (list): Pipeline stages to make (and submit) for the TOIs instead of the
+            gen -> pe chain (see pipeline.py and standard_stages).
+        delta (bool): Also rerun completed TOIs whose catalogue rows (planets, ephemerides,
+            sectors) changed since their results were made (only used if not clean).
+        offline (bool): Only use the cached TOI catalogue (for delta).
+        dry_run (bool): Only print the planned array jobs and their resource requests
+            (no slurm files are written, and the delta snapshot isn't updated).
+        generation_throttle (int): Max number of generation tasks running at once per array
+            (%N), e.g. to spare the datamover partition.
+        analysis_throttle (int): Max number of analysis tasks running at once per array (%N).
+        max_queued (int): Pace the submission (if submit): each batch is only submitted once
+            the user's queued + running tasks leave room for it (see submission.py).
+        staging (bool): Run each TOI's analysis in $JOBFS, and move its results to the outdir
+            in one rename once it succeeded (see staging.py). The tmp_mem of the analysis
+            jobs is increased to fit the outputs of the TOIs already analysed.
 
     Returns:
         None
     """
 
     initial_num, new_num = len(toi_numbers), len(toi_numbers)
-    if not clean:
-        toi_numbers = get_unprocessed_toi_numbers(toi_numbers, outdir)
+    if not clean and delta:
+        toi_numbers = get_delta_toi_numbers(
+            toi_numbers, outdir, rescan, offline, update=not dry_run
+        )
+        new_num = len(toi_numbers)
+    elif not clean:
+        toi_numbers = get_unprocessed_toi_numbers(toi_numbers, outdir, rescan)
         new_num = len(toi_numbers)
 
     msg = f"TOIs to be processed: {new_num}"
@@ -63,54 +148,372 @@ def setup_jobs(
         msg += f" (not analyzing {initial_num - new_num}/{initial_num})"
     logger.info(msg)
 
+    if stages is not None:
+        __setup_pipeline(
+            stages, toi_numbers, outdir, module_loads, email, submit, dry_run
+        )
+        return
+    generation_jobs, analysis_jobs = plan_jobs(
+        toi_numbers,
+        outdir,
+        skip_gen=skip_gen,
+        quickrun=quickrun,
+        jobstats=jobstats,
+        bundle_size=bundle_size,
+        bundle_parallel=bundle_parallel,
+        resource_groups=resource_groups,
+        profile=profile,
+        layout=layout,
+        node_cores=node_cores,
+        node_mem=node_mem,
+        staging=staging,
+        generation_throttle=generation_throttle,
+        analysis_throttle=analysis_throttle,
+    )
+    node_pool = layout == NODE_LAYOUT
+
+    if dry_run:
+        print(format_plan(generation_jobs + analysis_jobs))
+        return
+
+    # Render all the slurm files in one pass
     submit_dir = mkdir(outdir, "submit")
+    renderer = SlurmFileRenderer(outdir, module_loads, submit_dir, email)
+    cache_job = None
+    if theano_cache and analysis_jobs:
+        tarball = cache_tarball(
+            outdir, module_loads, renderer.common_kwargs["load_env"]
+        )
+        for job in analysis_jobs:
+            job["tmp_mem"] = analysis_tmp_mem(job.get("tmp_mem"), tarball)
+            job["theano_cache"] = tarball
+        if not os.path.exists(tarball):
+            cache_job = cache_job_settings(
+                analysis_jobs[0]["array_args"][0], outdir, tarball
+            )
+    generation_fns = [
+        renderer.write(**job) if job else None for job in generation_jobs
+    ]
+    analysis_fns = renderer.write_many(analysis_jobs)
+    cache_fn = renderer.write(**cache_job) if cache_job else None
+    write_manifest(submit_dir, renderer.scripts)
+
+    # Generate the main job submission file
+    dependency = "afterany" if node_pool else "aftercorr"
+    submit_file = make_main_submitter(
+        generation_fns,
+        analysis_fns,
+        submit_dir,
+        partition,
+        cache_fn,
+        dependency,
+    )
+
+    # Submit or print the job submission command
+    if submit:
+        submit_jobs(
+            generation_fns,
+            analysis_fns,
+            submit_dir,
+            partition,
+            cache_fn=cache_fn,
+            dependency_type=dependency,
+            max_queued=max_queued,
+        )
+        logger.info("All submitted!")
+    else:
+        logger.info(f"To run job:\n>>> bash {submit_file}")
+
+
+def plan_jobs(
+    toi_numbers: List[int],
+    outdir: str,
+    skip_gen: bool = False,
+    quickrun: bool = False,
+    jobstats: Optional[str] = None,
+    bundle_size: int = 1,
+    bundle_parallel: bool = False,
+    resource_groups: Optional[List[Tuple[Dict, List[int]]]] = None,
+    profile: bool = False,
+    layout: str = ARRAY_LAYOUT,
+    node_cores: int = NODE_CORES,
+    node_mem: str = NODE_MEM,
+    staging: bool = False,
+    generation_throttle: Optional[int] = None,
+    analysis_throttle: Optional[int] = None,
+    max_array_size: Optional[int] = None,
+) -> Tuple[List[Optional[Dict]], List[Dict]]:
+    """The generation and analysis array jobs of each batch of TOIs (see
+    setup_jobs for the args), without writing anything
+
+    The analysis job of each batch depends on its generation job (task by
+    task, or on the whole array for the 'node' layout).
+
+    :param max_array_size: Max number of tasks per array job (defaults to
+        MAX_ARRAY_SIZE, or the MaxArraySize of the slurm config)
+    :return: (generation jobs (None if skip_gen), analysis jobs), the slurm
+        file kwargs of each batch
+    """
+    analysis_settings = resolve_job_settings(ANALYSIS, quickrun, jobstats)
+    generation_settings = resolve_job_settings(GENERATION, quickrun, jobstats)
+    analysis_settings["throttle"] = analysis_throttle
+    generation_settings["throttle"] = generation_throttle
+    if resource_groups is not None:
+        keep = set(toi_numbers)
+        resource_groups = [
+            (resources, [t for t in tois if t in keep])
+            for resources, tois in resource_groups
+        ]
+    elif jobstats and not quickrun:
+        from .resource_classes import (
+            assign_resource_classes,
+            predict_toi_costs,
+        )
+
+        costs = predict_toi_costs(
+            jobstats, analysis_settings["cpu_per_task"]
+        )
+        resource_groups = assign_resource_classes(
+            toi_numbers, costs, analysis_settings
+        )
+    else:
+        resource_groups = [({}, toi_numbers)]
+    node_pool = layout == NODE_LAYOUT
+    if node_pool:
+        bundle_size, bundle_parallel = 1, False  # (for the generation jobs)
+    max_array_size = max_array_size or MAX_ARRAY_SIZE or get_max_array_size()
+    batch_size = max_array_size * bundle_size
     toi_batches = [
-        toi_numbers[i : i + MAX_ARRAY_SIZE]
-        for i in range(0, len(toi_numbers), MAX_ARRAY_SIZE)
+        (resources, tois[i : i + batch_size])
+        for resources, tois in resource_groups
+        for i in range(0, len(tois), batch_size)
     ]
 
     # Common keyword arguments for job generation
+    cmd = CMD.format(srun=SRUN, outdir=os.path.abspath(outdir))
+    cmd = cmd if not quickrun else cmd + " --quickrun"
+    anlys_cmd = cmd
+    if staging:
+        anlys_cmd = CMD.format(srun=SRUN, outdir=STAGE_OUTDIR)
+        anlys_cmd = anlys_cmd if not quickrun else anlys_cmd + " --quickrun"
+        staged_mb = stage_mb(outdir)
     kwargs = dict(
-        outdir=outdir,
-        module_loads=module_loads,
-        submit_dir=submit_dir,
-        email=email,
         array_job=True,
-        command=CMD if not quickrun else CMD + " --quickrun",
+        command=cmd,
+        analysis_command=anlys_cmd,
+        bundle_size=bundle_size,
+        bundle_parallel=bundle_parallel,
+        profile=profile,
     )
 
-    generation_fns, analysis_fns = [], []
-    for i, toi_batch in enumerate(toi_batches):
+    generation_jobs, analysis_jobs = [], []
+    for i, (resources, toi_batch) in enumerate(toi_batches):
         kwargs.update(dict(array_args=toi_batch, jobid=i))
-        gen_fn, anlys_fn = __generate_job_for_batch(kwargs.copy(), skip_gen, quickrun)
-        generation_fns.append(gen_fn)
-        analysis_fns.append(anlys_fn)
+        gen_job, anlys_job = __generate_job_for_batch(
+            kwargs.copy(),
+            skip_gen,
+            generation_settings,
+            {**analysis_settings, **resources},
+        )
+        generation_jobs.append(gen_job)
+        if staging:
+            anlys_job.update(
+                staging=True,
+                tmp_mem=staged_tmp_mem(
+                    anlys_job.get("tmp_mem"),
+                    staged_mb,
+                    anlys_job["max_parallel"],
+                ),
+            )
+        if node_pool:
+            anlys_job = __node_pool(anlys_job, node_cores, node_mem)
+        analysis_jobs.append(anlys_job)
+    return generation_jobs, analysis_jobs
 
-    # Generate the main job submission file
-    submit_file = make_main_submitter(
-        generation_fns, analysis_fns, submit_dir, partition
-    )
 
-    # Submit or print the job submission command
+def standard_stages(
+    outdir: str,
+    quickrun: bool = False,
+    jobstats: Optional[str] = None,
+    generation_throttle: Optional[int] = None,
+) -> List[Stage]:
+    """The gen -> pe stages (to build pipelines with more stages on)
+
+    :param generation_throttle: Max number of generation tasks running at
+        once (per array) on the datamover partition
+    """
+    cmd = CMD.format(srun=SRUN, outdir=os.path.abspath(outdir))
+    cmd = cmd + " --quickrun" if quickrun else cmd
+    generation = resolve_job_settings(GENERATION, quickrun, jobstats)
+    analysis = resolve_job_settings(ANALYSIS, quickrun, jobstats)
+    return [
+        Stage(
+            name=generation.pop("jobname"),
+            command=f"{cmd} --setup",
+            settings=generation,
+            partition=GENERATION_PARTITION,
+            throttle=generation_throttle,
+        ),
+        Stage(
+            name=analysis.pop("jobname"),
+            command=cmd,
+            settings=analysis,
+            after={GENERATION_JOB_SETTINGS["jobname"]: "aftercorr"},
+        ),
+    ]
+
+
+def __setup_pipeline(
+    stages: List[Stage],
+    toi_numbers: List[int],
+    outdir: str,
+    module_loads: str,
+    email: str,
+    submit: bool,
+    dry_run: bool,
+):
+    """Write (and submit) the jobs of all the stages"""
+    pipeline = Pipeline(stages)
+    batch_size = MAX_ARRAY_SIZE or get_max_array_size()
+    toi_batches = [
+        toi_numbers[i : i + batch_size]
+        for i in range(0, len(toi_numbers), batch_size)
+    ]
+    if dry_run:
+        print(
+            format_plan(
+                dict(
+                    **stage.settings,
+                    jobname=stage.name,
+                    jobid=i if stage.per_toi else None,
+                    array_args=batch if stage.per_toi else None,
+                )
+                for stage in pipeline.order()
+                for i, batch in enumerate(
+                    toi_batches if stage.per_toi else [None]
+                )
+            )
+        )
+        return
+    submit_dir = mkdir(outdir, "submit")
+    renderer = SlurmFileRenderer(outdir, module_loads, submit_dir, email)
+    jobs = pipeline.write(renderer, toi_batches)
+    write_manifest(submit_dir, renderer.scripts)
+    submit_file = pipeline.make_submitter(jobs, submit_dir)
+    stage_names = " -> ".join(s.name for s in pipeline.order())
+    logger.info(f"Pipeline: {stage_names} ({len(jobs)} jobs)")
     if submit:
-        os.system(f"bash {submit_file}")
+        pipeline.submit(jobs, submit_dir)
         logger.info("All submitted!")
     else:
         logger.info(f"To run job:\n>>> bash {submit_file}")
 
 
-def __generate_job_for_batch(kwargs, skip_gen, quickrun):
+def format_plan(jobs: Iterable[Optional[Dict]]) -> str:
+    """A table of the (slurm file kwargs of the) jobs and their requests"""
+    rows = [("job", "tasks", "TOIs", "cpus", "time", "mem", "tmp", "cpu-hrs")]
+    total_cpu_hrs = 0.0
+    for job in filter(None, jobs):
+        tois = job.get("array_args") or []
+        n_tasks = max(math.ceil(len(tois) / job.get("bundle_size", 1)), 1)
+        cpus = job["cpu_per_task"]
+        if job.get("node_pool"):  # (one task per slot of the node)
+            cpus *= job["max_parallel"]
+        cpu_hrs = n_tasks * cpus * slurm_time_to_minutes(job["time"]) / 60
+        total_cpu_hrs += cpu_hrs
+        name = job["jobname"]
+        if job.get("jobid") is not None:
+            name += f"_{job['jobid']}"
+        rows.append(
+            (
+                name,
+                str(n_tasks),
+                f"{min(tois)}-{max(tois)} ({len(tois)})" if tois else "-",
+                str(cpus),
+                job["time"],
+                job["mem"] if not job.get("node_pool") else "node",
+                job.get("tmp_mem") or "-",
+                f"{cpu_hrs:,.1f}",
+            )
+        )
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    lines = [
+        "  ".join(col.ljust(w) for col, w in zip(row, widths)).rstrip()
+        for row in rows
+    ]
+    lines.append(f"Max CPU-hrs requested: {total_cpu_hrs:,.0f}")
+    return "\n".join(lines)
+
+
+def __generate_job_for_batch(
+    kwargs, skip_gen, generation_settings: Dict, analysis_settings: Dict
+):
+    """Get the (generation, analysis) slurm file kwargs of a batch"""
     cmd = kwargs.pop("command")
-    gen_fname = None
+    anlys_cmd = kwargs.pop("analysis_command")
+    bundle_parallel = kwargs.pop("bundle_parallel")
+    gen_job = None
     if not skip_gen:
-        gen_fname = make_slurm_file(
-            **kwargs, **GENERATION_JOB_SETTINGS, command=f"{cmd} --setup"
+        gen_job = dict(
+            **kwargs,
+            **__bundled(
+                generation_settings, kwargs, bundle_parallel, f"{cmd} --setup"
+            ),
+        )
+    analysis_job = dict(
+        **kwargs,
+        **__bundled(analysis_settings, kwargs, bundle_parallel, anlys_cmd),
+    )
+    return gen_job, analysis_job
+
+
+def __bundled(
+    settings: Dict, kwargs: Dict, bundle_parallel: bool, command: str
+) -> Dict:
+    """Settings for tasks running a bundle of TOIs (time scaled to bundle,
+    mem/tmp_mem to the TOIs run at once, each in its own srun step)"""
+    max_parallel = settings["cpu_per_task"] if bundle_parallel else 1
+    n_rounds = math.ceil(kwargs["bundle_size"] / max_parallel)
+    time = slurm_time_to_minutes(settings["time"]) * n_rounds
+    bundled = {
+        **settings,
+        "command": command,
+        "time": minutes_to_slurm_time(time),
+        "max_parallel": max_parallel,
+    }
+    if max_parallel > 1:
+        srun = BUNDLE_SRUN.format(mem=settings["mem"])
+        bundled.update(
+            command=command.replace(SRUN, srun, 1),
+            mem=f"{math.ceil(mem_to_mb(settings['mem']) * max_parallel)}M",
         )
-    if quickrun:
-        ANALYSIS_JOB_SETTINGS["time"] = "20:00"
-        ANALYSIS_JOB_SETTINGS["mem"] = "1000MB"
-        ANALYSIS_JOB_SETTINGS["cpu_per_task"] = 1
-    analysis_fn = make_slurm_file(
-        **kwargs, **ANALYSIS_JOB_SETTINGS, command=cmd,
+        if settings.get("tmp_mem"):
+            tmp_mb = mem_to_mb(settings["tmp_mem"]) * max_parallel
+            bundled["tmp_mem"] = f"{math.ceil(tmp_mb)}M"
+    return bundled
+
+
+def __node_pool(job: Dict, node_cores: int, node_mem: str) -> Dict:
+    """Turn an (unbundled) analysis job into whole-node pools of TOIs"""
+    slots = max(
+        1,
+        min(
+            node_cores // job["cpu_per_task"],
+            int(mem_to_mb(node_mem) // mem_to_mb(job["mem"])),
+        ),
     )
-    return gen_fname, analysis_fn
+    srun = NODE_SRUN.format(cpu_per_task=job["cpu_per_task"], mem=job["mem"])
+    tmp_mem = job.get("tmp_mem")
+    if tmp_mem:  # $JOBFS is shared by the node's slots
+        tmp_mem = f"{math.ceil(mem_to_mb(tmp_mem) * slots)}M"
+    return {
+        **job,
+        "command": job["command"].replace(SRUN, srun, 1),
+        "bundle_size": slots * NODE_ROUNDS,
+        "max_parallel": slots,
+        "time": minutes_to_slurm_time(
+            slurm_time_to_minutes(job["time"]) * NODE_ROUNDS
+        ),
+        "tmp_mem": tmp_mem or "",
+        "node_pool": True,
+    }
@@ -0,0 +1,66 @@
+"""This module stages the analysis of each TOI in $JOBFS.
+
+Without it, thousands of concurrent analysis tasks write their netcdf files,
+plots and notebooks straight into the (Lustre) outdir. With staging, each
+TOI's generation outputs are copied into $JOBFS/stage_$TOI, the analysis
+runs there (--outdir $JOBFS/stage_$TOI), and once it succeeded the results
+are copied back next to the outdir's toi_N_files and renamed into place
+(see stage_out in the slurm template). The completion scan thus never sees
+a partially written netcdf file.
+
+The $JOBFS space (--tmp) requested is sized from the outputs of the TOIs
+analysed last in the outdir (the mtimes of the completion index).
+"""
+import math
+import os
+import sqlite3
+from typing import Optional
+
+from .toi_data_interface import update_completion_index
+from .utils import dir_size, mem_to_mb
+
+__all__ = ["STAGE_OUTDIR", "staged_command", "staged_tmp_mem", "stage_mb"]
+
+# outdir of the TOI's run inside the job ($TOI is set by the slurm file)
+STAGE_OUTDIR = "$JOBFS/stage_$TOI"
+DEFAULT_STAGE_MB = 500  # size of a TOI's outputs if none were analysed yet
+STAGE_SAMPLE = 100  # number of analysed TOIs whose outputs are measured
+STAGE_HEADROOM = 1.5  # staged space requested ~ STAGE_HEADROOM * max size
+
+
+def staged_command(command: str) -> str:
+    """Wrap a TOI's command (run with --outdir STAGE_OUTDIR) with the
+    stage_in/stage_out functions of the slurm template (the exit code of
+    the command is kept)"""
+    return f"{{ stage_in $TOI && {command}; stage_out $TOI $?; }}"
+
+
+def stage_mb(outdir: str) -> float:
+    """Space (MB) needed to stage a TOI: the largest outputs (toi_N_files)
+    of the STAGE_SAMPLE TOIs of the outdir whose netcdf results are the
+    newest (with headroom)"""
+    if not os.path.isdir(outdir):
+        return DEFAULT_STAGE_MB
+    index = update_completion_index(outdir)
+    with sqlite3.connect(index) as conn:
+        tois = conn.execute(
+            "SELECT TOI FROM results GROUP BY TOI "
+            "ORDER BY MAX(mtime_ns) DESC LIMIT ?",
+            (STAGE_SAMPLE,),
+        ).fetchall()
+    conn.close()
+    sizes = [
+        dir_size(os.path.join(outdir, f"toi_{toi}_files"))
+        for (toi,) in tois
+    ]
+    if len(sizes) == 0:
+        return DEFAULT_STAGE_MB
+    return STAGE_HEADROOM * max(sizes) / 1024**2
+
+
+def staged_tmp_mem(
+    tmp_mem: Optional[str], staged_mb: float, n_staged: int = 1
+) -> str:
+    """tmp_mem plus room for n_staged TOIs staged at once in $JOBFS"""
+    base_mb = mem_to_mb(tmp_mem) if tmp_mem else 0
+    return f"{math.ceil(base_mb + staged_mb * n_staged)}M"
@@ -0,0 +1,352 @@
+"""This module submits the generated slurm files with sbatch (from Python).
+
+The (generation -> analysis) chain of each batch is submitted concurrently
+with a bounded pool of workers, sbatch calls that fail because slurmctld is
+busy are retried with exponential backoff, and the job IDs (with their
+dependencies) are saved in a JSON submission record in the submit dir.
+
+Slurm files that are still pending/running from a previous submission (the
+same content-addressed file, see SlurmFileRenderer) aren't submitted again:
+their queued job is reused (e.g. as a dependency) instead.
+
+Submissions can also be paced: each batch is then only released once the
+user's queued + running tasks leave room for it (see wait_for_headroom), so
+a full catalogue run doesn't hit the QOS submit limits or flood the queue.
+"""
+import functools
+import getpass
+import json
+import os
+import re
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from .file_generators import SUBMITTED_JOBS_LEDGER, read_array_args
+from .utils import logger
+
+__all__ = [
+    "sbatch",
+    "submit_jobs",
+    "get_max_array_size",
+    "wait_for_headroom",
+]
+
+GENERATION_PARTITION = "datamover"
+MAX_WORKERS = 4
+MAX_RETRIES = 5
+BACKOFF = 2.0  # seconds before the first retry (doubled for each retry)
+# sbatch errors worth retrying (slurmctld busy/unreachable)
+RETRY_ERRORS = (
+    "Socket timed out",
+    "Resource temporarily unavailable",
+    "Unable to contact slurm controller",
+)
+SUBMISSION_RECORD = "submission_{timestamp}.json"
+DEFAULT_MAX_ARRAY_SIZE = 2048  # (if it can't be read from the slurm config)
+SCONTROL_COMMAND = ["scontrol", "show", "config"]
+# one line (the job ID) per pending/running array task
+QUEUED_TASKS_COMMAND = [
+    "squeue",
+    "-h",
+    "-r",
+    "-t",
+    "PENDING,RUNNING",
+    "-o",
+    "%i",
+]
+QUEUED_JOBS_COMMAND = ["squeue", "-h", "-t", "PENDING,RUNNING", "-o", "%F"]
+POLL_INTERVAL = 60.0  # seconds between checks of the queue while pacing
+
+
+@functools.lru_cache(maxsize=None)
+def get_max_array_size(default: int = DEFAULT_MAX_ARRAY_SIZE) -> int:
+    """Max number of tasks of an array job (MaxArraySize of the slurm
+    config, as the task IDs start at 0)"""
+    try:
+        result = subprocess.run(
+            SCONTROL_COMMAND, capture_output=True, text=True
+        )
+    except FileNotFoundError:  # not on a slurm cluster
+        return default
+    match = re.search(r"^MaxArraySize\s*=\s*(\d+)", result.stdout, re.M)
+    if result.returncode != 0 or match is None:
+        logger.warning(f"MaxArraySize not found, using {default}")
+        return default
+    return int(match.group(1))
+
+
+def queued_task_count(user: Optional[str] = None) -> int:
+    """Number of the user's pending + running tasks (array tasks counted
+    one by one)"""
+    cmd = QUEUED_TASKS_COMMAND + ["-u", user or getpass.getuser()]
+    result = subprocess.run(cmd, capture_output=True, text=True, check=True)
+    return len(result.stdout.splitlines())
+
+
+def queued_jobs(submit_dir: str) -> Dict[str, str]:
+    """Slurm files of the jobs submitted from submit_dir (see the ledger)
+    that are still pending/running -> their job IDs"""
+    ledger = os.path.join(submit_dir, SUBMITTED_JOBS_LEDGER)
+    if not os.path.exists(ledger):
+        return {}
+    cmd = QUEUED_JOBS_COMMAND + ["-u", getpass.getuser()]
+    try:
+        result = subprocess.run(
+            cmd, capture_output=True, text=True, check=True
+        )
+    except (FileNotFoundError, subprocess.CalledProcessError) as e:
+        logger.warning(f"Can't check the queued jobs ({e})")
+        return {}
+    queued = set(result.stdout.split())
+    with open(ledger) as f:
+        jobs = [line.split() for line in f if line.strip()]
+    return {
+        os.path.realpath(fn): job_id for job_id, fn in jobs if job_id in queued
+    }
+
+
+def wait_for_headroom(
+    n_tasks: int, max_queued: int, poll_interval: float = POLL_INTERVAL
+):
+    """Wait until n_tasks more tasks keep the user's queued + running tasks
+    under max_queued (or the queue is empty, for larger submissions)"""
+    while True:
+        queued = queued_task_count()
+        if queued + n_tasks <= max_queued or queued == 0:
+            return
+        logger.info(
+            f"{queued} tasks queued: waiting to submit {n_tasks} more "
+            f"(max {max_queued})"
+        )
+        time.sleep(poll_interval)
+
+
+def sbatch(
+    slurm_file: str,
+    args: Optional[List[str]] = None,
+    retries: int = MAX_RETRIES,
+    backoff: float = BACKOFF,
+    queued: Optional[Dict[str, str]] = None,
+) -> str:
+    """Submit a slurm file, retrying transient slurmctld errors
+
+    :param slurm_file: Slurm file to submit
+    :param args: Extra sbatch args (e.g. ['--dependency=afterok:123'])
+    :param retries: Max number of retries
+    :param backoff: Seconds to wait before the first retry
+    :param queued: Slurm files already pending/running -> their job IDs
+        (see queued_jobs). These aren't submitted again.
+    :return: The job ID
+    """
+    job_id = (queued or {}).get(os.path.realpath(slurm_file))
+    if job_id is not None:
+        logger.info(f"{slurm_file} is already queued (job {job_id})")
+        return job_id
+    cmd = ["sbatch", "--parsable", *(args or []), slurm_file]
+    for attempt in range(retries + 1):
+        result = subprocess.run(cmd, capture_output=True, text=True)
+        if result.returncode == 0:
+            return result.stdout.strip().split(";")[0]  # 'jobid[;cluster]'
+        retryable = any(e in result.stderr for e in RETRY_ERRORS)
+        if not retryable or attempt == retries:
+            raise subprocess.CalledProcessError(
+                result.returncode, cmd, result.stdout, result.stderr
+            )
+        wait = backoff * 2**attempt
+        logger.warning(
+            f"sbatch {slurm_file} failed ({result.stderr.strip()}), "
+            f"retrying in {wait}s"
+        )
+        time.sleep(wait)
+
+
+def __submit_batch(
+    batch: int,
+    generation_fn: Optional[str],
+    analysis_fn: str,
+    partition: str,
+    cache_fn: Optional[str] = None,
+    cache_dependency: Optional[str] = None,
+    dependency_type: str = "aftercorr",
+    max_queued: Optional[int] = None,
+    poll_interval: float = POLL_INTERVAL,
+    **sbatch_kwargs,
+) -> Dict:
+    """Submit the jobs of a batch
+
+    :return: record of the submitted jobs (with the error if an sbatch
+        failed, so the jobs submitted before it are still recorded)
+    """
+    partition_args = [f"--partition={partition}"] if partition else []
+    record = dict(batch=batch, generation=None)
+    dependencies = []
+    try:
+        if max_queued is not None:
+            queued = sbatch_kwargs.get("queued") or {}
+            n_tasks = sum(
+                max(len(read_array_args(fn)), 1)
+                for fn in [generation_fn, cache_fn, analysis_fn]
+                if fn is not None and os.path.realpath(fn) not in queued
+            )
+            if n_tasks > 0:
+                wait_for_headroom(n_tasks, max_queued, poll_interval)
+        if generation_fn is not None:
+            gen_id = sbatch(
+                generation_fn,
+                [f"--partition={GENERATION_PARTITION}"],
+                **sbatch_kwargs,
+            )
+            record["generation"] = dict(
+                slurm_file=generation_fn, job_id=gen_id
+            )
+            dependencies.append(f"{dependency_type}:{gen_id}")
+        if cache_fn is not None:
+            # the cache job warms up on the first TOI (once its generation
+            # is done). afterany: a failed warm-up only means the analyses
+            # compile from scratch (they skip the missing tarball), so it
+            # mustn't block them
+            cache_args = partition_args + (
+                [f"--dependency=afterany:{gen_id}_0"] if dependencies else []
+            )
+            cache_id = sbatch(cache_fn, cache_args, **sbatch_kwargs)
+            record["cache"] = dict(slurm_file=cache_fn, job_id=cache_id)
+            cache_dependency = f"afterany:{cache_id}"
+        if cache_dependency is not None:
+            dependencies.append(cache_dependency)
+        dependency = ",".join(dependencies) or None
+        dependency_args = [f"--dependency={dependency}"] if dependency else []
+        anlys_id = sbatch(
+            analysis_fn, partition_args + dependency_args, **sbatch_kwargs
+        )
+        record["analysis"] = dict(
+            slurm_file=analysis_fn, job_id=anlys_id, dependency=dependency
+        )
+    except subprocess.CalledProcessError as e:
+        record["error"] = (e.stderr or "").strip() or str(e)
+    return record
+
+
+def submit_jobs(
+    generation_fns: List[Optional[str]],
+    analysis_fns: List[str],
+    submit_dir: str,
+    partition: str = "",
+    max_workers: int = MAX_WORKERS,
+    retries: int = MAX_RETRIES,
+    backoff: float = BACKOFF,
+    cache_fn: Optional[str] = None,
+    dependency_type: str = "aftercorr",
+    max_queued: Optional[int] = None,
+    poll_interval: float = POLL_INTERVAL,
+) -> str:
+    """Submit the generation + analysis slurm files of each batch
+
+    The analysis job of each batch depends (aftercorr) on its generation
+    job (if there is one), and on the end of the Theano cache job (if there
+    is one, afterany: the analyses still run if the warm-up failed).
+    Batches are submitted concurrently. Slurm files still queued from a
+    previous submission aren't submitted again (see queued_jobs).
+
+    :param generation_fns: Generation slurm file of each batch (or None)
+    :param analysis_fns: Analysis slurm file of each batch
+    :param submit_dir: Dir to save the submission record in
+    :param partition: Partition for the analysis jobs
+    :param max_workers: Max number of concurrent sbatch calls
+    :param retries: Max number of retries per sbatch call
+    :param backoff: Seconds to wait before the first retry
+    :param cache_fn: Theano cache job (submitted with the first batch,
+        after its first generation task). All analysis jobs depend on it.
+    :param dependency_type: Dependency of the analysis jobs on their
+        generation job (aftercorr: task by task, afterany: whole array)
+    :param max_queued: Pace the submission: the batches are submitted one
+        by one, each once the user's queued + running tasks leave room for
+        its tasks (this blocks until the last batch is submitted)
+    :param poll_interval: Seconds between checks of the queue while pacing
+    :return: Path to the JSON submission record
+    """
+    submitted = datetime.now()
+    batch_kwargs = dict(
+        queued=queued_jobs(submit_dir),
+        retries=retries,
+        backoff=backoff,
+        dependency_type=dependency_type,
+        max_queued=max_queued,
+        poll_interval=poll_interval,
+    )
+    if max_queued is not None:
+        max_workers = 1  # (release the batches in order)
+    batch_args = list(enumerate(zip(generation_fns, analysis_fns)))
+    batches = []
+    cache_dependency = None
+    if cache_fn is not None and batch_args:
+        # the other batches need the cache job's ID
+        i, (gen_fn, anlys_fn) = batch_args.pop(0)
+        batch = __submit_batch(
+            i, gen_fn, anlys_fn, partition, cache_fn, **batch_kwargs
+        )
+        batches.append(batch)
+        if batch.get("cache"):
+            cache_dependency = f"afterany:{batch['cache']['job_id']}"
+        else:  # (the analyses would run without the cache)
+            batches += [
+                dict(batch=j, error="not submitted (no Theano cache job)")
+                for j, _ in batch_args
+            ]
+            batch_args = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(
+                __submit_batch,
+                i,
+                gen_fn,
+                anlys_fn,
+                partition,
+                cache_dependency=cache_dependency,
+                **batch_kwargs,
+            )
+            for i, (gen_fn, anlys_fn) in batch_args
+        ]
+    batches += [future.result() for future in futures]
+    errors = [
+        f"batch {batch['batch']}: {batch['error']}"
+        for batch in batches
+        if "error" in batch
+    ]
+
+    record = dict(
+        submitted=submitted.isoformat(),
+        partition=partition,
+        batches=batches,
+    )
+    timestamp = submitted.strftime("%Y%m%d_%H%M%S")
+    fname = os.path.join(
+        submit_dir, SUBMISSION_RECORD.format(timestamp=timestamp)
+    )
+    with open(fname, "w") as f:
+        json.dump(record, f, indent=2)
+    __append_to_ledger(submit_dir, batches)
+    logger.info(f"Submission record saved in {os.path.abspath(fname)}")
+    if errors:
+        raise RuntimeError(
+            f"Failed to submit {len(errors)} batches: " + "; ".join(errors)
+        )
+    return os.path.abspath(fname)
+
+
+def __append_to_ledger(submit_dir: str, batches: List[Dict]):
+    """Append '<jobid> <slurm file>' lines to the submitted jobs ledger"""
+    lines = [
+        f"{job['job_id']} {job['slurm_file']}\n"
+        for batch in batches
+        for job in [
+            batch.get("generation"),
+            batch.get("cache"),
+            batch.get("analysis"),
+        ]
+        if job is not None
+    ]
+    with open(os.path.join(submit_dir, SUBMITTED_JOBS_LEDGER), "a") as f:
+        f.writelines(lines)
@@ -0,0 +1,11 @@
+#!/bin/bash
+
+# record of "<jobid> <slurm file>" for every submitted job (maps array tasks to TOIs)
+LEDGER={{ledger}}
+
+{% for job in jobs -%}
+{{job.var}}=$(sbatch --parsable {{job.args}} {{job.slurm_file}})
+echo "${{job.var}} {{job.slurm_file}}" >> $LEDGER
+>&2 echo "Submitted {{job.slurm_file}}"
+{% endfor %}
+>&2 squeue -u $USER -o '%.4u %.20j %.10A %.4C %.10E %R'
@@ -3,12 +3,14 @@
 #SBATCH --job-name={{jobname}}
 #SBATCH --output={{log_file}}
 #
-#SBATCH --ntasks=1
+#SBATCH --ntasks={% if node_pool %}{{max_parallel}}{% else %}1{% endif %}
+{% if node_pool -%}      #SBATCH --nodes=1{% endif %}
+{% if node_pool -%}      #SBATCH --exclusive{% endif %}
 #SBATCH --time={{time}}
-#SBATCH --mem={{mem}}
+#SBATCH --mem={% if node_pool %}0{% else %}{{mem}}{% endif %}
 #SBATCH --cpus-per-task={{cpu_per_task}}
 {% if tmp_mem!="" -%}      #SBATCH --tmp={{tmp_mem}}{% endif %}
-{% if array_job=="True" -%}      #SBATCH --array=0-{{array_end}}{% endif %}
+{% if array_job=="True" -%}      #SBATCH --array=0-{{array_end}}{% if throttle %}%{{throttle}}{% endif %}{% endif %}
 {% if email!="" -%}      #SBATCH --mail-user={{email}}{% endif %}
 {% if email!="" -%}      #SBATCH --mail-type=ALL{% endif %}
 {% if account!="" -%}      #SBATCH --account={{account}}{% endif %}
@@ -19,8 +21,90 @@ module load {{module_loads}}
 {{load_env}}
 {% if array_job=="True" %}
 ARRAY_ARGS=({{array_args}})
+{% if bundle_size > 1 or node_pool %}
+BUNDLE_SIZE={{bundle_size}}
+BUNDLE=("${ARRAY_ARGS[@]:$((SLURM_ARRAY_TASK_ID * BUNDLE_SIZE)):$BUNDLE_SIZE}")
+EXIT_CODES={{exit_codes}}
+{% else %}
+TOI=${ARRAY_ARGS[$SLURM_ARRAY_TASK_ID]}
+{% endif %}
 {% endif %}
 echo "Job tmp path: $JOBFS"
+{% if theano_cache %}
+# unpack the pre-warmed Theano compile cache (if it has been built)
+if [ -f {{theano_cache}} ]; then
+  tar -xzf {{theano_cache}} -C $JOBFS
+fi
+{% endif %}
 export THEANO_FLAGS="base_compiledir=$JOBFS/.theano_base,compiledir=$JOBFS/.theano_compile"
 export IPYTHONDIR=$JOBFS/.ipython
+{% if staging %}
+# each TOI runs in $JOBFS/stage_$TOI (with a copy of its generation outputs)
+stage_in() {
+  mkdir -p $JOBFS/stage_$1
+  if [ -d {{outdir}}/toi_$1_files ]; then
+    cp -r {{outdir}}/toi_$1_files $JOBFS/stage_$1/
+  fi
+}
+
+# copy a successful TOI's results next to the outdir's toi_N_files, then
+# rename them into place (so the outdir never has partial netcdf files)
+stage_out() {
+  local STAGE=$JOBFS/stage_$1 EXIT_CODE=$2
+  local DEST={{outdir}}/toi_$1_files
+  local NEW={{outdir}}/.toi_$1_files.$SLURM_JOB_ID.new
+  local OLD={{outdir}}/.toi_$1_files.$SLURM_JOB_ID.old
+  if [ $EXIT_CODE -eq 0 ]; then
+    rm -rf $NEW $OLD
+    cp -r $STAGE/toi_$1_files $NEW && \
+      { [ ! -d $DEST ] || mv -T $DEST $OLD; } && \
+      mv -T $NEW $DEST
+    EXIT_CODE=$?
+    if [ $EXIT_CODE -ne 0 ]; then
+      # put the previous outputs back in place
+      [ ! -d $OLD ] || mv -T $OLD $DEST
+      rm -rf $NEW
+    else
+      rm -rf $OLD
+      for f in $STAGE/toi_$1*; do  # (e.g. the TOI's notebook)
+        if [ -f $f ]; then
+          cp $f {{outdir}}/.$(basename $f).$SLURM_JOB_ID.new && \
+            mv {{outdir}}/.$(basename $f).$SLURM_JOB_ID.new {{outdir}}/$(basename $f)
+        fi
+      done
+    fi
+  fi
+  if [ $2 -eq 0 ] && [ $EXIT_CODE -ne 0 ]; then
+    >&2 echo "Staging out TOI $1 failed: its results are kept in $STAGE"
+  else
+    rm -rf $STAGE
+  fi
+  return $EXIT_CODE
+}
+{% endif %}
+{% if bundle_size > 1 or node_pool %}
+run_bundled_toi() {
+  local TOI=$1
+{% if node_pool %}
+  {{command}} > {{toi_log}} 2>&1
+{% else %}
+  {{command}}
+{% endif %}
+  echo "$TOI $?" >> $EXIT_CODES
+}
+
+: > $EXIT_CODES  # (drop the exit codes of a previous run of the task)
+for TOI in "${BUNDLE[@]}"; do
+{% if max_parallel > 1 %}
+  while [ $(jobs -rp | wc -l) -ge {{max_parallel}} ]; do wait -n; done
+  run_bundled_toi $TOI &
+{% else %}
+  run_bundled_toi $TOI
+{% endif %}
+done
+wait
+# fail the task if any TOI in the bundle failed
+awk '$2 != 0 {failed=1} END {exit failed}' $EXIT_CODES
+{% else %}
 {{command}}
+{% endif %}
@@ -3,6 +3,8 @@
 GENERATION_FN=({{generation_fns}})
 ANALYSIS_FN=({{analysis_fns}})
 ANLYS_IDS=()
+# record of "<jobid> <slurm file>" for every submitted job (maps array tasks to TOIs)
+LEDGER={{ledger}}
 
 {% if partition!="" -%}
 PARTITION="--partition={{partition}}"
@@ -10,15 +12,31 @@ PARTITION="--partition={{partition}}"
 PARTITION=""
 {% endif %}
 
+{% if cache_fn!="" -%}
+# builds the Theano compile cache used by all the analysis jobs (afterany:
+# if the warm-up fails, the analyses run without the cache)
+CACHE_FN={{cache_fn}}
+{% endif %}
+
 for index in ${!ANALYSIS_FN[*]}; do
+  DEPENDENCY=""
   if [ ! -z $GENERATION_FN ]; then
     >&2 echo "Submitting ${GENERATION_FN[$index]} ${ANALYSIS_FN[$index]}"
     GEN_ID=$(sbatch --partition=datamover --parsable ${GENERATION_FN[$index]})
-    ANLYS_ID=$(sbatch $PARTITION --parsable --dependency=aftercorr:$GEN_ID ${ANALYSIS_FN[$index]})
+    DEPENDENCY="{{dependency}}:$GEN_ID"
+    echo "$GEN_ID ${GENERATION_FN[$index]}" >> $LEDGER
   else
-    >&2 echo "Submitting ${GENERATION_FN[$index]}}"
-    ANLYS_ID=$(sbatch $PARTITION --parsable ${ANALYSIS_FN[$index]})
+    >&2 echo "Submitting ${ANALYSIS_FN[$index]}"
   fi
+{% if cache_fn!="" %}
+  if [ $index -eq 0 ]; then
+    CACHE_ID=$(sbatch $PARTITION --parsable ${GEN_ID:+--dependency=afterany:${GEN_ID}_0} $CACHE_FN)
+    echo "$CACHE_ID $CACHE_FN" >> $LEDGER
+  fi
+  DEPENDENCY="${DEPENDENCY:+$DEPENDENCY,}afterany:$CACHE_ID"
+{% endif %}
+  ANLYS_ID=$(sbatch $PARTITION --parsable ${DEPENDENCY:+--dependency=$DEPENDENCY} ${ANALYSIS_FN[$index]})
+  echo "$ANLYS_ID ${ANALYSIS_FN[$index]}" >> $LEDGER
   ANLYS_IDS+=($ANLYS_ID)
 done
 
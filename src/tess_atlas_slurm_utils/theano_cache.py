@@ -0,0 +1,79 @@
+"""This module makes the job that pre-warms a shared Theano compile cache.
+
+Without it, every analysis task compiles the same PyMC/Theano C modules from
+scratch in its own $JOBFS. The cache job analyses one TOI (--quickrun) and
+packs the compiled modules into a tarball in {outdir}/theano_cache, which
+every analysis task then unpacks into its $JOBFS before starting.
+
+The tarball is keyed on the module loads and the python env, so a cache
+built with other compilers/libraries is never reused.
+"""
+import hashlib
+import math
+import os
+from typing import Dict, Optional
+
+from .utils import mem_to_mb
+
+__all__ = ["cache_tarball", "cache_job_settings", "analysis_tmp_mem"]
+
+CACHE_DIR = "theano_cache"
+CACHE_FNAME = "theano_{key}.tar.gz"
+# unpacked size of the compile cache if no tarball exists yet
+DEFAULT_CACHE_MB = 300
+UNPACK_RATIO = 4  # unpacked size ~ UNPACK_RATIO * tarball size
+
+# $TOI is set by the (1 task) array job; the TOI's data is copied from the
+# outdir (made by its generation job) so the warm-up doesn't download it
+WARM_CMD = """WARM_DIR=$JOBFS/theano_warmup
+mkdir -p $WARM_DIR
+cp -r {outdir}/toi_${{TOI}}_files $WARM_DIR/ 2>/dev/null
+{srun} run_toi $TOI --outdir $WARM_DIR --quickrun && \\
+  tar -czf {tarball}.$SLURM_JOB_ID -C $JOBFS --exclude=lock_dir \\
+    .theano_compile && \\
+  mv {tarball}.$SLURM_JOB_ID {tarball}"""
+
+CACHE_JOB_SETTINGS = dict(
+    cpu_per_task=1,
+    time="60:00",
+    jobname="cache",
+    mem="1500MB",
+    tmp_mem="2000M",
+)
+
+
+def cache_key(module_loads: str, load_env: str) -> str:
+    """Version of the compile cache (changes with the modules/python env)"""
+    key = f"{module_loads.strip()}|{load_env.strip()}"
+    return hashlib.sha256(key.encode()).hexdigest()[:12]
+
+
+def cache_tarball(outdir: str, module_loads: str, load_env: str) -> str:
+    """Path to the compile cache tarball for the modules/python env"""
+    fname = CACHE_FNAME.format(key=cache_key(module_loads, load_env))
+    return os.path.join(os.path.abspath(outdir), CACHE_DIR, fname)
+
+
+def cache_job_settings(
+    toi: int, outdir: str, tarball: str, srun: str = "srun"
+) -> Dict:
+    """Slurm file kwargs of the job building the compile cache tarball"""
+    os.makedirs(os.path.dirname(tarball), exist_ok=True)
+    return dict(
+        **CACHE_JOB_SETTINGS,
+        array_job=True,
+        array_args=[toi],
+        command=WARM_CMD.format(
+            outdir=os.path.abspath(outdir), srun=srun, tarball=tarball
+        ),
+    )
+
+
+def analysis_tmp_mem(tmp_mem: Optional[str], tarball: str) -> str:
+    """The analysis tmp_mem plus room for the unpacked compile cache"""
+    if os.path.exists(tarball):
+        cache_mb = UNPACK_RATIO * os.path.getsize(tarball) / 1024**2
+    else:
+        cache_mb = DEFAULT_CACHE_MB
+    base_mb = mem_to_mb(tmp_mem) if tmp_mem else 0
+    return f"{math.ceil(base_mb + cache_mb)}M"
@@ -0,0 +1,176 @@
+"""This module keeps a local cache of the ExoFOP TOI catalogue.
+
+The catalogue is only re-downloaded once the cached copy is older than the
+TTL, and even then the request is conditional (ETag/Last-Modified), so an
+unchanged catalogue costs a single 304 response. In offline mode (e.g. on
+compute nodes without internet) the cached copy is always used, as it is
+when the server is unreachable or doesn't answer within FETCH_TIMEOUT.
+"""
+from __future__ import annotations
+
+import json
+import os
+import shutil
+import socket
+import time
+import urllib.error
+import urllib.request
+from typing import TYPE_CHECKING, Optional, Sequence
+
+from .utils import logger
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+__all__ = ["load_toi_catalogue", "get_catalogue_path", "seed_catalogue_cache"]
+
+TOI_CSV = "https://tess-atlas.github.io/exofop_data/exofop_data.csv"
+LK_AVAIL = "Lightcurve Available"
+TOI_INT = "TOI int"  # 101
+TOI = "TOI"  # 101.01
+DISPOSITION = "TFOPWG Disposition"  # PC, CP, KP, FP, ...
+TESS_MAG = "TESS Mag"
+PERIOD = "Period (days)"
+UPDATED = "Date TOI Updated (UTC)"
+EPOCH = "Epoch (BJD)"
+DURATION = "Duration (hours)"
+DEPTH = "Depth (ppm)"
+SECTORS = "Sectors"
+
+CATALOGUE_DTYPES = {
+    TOI_INT: "Int64",
+    LK_AVAIL: "boolean",
+    DISPOSITION: "string",
+    TESS_MAG: "float64",
+    PERIOD: "float64",
+    UPDATED: "string",
+}
+CATALOGUE_FNAME = "exofop_data.csv"
+CACHE_TTL = 24 * 60 * 60  # seconds
+# (nodes without an outbound route would otherwise hang on the connect)
+FETCH_TIMEOUT = 10  # seconds
+CACHE_DIR_ENV = "TESS_ATLAS_CACHE"  # overrides the default cache dir
+OFFLINE_ENV = "TESS_ATLAS_OFFLINE"  # set to 1 to never hit the network
+DEFAULT_CACHE_DIR = os.path.join("~", ".cache", "tess_atlas_slurm_utils")
+
+
+def __cache_dir(cache_dir: Optional[str] = None) -> str:
+    cache_dir = cache_dir or os.environ.get(CACHE_DIR_ENV, DEFAULT_CACHE_DIR)
+    cache_dir = os.path.expanduser(cache_dir)
+    os.makedirs(cache_dir, exist_ok=True)
+    return cache_dir
+
+
+def __is_offline(offline: Optional[bool]) -> bool:
+    if offline is None:
+        return os.environ.get(OFFLINE_ENV, "0") not in ("", "0")
+    return offline
+
+
+def __read_meta(meta_fname: str) -> dict:
+    if not os.path.exists(meta_fname):
+        return {}
+    with open(meta_fname) as f:
+        return json.load(f)
+
+
+def __write_meta(meta_fname: str, meta: dict):
+    with open(meta_fname, "w") as f:
+        json.dump(meta, f)
+
+
+def get_catalogue_path(
+    url: str = TOI_CSV,
+    cache_dir: Optional[str] = None,
+    ttl: float = CACHE_TTL,
+    offline: Optional[bool] = None,
+    timeout: float = FETCH_TIMEOUT,
+) -> str:
+    """Get the path to a (fresh enough) local copy of the TOI catalogue
+
+    :param url: URL of the catalogue CSV
+    :param cache_dir: Dir for the cache (default: $TESS_ATLAS_CACHE or ~/.cache/tess_atlas_slurm_utils)
+    :param ttl: Seconds before the cached copy is revalidated with the server
+    :param offline: Only use the cached copy (default: $TESS_ATLAS_OFFLINE)
+    :param timeout: Seconds before giving up on the server (the cached copy
+        is then used, if any)
+    """
+    cache_dir = __cache_dir(cache_dir)
+    fname = os.path.join(cache_dir, CATALOGUE_FNAME)
+    meta_fname = fname + ".json"
+    meta = __read_meta(meta_fname)
+    cached = os.path.exists(fname)
+
+    if __is_offline(offline):
+        if not cached:
+            raise FileNotFoundError(
+                f"Offline mode but no cached TOI catalogue at {fname} "
+                "(seed it with seed_catalogue_cache)"
+            )
+        return fname
+
+    same_url = meta.get("url") == url
+    if cached and same_url and time.time() - meta.get("fetched", 0) < ttl:
+        return fname
+
+    request = urllib.request.Request(url)
+    if cached and same_url:
+        if meta.get("etag"):
+            request.add_header("If-None-Match", meta["etag"])
+        if meta.get("last_modified"):
+            request.add_header("If-Modified-Since", meta["last_modified"])
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            tmp_fname = f"{fname}.{os.getpid()}.tmp"
+            try:
+                with open(tmp_fname, "wb") as f:
+                    shutil.copyfileobj(response, f)
+                os.replace(tmp_fname, fname)
+            finally:
+                if os.path.exists(tmp_fname):  # (the download failed)
+                    os.remove(tmp_fname)
+            meta = dict(
+                url=url,
+                etag=response.headers.get("ETag"),
+                last_modified=response.headers.get("Last-Modified"),
+            )
+            logger.info(f"Downloaded TOI catalogue {url} -> {fname}")
+    except urllib.error.HTTPError as e:
+        if e.code != 304:
+            raise
+        logger.info(f"Cached TOI catalogue {fname} is up to date")
+    except (urllib.error.URLError, socket.timeout) as e:
+        if not (cached and same_url):
+            raise
+        logger.warning(f"Using cached TOI catalogue ({url} unreachable: {e})")
+        return fname
+    meta["fetched"] = time.time()
+    __write_meta(meta_fname, meta)
+    return fname
+
+
+def seed_catalogue_cache(
+    src: str, cache_dir: Optional[str] = None, url: str = TOI_CSV
+) -> str:
+    """Seed the catalogue cache with a local copy of the catalogue CSV
+    (e.g. copied over from a login node)"""
+    fname = os.path.join(__cache_dir(cache_dir), CATALOGUE_FNAME)
+    shutil.copyfile(src, fname)
+    __write_meta(fname + ".json", dict(url=url, fetched=time.time()))
+    return fname
+
+
+def load_toi_catalogue(
+    columns: Sequence[str] = (TOI_INT, LK_AVAIL), **kwargs
+) -> pd.DataFrame:
+    """Load the given columns of the (cached) TOI catalogue
+
+    :param columns: Catalogue columns to parse (all others are skipped)
+    :param kwargs: Passed to get_catalogue_path
+    """
+    import pandas as pd
+
+    dtypes = {c: CATALOGUE_DTYPES[c] for c in columns if c in CATALOGUE_DTYPES}
+    return pd.read_csv(
+        get_catalogue_path(**kwargs), usecols=list(columns), dtype=dtypes
+    )
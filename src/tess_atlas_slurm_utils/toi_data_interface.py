@@ -1,42 +1,326 @@
-"""This module interfaces with the TOI data."""
-import glob
+"""This module interfaces with the TOI data.
+
+pandas/NumPy are only imported by the functions that need them (so e.g.
+making the jobs of a single TOI doesn't pay for their import).
+"""
+from __future__ import annotations
+
+import hashlib
 import os
 import re
-from typing import List, Optional, Union
-
-import pandas as pd
+import sqlite3
+from typing import TYPE_CHECKING, List, Optional, Sequence, Set, Tuple, Union
 
+from .toi_catalogue import (
+    DEPTH,
+    DISPOSITION,
+    DURATION,
+    EPOCH,
+    LK_AVAIL,
+    PERIOD,
+    SECTORS,
+    TESS_MAG,
+    TOI,
+    TOI_INT,
+    UPDATED,
+    get_catalogue_path,
+    load_toi_catalogue,
+)
 from .utils import logger
 
-__all__ = ["parse_toi_numbers", "get_unprocessed_toi_numbers"]
+if TYPE_CHECKING:
+    import numpy as np
+    import pandas as pd
 
-TOI_CSV = "https://tess-atlas.github.io/exofop_data/exofop_data.csv"
-LK_AVAIL = "Lightcurve Available"
-TOI_INT = "TOI int"  # 101
+__all__ = [
+    "parse_toi_numbers",
+    "select_toi_numbers",
+    "get_unprocessed_toi_numbers",
+    "get_completed_toi_numbers",
+    "get_delta_toi_numbers",
+    "update_completion_index",
+]
 
+COMPLETION_INDEX = ".completion_index.sqlite"
+TOI_DIR_REGEX = re.compile(r"toi_(\d+)_files$")
+CATALOGUE_SNAPSHOT = ".catalogue_snapshot.sqlite"
+# catalogue fields that change the analysis of a TOI (its planets, their
+# ephemerides and the sectors with data)
+DELTA_FIELDS = (TOI, PERIOD, EPOCH, DURATION, DEPTH, SECTORS)
+Range = Tuple[Optional[float], Optional[float]]  # inclusive (min, max)
 
-def __get_completed_toi_pe_results_paths(outdir: str) -> pd.DataFrame:
-    """Get the paths to the netcdf files for all completed TOIs"""
-    search_path = os.path.join(outdir, "toi_*_files/*.netcdf")
-    netcdf_files = glob.glob(search_path)
-    logger.info(f"Searching {search_path} --> {len(netcdf_files)} files found")
-    regex = "toi_(\d+)_files"
-    tois = [int(re.search(regex, f).group(1)) for f in netcdf_files]
-    return pd.DataFrame(dict(TOI=tois, path=netcdf_files))
 
+def update_completion_index(outdir: str, rescan: bool = False) -> str:
+    """Refresh the completion index (an SQLite file in the outdir) that
+    records the TOI, path, size and mtime of every netcdf result.
 
-def get_unprocessed_toi_numbers(toi_numbers: List, outdir: str) -> List[int]:
-    """Filter toi_numbers to only include those that have not been processed"""
-    processed_tois = set(
-        __get_completed_toi_pe_results_paths(outdir).TOI.values
+    Only the toi_*_files dirs whose mtime changed since the last refresh
+    are listed (with os.scandir), which avoids globbing every TOI dir on
+    each call. Pass rescan=True to rebuild the index from scratch.
+
+    :return: Path to the index
+    """
+    index = os.path.join(outdir, COMPLETION_INDEX)
+    if rescan and os.path.exists(index):
+        os.remove(index)
+    conn = sqlite3.connect(index)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS dirs (TOI INTEGER PRIMARY KEY, "
+        "mtime_ns INTEGER)"
+    )
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS results (TOI INTEGER, path TEXT "
+        "PRIMARY KEY, size INTEGER, mtime_ns INTEGER)"
     )
+    known = dict(conn.execute("SELECT TOI, mtime_ns FROM dirs"))
+    seen, changed = set(), []
+    with os.scandir(outdir) as entries:
+        for entry in entries:
+            match = TOI_DIR_REGEX.match(entry.name)
+            if match is None or not entry.is_dir():
+                continue
+            toi, mtime_ns = int(match.group(1)), entry.stat().st_mtime_ns
+            seen.add(toi)
+            if known.get(toi) != mtime_ns:
+                changed.append((toi, entry.path, mtime_ns))
+    removed = [(toi,) for toi in set(known) - seen]
+    with conn:
+        conn.executemany("DELETE FROM dirs WHERE TOI=?", removed)
+        conn.executemany("DELETE FROM results WHERE TOI=?", removed)
+        for toi, path, mtime_ns in changed:
+            conn.execute("DELETE FROM results WHERE TOI=?", (toi,))
+            conn.executemany(
+                "INSERT INTO results VALUES (?, ?, ?, ?)",
+                __scan_netcdf_files(toi, path),
+            )
+            conn.execute(
+                "INSERT OR REPLACE INTO dirs VALUES (?, ?)", (toi, mtime_ns)
+            )
+    conn.close()
+    logger.info(
+        f"Completion index {index}: {len(changed)} TOI dirs updated, "
+        f"{len(removed)} removed"
+    )
+    return index
+
+
+def __scan_netcdf_files(toi: int, toi_dir: str):
+    with os.scandir(toi_dir) as entries:
+        for entry in entries:
+            if entry.name.endswith(".netcdf") and entry.is_file():
+                stat = entry.stat()
+                yield toi, entry.path, stat.st_size, stat.st_mtime_ns
+
+
+def get_completed_toi_numbers(outdir: str, rescan: bool = False) -> Set[int]:
+    """Get the TOIs with netcdf results in the outdir"""
+    index = update_completion_index(outdir, rescan)
+    with sqlite3.connect(index) as conn:
+        tois = {toi for (toi,) in conn.execute("SELECT TOI FROM results")}
+    conn.close()
+    logger.info(f"{len(tois)} TOIs with netcdf files found in {outdir}")
+    return tois
+
+
+def get_unprocessed_toi_numbers(
+    toi_numbers: List, outdir: str, rescan: bool = False
+) -> List[int]:
+    """Filter toi_numbers to only include those that have not been processed"""
+    processed_tois = get_completed_toi_numbers(outdir, rescan)
     tois = set(toi_numbers)
     return list(tois.difference(processed_tois))
 
 
+def catalogue_row_hashes(
+    fields: Sequence[str] = DELTA_FIELDS, offline: Optional[bool] = None
+) -> pd.Series:
+    """Hash of the catalogue rows (of the given fields) of each TOI
+
+    Fields missing from the catalogue are ignored. The rows are read as
+    strings, so only changes to the catalogue's values change the hashes.
+
+    :return: series of hex digests indexed by the TOI numbers
+    """
+    import pandas as pd
+
+    wanted = {TOI_INT, *fields}
+    data = pd.read_csv(
+        get_catalogue_path(offline=offline),
+        usecols=lambda c: c in wanted,
+        dtype=str,
+        keep_default_na=False,
+    )
+    data[TOI_INT] = pd.to_numeric(data[TOI_INT], errors="coerce")
+    data = data.dropna(subset=[TOI_INT])
+    data = data.sort_values([c for c in data.columns if c != TOI_INT])
+    row_hashes = pd.util.hash_pandas_object(
+        data.drop(columns=TOI_INT), index=False
+    )
+    return row_hashes.groupby(data[TOI_INT].astype(int).to_numpy()).agg(
+        lambda h: hashlib.sha1(h.to_numpy().tobytes()).hexdigest()
+    )
+
+
+def get_delta_toi_numbers(
+    toi_numbers: List,
+    outdir: str,
+    rescan: bool = False,
+    offline: Optional[bool] = None,
+    update: bool = True,
+) -> List[int]:
+    """Filter toi_numbers to those that are not completed yet (e.g. new
+    TOIs), or whose catalogue rows changed since their results were made
+
+    The hash of the catalogue rows (see catalogue_row_hashes) of each
+    completed TOI is kept with the mtime of its results in a snapshot (an
+    SQLite file in the outdir). A TOI's hash is only replaced once its
+    results are newer (it was re-analysed), so a changed TOI stays in the
+    delta until its rerun succeeds. Completed TOIs that aren't in the
+    snapshot yet are only recorded (unless update=False).
+    """
+    index = update_completion_index(outdir, rescan)
+    with sqlite3.connect(index) as conn:
+        results = conn.execute("SELECT TOI, path, mtime_ns FROM results")
+        results = results.fetchall()
+    conn.close()
+    paths, mtimes = {}, {}
+    for toi, path, mtime_ns in results:
+        paths.setdefault(toi, []).append(path)
+        mtimes[toi] = max(mtimes.get(toi, 0), mtime_ns)
+    hashes = catalogue_row_hashes(offline=offline)
+    completed = [int(t) for t in set(toi_numbers) if t in paths]
+    unprocessed = set(toi_numbers).difference(paths)
+
+    snapshot = os.path.join(outdir, CATALOGUE_SNAPSHOT)
+    conn = sqlite3.connect(snapshot)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS analysed (TOI INTEGER PRIMARY KEY, "
+        "hash TEXT, mtime_ns INTEGER)"
+    )
+    analysed = {
+        toi: (h, mtime_ns)
+        for toi, h, mtime_ns in conn.execute("SELECT * FROM analysed")
+    }
+    changed, records = set(), []
+    for toi in completed:
+        if toi not in hashes.index:
+            continue
+        current = hashes[toi]
+        if toi not in analysed:  # (first seen: only recorded)
+            records.append((toi, current, mtimes[toi]))
+            continue
+        previous, analysed_ns = analysed[toi]
+        if previous == current:
+            continue
+        # (rewritten results don't always change the mtime of the TOI dir)
+        mtime_ns = max(__mtime_ns(path) for path in paths[toi])
+        if mtime_ns > analysed_ns:  # re-analysed since its rows changed
+            records.append((toi, current, mtime_ns))
+        else:
+            changed.add(toi)
+    if update:
+        with conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO analysed VALUES (?, ?, ?)", records
+            )
+    conn.close()
+    logger.info(
+        f"Delta: {len(changed)} changed and {len(unprocessed)} not "
+        "completed TOIs"
+    )
+    return sorted(int(toi) for toi in changed.union(unprocessed))
+
+
+def __mtime_ns(path: str) -> int:
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return 0
+
+
+def select_toi_numbers(
+    toi_range: Optional[Range] = None,
+    dispositions: Optional[Sequence[str]] = None,
+    mag_range: Optional[Range] = None,
+    period_range: Optional[Range] = None,
+    updated_since: Optional[str] = None,
+    lk_available: bool = True,
+    offline: Optional[bool] = None,
+) -> np.ndarray:
+    """Select TOIs from the (cached) catalogue
+
+    Ranges are inclusive (min, max) pairs, either of which can be None.
+    Only the columns needed by the filters are parsed.
+
+    :param toi_range: Range of TOI numbers (e.g. (100, 2000))
+    :param dispositions: TFOPWG dispositions to keep (e.g. ["PC", "CP"])
+    :param mag_range: Range of TESS magnitudes
+    :param period_range: Range of periods (days)
+    :param updated_since: Only TOIs updated on/after this date (YYYY-MM-DD)
+    :param lk_available: Only TOIs with an available lightcurve
+    :param offline: Only use the cached catalogue
+    :return: sorted array of the unique TOI numbers
+    """
+    import numpy as np
+    import pandas as pd
+
+    filters = {
+        TOI_INT: toi_range,
+        LK_AVAIL: lk_available or None,
+        DISPOSITION: dispositions,
+        TESS_MAG: mag_range,
+        PERIOD: period_range,
+        UPDATED: updated_since,
+    }
+    columns = [c for c, value in filters.items() if value is not None]
+    data = load_toi_catalogue(
+        columns=list(dict.fromkeys([TOI_INT, *columns])), offline=offline
+    )
+    keep = data[TOI_INT].notna().to_numpy(dtype=bool, copy=True)
+    if lk_available:
+        keep &= data[LK_AVAIL].fillna(False).to_numpy(dtype=bool)
+    if dispositions is not None:
+        wanted = [d.upper() for d in dispositions]
+        disposition = data[DISPOSITION].str.strip().str.upper()
+        keep &= disposition.isin(wanted).fillna(False).to_numpy(dtype=bool)
+    for column in [TOI_INT, TESS_MAG, PERIOD]:
+        if filters[column] is not None:
+            keep &= __in_range(data[column], filters[column])
+    if updated_since is not None:
+        updated = pd.to_datetime(data[UPDATED], errors="coerce", utc=True)
+        since = pd.Timestamp(updated_since, tz="UTC")
+        keep &= (updated >= since).to_numpy()
+    toi_numbers = data[TOI_INT].to_numpy(dtype=float, na_value=np.nan)
+    return np.unique(toi_numbers[keep].astype(int))
+
+
+def __in_range(values: pd.Series, bounds: Range) -> np.ndarray:
+    import numpy as np
+
+    values = values.to_numpy(dtype=float, na_value=np.nan)
+    low, high = bounds
+    keep = ~np.isnan(values)
+    if low is not None:
+        keep &= values >= low
+    if high is not None:
+        keep &= values <= high
+    return keep
+
+
 def parse_toi_numbers(
-    toi_csv: Union[str, None]=None, toi_number: Union[int, None]=None, outdir: str='./'
+    toi_csv: Union[str, None] = None,
+    toi_number: Union[int, None] = None,
+    outdir: str = "./",
+    offline: Optional[bool] = None,
+    **selection,
 ) -> List[int]:
+    """Get the TOI numbers to analyse: from a CSV, a single TOI, or all the
+    TOIs of the catalogue (with lightcurves)
+
+    :param selection: Filters of the catalogue (see select_toi_numbers). If
+        passed with a CSV or a TOI, only the TOIs passing them are kept.
+    """
+    selection = {k: v for k, v in selection.items() if v is not None}
     if (
         toi_csv and toi_number is None
     ):  # get TOI numbers from CSV (gets the latest TOI numbers)
@@ -44,23 +328,24 @@ def parse_toi_numbers(
     elif toi_csv is None and toi_number:  # get single TOI number
         toi_numbers = [toi_number]
     elif toi_csv is None and toi_number is None:  # get all TOIs
-        toi_numbers = __make_toi_csv(os.path.join(outdir, "tois.csv"))
+        import pandas as pd
+
+        toi_numbers = select_toi_numbers(offline=offline, **selection)
+        pd.DataFrame(dict(toi_numbers=toi_numbers)).to_csv(
+            os.path.join(outdir, "tois.csv"), index=False
+        )
+        return toi_numbers.tolist()
     else:
         raise ValueError(f"Cannot pass both toi-csv and toi-number")
+    if selection:
+        import numpy as np
+
+        selected = select_toi_numbers(offline=offline, **selection)
+        toi_numbers = np.intersect1d(toi_numbers, selected).tolist()
     return toi_numbers
 
 
 def __read_csv_toi_numbers(toi_csv: str) -> List[int]:
-    return list(pd.read_csv(toi_csv).toi_numbers.values)
+    import pandas as pd
 
-
-def __make_toi_csv(
-    fname: str, toi_numbers: Optional[List[int]] = []
-) -> List[int]:
-    if len(toi_numbers) == 0:
-        data = pd.read_csv(TOI_CSV)[[TOI_INT, LK_AVAIL]]
-        toi_numbers = data[data[LK_AVAIL] == True][TOI_INT].values
-    toi_numbers = list(set([int(i) for i in toi_numbers]))
-    data = pd.DataFrame(dict(toi_numbers=toi_numbers))
-    data.to_csv(fname, index=False)
-    return __read_csv_toi_numbers(fname)
+    return list(pd.read_csv(toi_csv).toi_numbers.values)
@@ -1,6 +1,9 @@
 import os
+import math
+import sys
 import shutil
 import logging
+from typing import List
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("SLURM-UTILS")
@@ -25,3 +28,99 @@ def mkdir(base, name=None):
         dirname = base
     os.makedirs(dirname, exist_ok=True)
     return newpth
+
+
+def write_if_changed(fname: str, contents: str) -> bool:
+    """Atomically write contents to fname (skipped if already identical)
+
+    :return: True if the file was written
+    """
+    try:
+        if os.path.getsize(fname) == len(contents.encode()):
+            with open(fname) as f:
+                if f.read() == contents:
+                    return False
+    except OSError:  # no file yet
+        pass
+    tmp_fname = f"{fname}.{os.getpid()}.tmp"
+    with open(tmp_fname, "w") as f:
+        f.write(contents)
+    os.replace(tmp_fname, fname)
+    return True
+
+
+def replace_symlink(target: str, link_name: str):
+    """Atomically point link_name to target (a relative link)"""
+    target = os.path.relpath(target, os.path.dirname(link_name))
+    if os.path.islink(link_name) and os.readlink(link_name) == target:
+        return
+    tmp_link = f"{link_name}.{os.getpid()}.tmp"
+    os.symlink(target, tmp_link)
+    os.replace(tmp_link, link_name)
+
+
+def slurm_time_to_minutes(time: str) -> float:
+    """Convert a slurm time (MM, MM:SS, HH:MM:SS, D-HH[:MM[:SS]]) to minutes"""
+    days, _, time = time.rpartition("-")
+    parts = [float(p) for p in time.split(":")]
+    if days:
+        parts += [0] * (3 - len(parts))
+        hrs, mins, secs = parts
+    elif len(parts) == 3:
+        hrs, mins, secs = parts
+    else:
+        hrs, (mins, secs) = 0, (parts + [0])[:2]
+    return float(days or 0) * 24 * 60 + hrs * 60 + mins + secs / 60
+
+
+def minutes_to_slurm_time(minutes: float) -> str:
+    """Convert minutes to a slurm time string (MM:SS), rounding up"""
+    return f"{int(math.ceil(minutes))}:00"
+
+
+def mem_to_mb(mem: str) -> float:
+    """Convert a slurm mem string (e.g. 1500MB, 500M, 2G) to MB"""
+    value = mem.upper().rstrip("B")
+    units = {"K": 1 / 1024, "M": 1, "G": 1024, "T": 1024**2}
+    if value[-1] in units:
+        return float(value[:-1]) * units[value[-1]]
+    return float(value)
+
+
+def dir_size(path: str) -> int:
+    """Total size (bytes) of the files under path"""
+    size = 0
+    for root, _, files in os.walk(path):
+        for f in files:
+            try:
+                size += os.lstat(os.path.join(root, f)).st_size
+            except OSError:  # deleted while walking
+                pass
+    return size
+
+
+def expand_array_task_ids(job_id: str) -> List[str]:
+    """'123_[1-3,7%2]' -> ['123_1', '123_2', '123_3', '123_7']"""
+    array_id, _, spec = job_id.partition("_[")
+    if not spec:
+        return [job_id]
+    task_ids = []
+    for part in spec.rstrip("]").split("%")[0].split(","):
+        first, _, last = part.partition("-")
+        task_ids += range(int(first), int(last or first) + 1)
+    return [f"{array_id}_{i}" for i in task_ids]
+
+
+def get_pyplot():
+    """Import matplotlib.pyplot (only when plotting, as it is slow to import)
+
+    The non-interactive Agg backend is used, unless pyplot was already
+    imported (e.g. in a notebook).
+    """
+    if "matplotlib.pyplot" not in sys.modules:
+        import matplotlib
+
+        matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    return plt
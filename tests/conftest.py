@@ -13,3 +13,112 @@ def __generate_fake_files_for_toi(outdir, toi_int):
 def generate_toi_files(outdir, tois):
     for toi in tois:
         __generate_fake_files_for_toi(outdir, toi)
+
+
+def make_fake_executable(bindir, name, script):
+    """Write an executable called `name` into bindir (put bindir on the PATH to use it)"""
+    os.makedirs(bindir, exist_ok=True)
+    path = os.path.join(bindir, name)
+    with open(path, "w") as f:
+        f.write("#!/bin/bash\n" + script)
+    os.chmod(path, 0o755)
+    return path
+
+
+# Prints an incrementing job ID (from 101) and logs '<job id> <args>'
+# (the lock keeps the IDs unique when jobs are submitted concurrently)
+FAKE_SBATCH = """
+DIR=$(dirname "$0")
+exec 9>"$DIR/lock"
+flock 9
+if [ -f "$DIR/sbatch_hook" ]; then source "$DIR/sbatch_hook"; fi
+N=$(( $(cat "$DIR/jobid" 2>/dev/null || echo 100) + 1 ))
+echo $N > "$DIR/jobid"
+echo "$N $@" >> "$DIR/sbatch.log"
+echo $N
+"""
+
+
+class FakeSlurm:
+    """The fake slurm commands of a bin dir (see the `fake_slurm` fixture)"""
+
+    def __init__(self, bindir):
+        self.bindir = bindir
+        self.sbatch_log = os.path.join(bindir, "sbatch.log")
+
+    def add(self, name, script):
+        """Add (or replace) the fake command `name`"""
+        return make_fake_executable(self.bindir, name, script)
+
+    def fail_sbatch(self, pattern="", message="invalid", once=False):
+        """Make sbatch fail (logging 'failed <args>') when its args match
+        `pattern` (only for the first such call if `once`)"""
+        once = '[ ! -f "$DIR/failed" ]' if once else "true"
+        with open(os.path.join(self.bindir, "sbatch_hook"), "w") as f:
+            f.write(
+                f'if [[ "$*" == *{pattern}* ]] && {once}; then\n'
+                '  touch "$DIR/failed"\n'
+                '  echo "failed $@" >> "$DIR/sbatch.log"\n'
+                f'  >&2 echo "{message}"\n'
+                "  exit 1\n"
+                "fi\n"
+            )
+
+    def sbatch_calls(self):
+        """The (job ID, args) of each sbatch call (job ID 'failed' if the
+        call failed)"""
+        if not os.path.exists(self.sbatch_log):
+            return []
+        with open(self.sbatch_log) as f:
+            return [
+                tuple(line.split(" ", 1)) for line in f.read().splitlines()
+            ]
+
+
+@pytest.fixture
+def fake_slurm(tmpdir, monkeypatch):
+    """Put a bin dir with a fake sbatch first on the PATH"""
+    bindir = str(tmpdir / "bin")
+    make_fake_executable(bindir, "sbatch", FAKE_SBATCH)
+    monkeypatch.setenv("PATH", bindir + os.pathsep + os.environ["PATH"])
+    return FakeSlurm(bindir)
+
+
+def make_jobstats(fake_slurm, tmpdir, jobs):
+    """A jobstats CSV (made by create_slurm_stats_file) of the jobs reported
+    by a fake sacct (as on a cluster, the allocation rows have no MaxRSS:
+    only the batch step of each job reports it)
+
+    :param jobs: (JobID 'A_i', JobName, CPUTimeRAW, State, MaxRSS, ReqMem,
+        AllocCPUS, TOI) of each job (the tasks of each array A in order)
+    """
+    from tess_atlas_slurm_utils.jobstats_collector import (
+        create_slurm_stats_file,
+    )
+
+    rows = ["JobID|JobName|Submit|CPUTimeRAW|State|MaxRSS|ReqMem|AllocCPUS"]
+    tois = {}
+    for job_id, name, cpu_time, state, max_rss, req_mem, cpus, toi in jobs:
+        run = f"2023-01-02T10:00:00|{cpu_time}|{state}"
+        rows += [
+            f"{job_id}|{name}|{run}||{req_mem}|{cpus}",
+            f"{job_id}.batch|batch|{run}|{max_rss}|{req_mem}|{cpus}",
+        ]
+        tois.setdefault(job_id.split("_")[0], []).append(str(toi))
+    fake_slurm.add("sacct", "cat <<'EOF'\n" + "\n".join(rows) + "\nEOF\n")
+    submit_dir = tmpdir.mkdir("jobstats_submit")
+    with open(submit_dir / "submitted_jobs.txt", "w") as ledger:
+        for array_id, array_tois in tois.items():
+            slurm_file = submit_dir / f"slurm_{array_id}.sh"
+            slurm_file.write(f"ARRAY_ARGS=({' '.join(array_tois)})\n")
+            ledger.write(f"{array_id} {slurm_file}\n")
+    fname = str(tmpdir / "jobstats.csv")
+    create_slurm_stats_file(
+        "2023-01-01",
+        "2023-01-05",
+        "user",
+        fname,
+        store=str(tmpdir / "jobstats.sqlite"),
+        submit_dir=str(submit_dir),
+    )
+    return fname
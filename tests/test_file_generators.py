@@ -0,0 +1,30 @@
+import os
+
+from tess_atlas_slurm_utils.file_generators import SlurmFileRenderer
+
+
+def test_renderer_skips_unchanged_files(tmpdir):
+    submit_dir = tmpdir.mkdir("submit")
+    renderer = SlurmFileRenderer(str(tmpdir), "mod 1", str(submit_dir))
+    job = dict(
+        jobname="pe",
+        cpu_per_task=1,
+        time="10:00",
+        mem="100MB",
+        jobid=0,
+        array_job=True,
+        array_args=[1, 2],
+        command="run_toi $TOI",
+    )
+    fname = renderer.write(**job)
+    mtime = os.stat(fname).st_mtime_ns
+    assert renderer.write(**job) == fname
+    assert os.stat(fname).st_mtime_ns == mtime
+    # a new slurm file is made, and the submitted one isn't changed
+    new_fname = renderer.write(**{**job, "array_args": [1, 2, 3]})
+    assert new_fname != fname
+    with open(fname) as f:
+        assert "ARRAY_ARGS=(1 2)" in f.read()
+    with open(submit_dir / "slurm_pe_0_job.sh") as f:
+        assert "ARRAY_ARGS=(1 2 3)" in f.read()
+    assert sorted(os.listdir(submit_dir)) == ["scripts", "slurm_pe_0_job.sh"]
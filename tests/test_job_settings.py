@@ -0,0 +1,55 @@
+import pytest
+from conftest import make_jobstats
+from tess_atlas_slurm_utils.job_settings import (
+    ANALYSIS_JOB_SETTINGS,
+    resolve_job_settings,
+)
+from tess_atlas_slurm_utils.slurm_job_generator import setup_jobs
+
+
+def test_quickrun_settings_dont_leak(tmpdir):
+    kwargs = dict(toi_numbers=[1], module_loads="mod 1", submit=False)
+    setup_jobs(outdir=tmpdir / "quick", clean=True, quickrun=True, **kwargs)
+    setup_jobs(outdir=tmpdir / "full", clean=True, **kwargs)
+    with open(tmpdir / "quick" / "submit" / "slurm_pe_0_job.sh") as f:
+        quick = f.read()
+    with open(tmpdir / "full" / "submit" / "slurm_pe_0_job.sh") as f:
+        full = f.read()
+    assert "--job-name=toi_pe_quickrun" in quick
+    assert "--time=20:00" in quick
+    assert "--job-name=toi_pe\n" in full
+    assert f"--time={ANALYSIS_JOB_SETTINGS['time']}" in full
+    with pytest.raises(TypeError):
+        ANALYSIS_JOB_SETTINGS["time"] = "20:00"
+
+
+def test_settings_right_sized_from_jobstats(tmpdir):
+    jobstats = tmpdir / "jobstats.csv"
+    rows = [
+        f"1_{i},toi_pe,2023-01-01,{60 * (i + 1) * 2},COMPLETED,{i * 1024**2}"
+        for i in range(100)
+    ]
+    rows += ["2_0,toi_pe,2023-01-01,10,TIMEOUT,", "3_0,toi_gen,,1,FAILED,"]
+    jobstats.write(
+        "JobID,JobName,Submit,CPUTimeRAW,State,MaxRSS\n" + "\n".join(rows)
+    )
+    settings = resolve_job_settings("analysis", jobstats=str(jobstats))
+    assert settings["time"] == "115:00"  # p95 (95.05 min) * 1.2
+    assert settings["mem"] == "200MB"
+    assert settings["tmp_mem"] == ANALYSIS_JOB_SETTINGS["tmp_mem"]
+    # not enough history for the other stages/modes
+    quick = resolve_job_settings("analysis", True, jobstats=str(jobstats))
+    assert quick["time"] == "20:00"
+    gen = resolve_job_settings("generation", jobstats=str(jobstats))
+    assert gen["time"] == "20:00"
+
+
+def test_mem_right_sized_from_the_steps_max_rss(tmpdir, fake_slurm):
+    # (sacct leaves the MaxRSS of the allocation rows blank)
+    jobs = [
+        (f"1_{i}", "toi_pe", 600, "COMPLETED", f"{10 * i}M", "1500M", 2, i)
+        for i in range(1, 41)
+    ]
+    jobstats = make_jobstats(fake_slurm, tmpdir, jobs)
+    settings = resolve_job_settings("analysis", jobstats=jobstats)
+    assert settings["mem"] == "500MB"  # p95 (380.5MB) * 1.2
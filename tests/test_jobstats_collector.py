@@ -0,0 +1,178 @@
+import io
+import os
+import sqlite3
+
+import matplotlib
+import pytest
+
+matplotlib.use("Agg")
+
+import pandas as pd
+from tess_atlas_slurm_utils import jobstats_collector
+from tess_atlas_slurm_utils.jobstats_collector import (
+    add_toi_numbers,
+    create_slurm_stats_file,
+    load_slurm_stats,
+    sync_accounting_store,
+)
+from tess_atlas_slurm_utils.jobstats_report import load_accounting_data
+
+parse_sacct = getattr(jobstats_collector, "__slurm_raw_data_to_dataframe")
+
+# (as sacct, MaxRSS is only reported for the steps of the jobs)
+SACCT_ROWS = """1|toi_pe|2023-01-02T10:00:00|3600|COMPLETED|
+1.batch|batch|2023-01-02T10:00:00|3600|COMPLETED|1024K
+1.0|run_toi|2023-01-02T10:00:00|3500|COMPLETED|800K
+2|other_job|2023-01-03T10:00:00|10|FAILED|
+2.batch|batch|2023-01-03T10:00:00|10|FAILED|5G
+3_0|toi_gen|2023-01-10T10:00:00|120|TIMEOUT|
+3_0.batch|batch|2023-01-10T10:00:00|120|CANCELLED|1.5G
+3_1|toi_pe|2023-01-11T10:00:00|0|CANCELLED by 123|
+"""
+
+# Prints the rows submitted in [-S, -E) and logs each call
+FAKE_SACCT = f"""
+echo "$2" >> "$(dirname "$0")/calls.log"
+echo "JobID|JobName|Submit|CPUTimeRAW|State|MaxRSS"
+cat <<'EOF' | awk -F'|' -v s="$2" -v e="$4" 'substr($3,1,10) >= s && substr($3,1,10) < e'
+{SACCT_ROWS}EOF
+"""
+
+
+@pytest.fixture
+def fake_sacct(fake_slurm):
+    fake_slurm.add("sacct", FAKE_SACCT)
+    return os.path.join(fake_slurm.bindir, "calls.log")
+
+
+def __n_calls(log):
+    with open(log) as f:
+        return len(f.readlines())
+
+
+def test_stats_file_is_streamed_and_typed(tmpdir, fake_sacct):
+    fname = str(tmpdir / "jobstats.csv")
+    create_slurm_stats_file(
+        "2023-01-01", "2023-01-31", "user", fname, store=str(tmpdir / "db")
+    )
+    data = load_slurm_stats(fname)
+    assert list(data.JobName) == ["toi_pe", "toi_gen", "toi_pe"]
+    assert data.CPUTimeRAW.dtype == "float64"
+    assert data.State.dtype == "category"
+    assert data.MaxRSS.iloc[0] == 1024**2
+    assert data.MaxRSS.iloc[1] == 1.5 * 1024**3
+    assert pd.isna(data.MaxRSS.iloc[2])  # (no steps)
+    assert os.path.isfile(str(tmpdir / "jobstats.png"))
+
+
+def test_steps_split_across_chunks_and_per_cpu_req_mem():
+    sacct = io.StringIO(
+        "JobID|JobName|MaxRSS|ReqMem|AllocCPUS\n"
+        "1_0|toi_pe||1000Mc|2\n"
+        "1_0.batch|batch|10M|1000Mc|2\n"
+        "1_0.0|run_toi|30M|1000Mc|2\n"
+        "1_1|toi_pe||1500Mn|2\n"
+        "1_1.batch|batch|20M|1500Mn|2\n"
+    )
+    chunks = list(parse_sacct(sacct, chunksize=2))
+    data = pd.concat(chunks, ignore_index=True)
+    assert list(data.JobID) == ["1_0", "1_1"]
+    assert list(data.MaxRSS / 1024**2) == [30, 20]
+    assert list(data.ReqMem / 1024**2) == [2000, 1500]
+
+
+def test_accounting_store_only_fetches_missing_shards(tmpdir, fake_sacct):
+    store = str(tmpdir / "jobstats.sqlite")
+    n = sync_accounting_store("2023-01-01", "2023-01-14", "user", store, 7)
+    assert n == 2
+    assert __n_calls(fake_sacct) == 2
+    # second run: nothing new to fetch
+    assert sync_accounting_store("2023-01-01", "2023-01-14", "user", store) == 0
+    # extending the range only fetches the new shard
+    n = sync_accounting_store("2023-01-01", "2023-01-21", "user", store, 7)
+    assert n == 1
+    assert __n_calls(fake_sacct) == 3
+
+
+def test_shards_of_older_stores_are_refetched(tmpdir, fake_sacct):
+    store = str(tmpdir / "jobstats.sqlite")
+    sync_accounting_store("2023-01-01", "2023-01-05", "user", store)
+    with sqlite3.connect(store) as conn:  # (rows fetched with sacct -X)
+        conn.execute("UPDATE jobs SET MaxRSS = NULL")
+        conn.execute("PRAGMA user_version = 0")
+    conn.close()
+    assert sync_accounting_store("2023-01-01", "2023-01-05", "user", store)
+    assert list(load_accounting_data(store).MaxRSS) == [1024**2]
+    assert not sync_accounting_store("2023-01-01", "2023-01-05", "user", store)
+
+
+def test_refetched_shard_replaces_pending_array_rows(tmpdir, fake_slurm):
+    # the tasks of array job 5 are pending, then ran
+    fake_slurm.add(
+        "sacct",
+        'echo "JobID|JobName|Submit|CPUTimeRAW|State|MaxRSS"\n'
+        'if [ -f "$0.seen" ]; then\n'
+        '  echo "5_1|toi_pe|2023-01-02T10:00:00|60|TIMEOUT|"\n'
+        '  echo "5_2|toi_pe|2023-01-02T10:00:00|60|COMPLETED|"\n'
+        "else\n"
+        '  echo "5_[1-2]|toi_pe|2023-01-02T10:00:00|0|PENDING|"\n'
+        "fi\n"
+        'touch "$0.seen"\n',
+    )
+    store = str(tmpdir / "jobstats.sqlite")
+    for _ in range(2):
+        sync_accounting_store("2023-01-01", "2023-01-05", "user", store)
+    data = load_accounting_data(store, user="user")
+    assert sorted(zip(data.JobID, data.State)) == [
+        ("5_1", "TIMEOUT"),
+        ("5_2", "COMPLETED"),
+    ]
+
+
+def test_toi_numbers_added_from_submitted_jobs(tmpdir, fake_sacct):
+    submit_dir = tmpdir.mkdir("submit")
+    (submit_dir / "slurm_pe_0_job.sh").write("#!/bin/bash\nARRAY_ARGS=(7 8)\n")
+    (submit_dir / "submitted_jobs.txt").write(
+        f"3 {submit_dir / 'slurm_pe_0_job.sh'}\n"
+    )
+    fname = str(tmpdir / "jobstats.csv")
+    create_slurm_stats_file(
+        "2023-01-01",
+        "2023-01-31",
+        "user",
+        fname,
+        store=str(tmpdir / "db"),
+        submit_dir=str(submit_dir),
+    )
+    data = load_slurm_stats(fname)
+    assert list(data.TOI.astype(object).fillna(-1)) == [-1, 7, 8]
+
+
+def test_pending_array_tasks_are_expanded():
+    stats = pd.DataFrame(
+        dict(JobID=["5_0", "5_[1-2,4%2]"], CPUTimeRAW=[10.0, 0.0])
+    )
+    task_map = pd.DataFrame(
+        dict(ArrayJobID="5", TaskID=[0, 1, 2, 3, 4], TOI=[10, 11, 12, 13, 14])
+    )
+    stats = add_toi_numbers(stats, task_map)
+    assert list(stats.JobID) == ["5_0", "5_1", "5_2", "5_4"]
+    assert list(stats.TOI) == [10, 11, 12, 14]
+
+
+def test_store_keeps_the_jobs_of_each_user(tmpdir, fake_slurm):
+    fake_slurm.add(  # each user has one job (named after them)
+        "sacct",
+        'echo "JobID|JobName|Submit|CPUTimeRAW|State|MaxRSS"\n'
+        'echo "${6}_1|toi_$6|2023-01-02T10:00:00|10|COMPLETED|"\n',
+    )
+    store = str(tmpdir / "jobstats.sqlite")
+    for user in ["alice", "bob"]:
+        fname = str(tmpdir / f"{user}.csv")
+        create_slurm_stats_file(
+            "2023-01-01", "2023-01-05", user, fname, store=store
+        )
+        assert list(load_slurm_stats(fname).JobID) == [f"{user}_1"]
+    bob = load_accounting_data(store, user="bob")
+    assert list(bob.JobID) == ["bob_1"]
+    assert len(load_accounting_data(store)) == 2
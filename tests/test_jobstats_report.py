@@ -0,0 +1,93 @@
+import json
+import sqlite3
+
+import matplotlib
+import pandas as pd
+
+matplotlib.use("Agg")
+
+from tess_atlas_slurm_utils.jobstats_collector import (
+    SACCT_DTYPES,
+    sync_accounting_store,
+)
+from tess_atlas_slurm_utils.jobstats_report import (
+    load_accounting_data,
+    plot_report,
+    save_report,
+    summarise_jobstats,
+)
+
+HR = 3600.0
+GB = 1024.0**3
+JOBS = pd.DataFrame(
+    dict(
+        JobID=["1_0", "1_1", "1_2", "2_0"],
+        JobName=["toi_pe", "toi_pe", "toi_pe", "toi_gen"],
+        Submit=[
+            "2023-01-02T10:00:00",
+            "2023-01-02T10:00:00",
+            "2023-01-02T10:00:00",
+            "2023-01-10T10:00:00",
+        ],
+        CPUTimeRAW=[2 * HR, 4 * HR, 10 * HR, 1 * HR],
+        State=["COMPLETED", "COMPLETED", "TIMEOUT", "OUT_OF_MEMORY"],
+        MaxRSS=[0.5 * GB, 1.0 * GB, 1.0 * GB, 1.0 * GB],
+        ReqMem=[1.0 * GB, 1.0 * GB, 1.0 * GB, 1.0 * GB],
+        AllocCPUS=[2, 2, 2, 1],
+    )
+).astype(SACCT_DTYPES)
+
+
+def test_summary_tables(tmpdir):
+    summary = summarise_jobstats(JOBS)
+    totals = summary["totals"].iloc[0]
+    assert totals.cpu_hrs == 17
+    assert totals.wasted_cpu_hrs == 11
+    assert summary["by_state"].loc["COMPLETED"].cpu_hrs == 6
+    assert summary["by_array"].loc[("1", "toi_pe")].n_failed == 1
+    runtimes = summary["runtime_percentiles"].loc["toi_pe"]
+    assert (runtimes.p50_hrs, runtimes.max_hrs) == (1.5, 2)
+    assert summary["mem_efficiency"].loc["toi_pe"].efficiency_median == 1
+    failures = summary["failures_over_time"]
+    assert list(failures.n_jobs) == [3, 1]
+    assert list(failures.oom_fraction) == [0, 1]
+
+    prefix = str(tmpdir / "jobstats")
+    with open(save_report(summary, prefix)) as f:
+        saved = json.load(f)
+    assert saved["totals"]["n_failed"] == 2
+    assert len(saved["by_array"]) == 2
+    plot_report(summary, f"{prefix}_report.png")
+
+
+def test_old_store_is_migrated(tmpdir, monkeypatch):
+    store = str(tmpdir / "jobstats.sqlite")
+    with sqlite3.connect(store) as conn:
+        conn.execute(
+            "CREATE TABLE jobs (JobID TEXT PRIMARY KEY, JobName TEXT, "
+            "Submit TEXT, CPUTimeRAW REAL, State TEXT, MaxRSS REAL)"
+        )
+        conn.execute(
+            "CREATE TABLE shards (user TEXT, start TEXT, end TEXT, "
+            "fetched TEXT, closed INTEGER, PRIMARY KEY (user, start, end))"
+        )
+        conn.execute(
+            "INSERT INTO jobs VALUES "
+            "('1', 'toi_pe', '2023-01-02T10:00:00', 10, 'COMPLETED', 1)"
+        )
+        conn.execute(
+            "INSERT INTO shards VALUES "
+            "('user', '2023-01-01', '2023-01-02', '', 1)"
+        )
+    data = load_accounting_data(store)
+    assert data.ReqMem.isna().all()  # old store: not migrated on read
+
+    monkeypatch.setenv("PATH", "")  # no sacct: the shard re-fetch fails
+    try:
+        sync_accounting_store("2023-01-01", "2023-01-01", "user", store)
+    except FileNotFoundError:
+        pass
+    with sqlite3.connect(store) as conn:
+        closed = conn.execute("SELECT closed FROM shards").fetchall()
+    assert closed == [(0,)]
+    assert load_accounting_data(store).JobID.tolist() == ["1"]
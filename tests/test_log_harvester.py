@@ -0,0 +1,89 @@
+import os
+
+import pytest
+from tess_atlas_slurm_utils import log_harvester
+from tess_atlas_slurm_utils.log_harvester import (
+    harvest_logs,
+    load_log_index,
+    summarise_failures,
+)
+
+TRACEBACK = """Sampling: 100%
+Traceback (most recent call last):
+  File "/home/user/run_toi.py", line 10, in <module>
+    run()
+ValueError: bad value {value} in /fred/toi_{toi}/data.csv
+"""
+TIMEOUT = """Sampling: 12%
+slurmstepd: error: *** JOB 100 ON john5 CANCELLED AT 2023-01-01T10:00:00 DUE TO TIME LIMIT ***
+"""
+OOM = """Downloading lightcurve
+slurmstepd: error: Detected 1 oom_kill event in StepId=99.batch.
+"""
+LOGS = {
+    "log_pe/pe_100_0.log": "Sampling: 100%\nSaved netcdf\n",
+    "log_pe/pe_100_1.log": TRACEBACK.format(value=3.2, toi=12),
+    "log_pe/pe_100_2.log": TRACEBACK.format(value=5.1, toi=13),
+    "log_pe/pe_100_3.log": TIMEOUT,
+    "log_gen/gen_99_0.log": OOM,
+    # a bundled task: TOI 21 finished, 22 failed
+    "log_pe/pe_101_0.log": TRACEBACK.format(value=1, toi=22),
+    "log_pe/pe_101_0.exit_codes": "21 0\n22 1\n",
+}
+SLURM_FILES = {
+    "100": "ARRAY_ARGS=(11 12 13 14)\n",
+    "99": "ARRAY_ARGS=(11 12 13 14)\n",
+    "101": "ARRAY_ARGS=(21 22)\nBUNDLE_SIZE=2\n",
+}
+
+
+@pytest.fixture
+def outdir(tmpdir):
+    for path, txt in LOGS.items():
+        tmpdir.ensure(path).write(txt)
+    submit_dir = tmpdir.mkdir("submit")
+    with open(submit_dir / "submitted_jobs.txt", "w") as ledger:
+        for job_id, txt in SLURM_FILES.items():
+            (submit_dir / f"slurm_{job_id}_job.sh").write(txt)
+            ledger.write(f"{job_id} {submit_dir / f'slurm_{job_id}_job.sh'}\n")
+    return tmpdir
+
+
+def test_failures_grouped_by_signature(outdir, monkeypatch):
+    monkeypatch.setattr(log_harvester, "MIN_POOL_SIZE", 0)
+    logs = load_log_index(harvest_logs(str(outdir), max_workers=2))
+    status = logs.set_index(["stage", "toi"]).status
+    assert status[("pe", 11)] == "ok"
+    assert status[("pe", 14)] == "timeout"
+    assert status[("gen", 11)] == "oom"
+    assert status[("pe", 21)] == "ok"  # (from the bundle's exit codes)
+    assert status[("pe", 22)] == "error"
+    last_line = logs.set_index(["stage", "toi"]).last_line
+    assert last_line[("pe", 11)] == "Saved netcdf"
+    assert last_line[("pe", 12)] == "Sampling: 100%"
+
+    failures = summarise_failures(logs)
+    signature = "ValueError: bad value <n> in <path>"
+    assert failures.index[0] == signature
+    assert failures.loc[signature, "n_logs"] == 3
+    assert failures.loc[signature, "tois"] == "12 13 22"
+    assert failures.n_tois.sum() == 5
+
+
+def test_harvest_is_incremental(outdir, monkeypatch):
+    harvest_logs(str(outdir), max_workers=1)
+    parsed = []
+    monkeypatch.setattr(
+        log_harvester,
+        "parse_log",
+        lambda path: parsed.append(path) or dict(
+            status="ok", signature=None, last_line="fixed"
+        ),
+    )
+    # only the changed log is parsed again, and removed logs are dropped
+    (outdir / "log_pe" / "pe_100_3.log").write("Sampling: 100%\nretried\n")
+    os.remove(outdir / "log_gen" / "gen_99_0.log")
+    logs = load_log_index(harvest_logs(str(outdir), max_workers=1))
+    assert parsed == [str(outdir / "log_pe" / "pe_100_3.log")]
+    assert "gen" not in set(logs.stage)
+    assert set(summarise_failures(logs).statuses) == {"error"}
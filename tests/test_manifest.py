@@ -0,0 +1,83 @@
+import json
+import os
+import sqlite3
+
+import pytest
+
+from tess_atlas_slurm_utils.jobstats_collector import load_array_task_map
+from tess_atlas_slurm_utils.manifest import MANIFEST, task_tois
+from tess_atlas_slurm_utils.slurm_job_generator import setup_jobs
+
+
+@pytest.fixture(autouse=True)
+def small_batches(monkeypatch):
+    monkeypatch.setattr(
+        "tess_atlas_slurm_utils.slurm_job_generator.MAX_ARRAY_SIZE", 2
+    )
+
+
+def make_jobs(outdir, toi_numbers, submit):
+    setup_jobs(
+        toi_numbers=toi_numbers,
+        outdir=outdir,
+        module_loads="mod 1",
+        submit=submit,
+        clean=True,
+    )
+
+
+def test_unchanged_batches_are_not_rewritten(tmpdir, fake_slurm):
+    outdir = str(tmpdir / "out")
+    submit_dir = os.path.join(outdir, "submit")
+    make_jobs(outdir, [1, 2, 3, 4], submit=True)
+    first_pe = os.path.realpath(os.path.join(submit_dir, "slurm_pe_1_job.sh"))
+    make_jobs(outdir, [1, 2, 5], submit=False)
+    # batch 0 is unchanged, batch 1 gets a new slurm file
+    assert len(os.listdir(os.path.join(submit_dir, "scripts"))) == 6
+    new_pe = os.path.realpath(os.path.join(submit_dir, "slurm_pe_1_job.sh"))
+    assert new_pe != first_pe
+    with open(first_pe) as f:
+        assert "ARRAY_ARGS=(3 4)" in f.read()
+
+    with sqlite3.connect(os.path.join(submit_dir, MANIFEST)) as conn:
+        generations = conn.execute(
+            "SELECT n_scripts, n_new FROM generations"
+        ).fetchall()
+    conn.close()
+    assert generations == [(4, 4), (4, 2)]
+
+    # the TOIs of the submitted array tasks, from the manifest
+    with open(os.path.join(submit_dir, "submitted_jobs.txt")) as f:
+        job_ids = {
+            os.path.realpath(fn): job_id for job_id, fn in map(str.split, f)
+        }
+    assert task_tois(submit_dir, job_ids[first_pe], 1) == [4]
+    task_map = load_array_task_map(submit_dir)
+    assert len(task_map) == 8  # (gen + pe tasks of the 4 TOIs)
+    first_pe_tasks = task_map[task_map.ArrayJobID == job_ids[first_pe]]
+    assert sorted(first_pe_tasks.TOI) == [3, 4]
+
+
+def test_queued_jobs_are_not_resubmitted(tmpdir, fake_slurm):
+    outdir = str(tmpdir / "out")
+    submit_dir = os.path.join(outdir, "submit")
+    make_jobs(outdir, [1, 2, 3, 4], submit=True)
+    # only the jobs of batch 0 are still queued
+    batch_0 = []
+    for job_id, args in fake_slurm.sbatch_calls():
+        with open(args.split()[-1]) as slurm_file:
+            if "ARRAY_ARGS=(1 2)" in slurm_file.read():
+                batch_0.append(job_id)
+    fake_slurm.add("squeue", f"echo {' '.join(batch_0)}\n")
+    n_calls = len(fake_slurm.sbatch_calls())
+    make_jobs(outdir, [1, 2, 3, 4], submit=True)
+
+    resubmitted = fake_slurm.sbatch_calls()[n_calls:]
+    assert len(resubmitted) == 2  # (gen + pe of batch 1)
+    records = sorted(
+        f for f in os.listdir(submit_dir) if f.startswith("submission_")
+    )
+    with open(os.path.join(submit_dir, records[-1])) as f:
+        batches = json.load(f)["batches"]
+    reused = [batches[0][job]["job_id"] for job in ["generation", "analysis"]]
+    assert sorted(reused) == sorted(batch_0)
@@ -0,0 +1,95 @@
+import os
+
+import pytest
+from tess_atlas_slurm_utils.monitor import (
+    SubmissionMonitor,
+    load_submission_record,
+)
+from tess_atlas_slurm_utils.slurm_job_generator import setup_jobs
+from tess_atlas_slurm_utils.submission import submit_jobs
+from conftest import generate_toi_files
+
+# gen job 101 is done, analysis job 102 has 1 failed, 1 running, 2 pending
+FAKE_SQUEUE = """
+echo "squeue $@" >> "$(dirname "$0")/calls.log"
+echo "102_[2-3]|PENDING"
+echo "102_1|RUNNING"
+"""
+FAKE_SACCT = """
+echo "sacct $@" >> "$(dirname "$0")/calls.log"
+for i in 0 1 2 3; do echo "101_$i|COMPLETED"; done
+echo "102_0|FAILED"
+echo "102_1|RUNNING"
+echo "102_[2-3]|PENDING"
+"""
+
+
+@pytest.fixture
+def submitted_outdir(tmpdir, fake_slurm):
+    fake_slurm.add("squeue", FAKE_SQUEUE)
+    fake_slurm.add("sacct", FAKE_SACCT)
+    outdir = str(tmpdir / "out")
+    setup_jobs(
+        toi_numbers=[1, 2, 3, 4],
+        outdir=outdir,
+        module_loads="mod 1",
+        submit=False,
+        clean=True,
+    )
+    submit_dir = os.path.join(outdir, "submit")
+    submit_jobs(
+        [os.path.join(submit_dir, "slurm_gen_0_job.sh")],
+        [os.path.join(submit_dir, "slurm_pe_0_job.sh")],
+        submit_dir,
+    )
+    return outdir, os.path.join(fake_slurm.bindir, "calls.log")
+
+
+def test_monitor_counts_tasks(submitted_outdir):
+    outdir, calls_log = submitted_outdir
+    record = load_submission_record(os.path.join(outdir, "submit"))
+    monitor = SubmissionMonitor(record, outdir)
+    generate_toi_files(outdir, [2])
+
+    summary = monitor.poll()
+    assert summary.loc["101"].completed == 4
+    anlys = summary.loc["102"]
+    assert (anlys.pending, anlys.running, anlys.failed) == (2, 1, 1)
+    assert anlys.n_tasks == 4
+    progress = monitor.progress()
+    assert (progress["completed"], progress["total"]) == (1, 4)
+
+    # nothing left the queue: sacct isn't called again
+    monitor.poll()
+    with open(calls_log) as f:
+        calls = [c.split()[0] for c in f.read().splitlines()]
+    assert calls == ["squeue", "sacct", "squeue"]
+
+
+def test_monitor_waits_for_final_sacct_states(
+    submitted_outdir, fake_slurm, monkeypatch
+):
+    outdir, _ = submitted_outdir
+    # the queue is empty, but slurmdbd still reports job 102 as running
+    fake_slurm.add("squeue", 'echo "squeue" >> "$0.log"\n')
+    fake_slurm.add(
+        "sacct",
+        'echo "sacct" >> "$0.log"\n'
+        'STATE=$([ -f "$0.seen" ] && echo COMPLETED || echo RUNNING)\n'
+        'touch "$0.seen"\n'
+        'for i in 0 1 2 3; do echo "101_$i|COMPLETED"; done\n'
+        'for i in 0 1 2 3; do echo "102_$i|$STATE"; done\n',
+    )
+    sleeps = []
+
+    def sleep(seconds):
+        sleeps.append(seconds)
+        assert len(sleeps) < 5, "the monitor never finished"
+
+    monkeypatch.setattr("tess_atlas_slurm_utils.monitor.time.sleep", sleep)
+    record = load_submission_record(os.path.join(outdir, "submit"))
+    summary = SubmissionMonitor(record, outdir).run(min_interval=0)
+    assert summary.loc["102"].completed == 4
+    assert len(sleeps) == 1
+    with open(os.path.join(fake_slurm.bindir, "sacct.log")) as f:
+        assert len(f.read().splitlines()) == 2
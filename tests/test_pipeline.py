@@ -0,0 +1,108 @@
+import json
+import os
+
+import pytest
+
+from tess_atlas_slurm_utils.pipeline import Pipeline, Stage
+from tess_atlas_slurm_utils.slurm_job_generator import (
+    setup_jobs,
+    standard_stages,
+)
+
+SETTINGS = dict(cpu_per_task=1, time="10:00", mem="500MB")
+
+
+def post_stages(outdir):
+    return standard_stages(outdir, generation_throttle=5) + [
+        Stage("post", "srun post $TOI", SETTINGS, after={"pe": "aftercorr"}),
+        Stage(
+            "catalogue",
+            "srun catalogue",
+            SETTINGS,
+            after={"post": "afterany"},
+            per_toi=False,
+            singleton=True,
+        ),
+    ]
+
+
+def test_order(tmpdir):
+    stages = post_stages(str(tmpdir))[::-1]
+    names = [s.name for s in Pipeline(stages).order()]
+    assert names == ["gen", "pe", "post", "catalogue"]
+
+    stages[-1].after = {"catalogue": "afterok"}  # gen after catalogue
+    with pytest.raises(ValueError, match="cycle"):
+        Pipeline(stages).order()
+    with pytest.raises(ValueError, match="unknown stage"):
+        Pipeline(stages[:1])
+    with pytest.raises(ValueError, match="per-TOI"):
+        Stage("x", "cmd", SETTINGS, after={"y": "aftercorr"}, per_toi=False)
+
+
+def test_pipeline_submission(tmpdir, fake_slurm, monkeypatch):
+    monkeypatch.setattr(
+        "tess_atlas_slurm_utils.slurm_job_generator.MAX_ARRAY_SIZE", 2
+    )
+    outdir = str(tmpdir / "out")
+    setup_jobs(
+        toi_numbers=[1, 2, 3],
+        outdir=outdir,
+        module_loads="mod 1",
+        submit=True,
+        clean=True,
+        stages=post_stages(outdir),
+    )
+    submit_dir = os.path.join(outdir, "submit")
+    with open(os.path.join(submit_dir, "slurm_gen_1_job.sh")) as f:
+        assert "#SBATCH --array=0-0%5" in f.read()
+    with open(os.path.join(submit_dir, "submit.sh")) as f:
+        assert "--dependency=afterany:${JOB_4}:${JOB_5},singleton" in f.read()
+
+    (record,) = [
+        f for f in os.listdir(submit_dir) if f.startswith("submission_")
+    ]
+    with open(os.path.join(submit_dir, record)) as f:
+        jobs = {(j["stage"], j["batch"]): j for j in json.load(f)["jobs"]}
+    assert len(jobs) == 7  # gen/pe/post for each of the 2 batches + 1
+    for batch in [0, 1]:
+        gen_id = jobs[("gen", batch)]["job_id"]
+        assert jobs[("gen", batch)]["dependency"] is None
+        assert jobs[("pe", batch)]["dependency"] == f"aftercorr:{gen_id}"
+    post_ids = [jobs[("post", b)]["job_id"] for b in [0, 1]]
+    assert jobs[("catalogue", None)]["dependency"] == (
+        f"afterany:{':'.join(post_ids)},singleton"
+    )
+
+    calls = dict(fake_slurm.sbatch_calls())
+    gen_call = calls[jobs[("gen", 0)]["job_id"]]
+    gen_fn = os.path.realpath(os.path.join(submit_dir, "slurm_gen_0_job.sh"))
+    assert gen_call.endswith(f"--partition=datamover {gen_fn}")
+
+
+def test_failed_pipeline_submission_records_submitted_jobs(
+    tmpdir, fake_slurm
+):
+    fake_slurm.fail_sbatch("slurm_post_")
+    outdir = str(tmpdir / "out")
+    with pytest.raises(RuntimeError, match="Failed to submit 1 jobs"):
+        setup_jobs(
+            toi_numbers=[1, 2, 3],
+            outdir=outdir,
+            module_loads="mod 1",
+            submit=True,
+            clean=True,
+            stages=post_stages(outdir),
+        )
+    submit_dir = os.path.join(outdir, "submit")
+    (record,) = [
+        f for f in os.listdir(submit_dir) if f.startswith("submission_")
+    ]
+    with open(os.path.join(submit_dir, record)) as f:
+        record = json.load(f)
+    # the catalogue job (downstream of the post job) isn't submitted
+    assert [j["stage"] for j in record["jobs"]] == ["gen", "pe"]
+    assert "invalid" in record["errors"][0]
+    with open(os.path.join(submit_dir, "submitted_jobs.txt")) as f:
+        ledger = [line.split()[0] for line in f]
+    assert ledger == [j["job_id"] for j in record["jobs"]]
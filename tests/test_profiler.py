@@ -0,0 +1,47 @@
+import os
+import sys
+
+import pandas as pd
+from tess_atlas_slurm_utils.jobstats_collector import (
+    load_profiling_log,
+    merge_profiling_log,
+)
+from tess_atlas_slurm_utils.profiler import profile, profile_command
+
+# allocates ~50MB and writes a 1MB file to $JOBFS
+FAKE_TOI_CMD = (
+    "import os; x = bytearray(50 * 1024**2); "
+    "open(os.path.join(os.environ['JOBFS'], 'f'), 'wb').write(bytes(1024**2))"
+)
+
+
+def test_profile_command_runs_inside_srun():
+    cmd = profile_command(
+        "srun --exact --ntasks=1 run_toi $TOI --outdir out", "pe", "p.jsonl"
+    )
+    assert cmd.startswith("srun --exact --ntasks=1 python -m ")
+    assert cmd.endswith("--log p.jsonl -- run_toi $TOI --outdir out")
+
+
+def test_profiler_log_merges_with_stats(tmpdir, monkeypatch):
+    monkeypatch.setenv("JOBFS", str(tmpdir.mkdir("jobfs")))
+    monkeypatch.setenv("SLURM_ARRAY_JOB_ID", "123")
+    monkeypatch.setenv("SLURM_ARRAY_TASK_ID", "0")
+    log = str(tmpdir / "profiling.jsonl")
+    for toi in [101, 102]:
+        cmd = [sys.executable, "-c", FAKE_TOI_CMD]
+        assert profile(cmd, toi, "pe", log, interval=0.05) == 0
+    assert profile([sys.executable, "-c", "exit(3)"], 103, "pe", log) == 3
+
+    profiling = load_profiling_log(log)
+    assert len(profiling) == 3
+    assert (profiling.PeakRSS.iloc[:2] > 50 * 1024**2).all()
+    assert (profiling.JobFSEnd.iloc[:2] >= 1024**2).all()
+
+    stats = pd.DataFrame(
+        dict(JobID=["123_0", "123_0"], TOI=[101, 102], State="COMPLETED")
+    )
+    merged = merge_profiling_log(stats, profiling)
+    assert len(merged) == 2
+    assert merged.WallTime.notna().all()
+    assert list(merged.Host.unique()) == [os.uname().nodename]
@@ -0,0 +1,68 @@
+import os
+
+import pytest
+from tess_atlas_slurm_utils.resubmission import (
+    ANALYSIS_JOB_SETTINGS,
+    classify_tois,
+    get_resubmission_groups,
+    resubmit,
+)
+from tess_atlas_slurm_utils.utils import mem_to_mb, slurm_time_to_minutes
+from conftest import generate_toi_files
+
+JOBSTATS = """JobID,JobName,Submit,CPUTimeRAW,State,MaxRSS,TOI
+1_0,toi_pe,2023-01-01,100,COMPLETED,,1
+1_1,toi_pe,2023-01-01,36000,TIMEOUT,,2
+1_2,toi_pe,2023-01-01,100,OUT_OF_MEMORY,,3
+1_3,toi_pe,2023-01-01,100,FAILED,,4
+1_4,toi_pe,2023-01-01,100,TIMEOUT,,5
+2_0,toi_pe,2023-01-02,0,RUNNING,,5
+1_5,toi_pe,2023-01-01,0,TIMEOUT,,6
+3_0,toi_pe,2023-01-03,0,TIMEOUT,,6
+4_0,toi_pe,2023-01-04,0,TIMEOUT,,6
+"""
+
+
+@pytest.fixture
+def jobstats(tmpdir):
+    fname = tmpdir / "jobstats.csv"
+    fname.write(JOBSTATS)
+    return str(fname)
+
+
+def test_classify_tois(tmpdir, jobstats):
+    generate_toi_files(tmpdir, [1])
+    classes = classify_tois([1, 2, 3, 4, 5, 6, 7], tmpdir, jobstats)
+    assert list(classes.status) == [
+        "completed",
+        "timeout",
+        "oom",
+        "failed",
+        "running",
+        "timeout",
+        "new",
+    ]
+    assert classes.loc[6].attempts == 3
+
+
+def test_resubmission_escalates_resources(tmpdir, jobstats):
+    generate_toi_files(tmpdir, [1])
+    classes = classify_tois([1, 2, 3, 4, 5, 6, 7], tmpdir, jobstats)
+    groups = get_resubmission_groups(classes, max_retries=3)
+    tois = {toi: resources for resources, group in groups for toi in group}
+    assert set(tois) == {2, 3, 4, 7}  # 6 already had 3 attempts
+    base_time = slurm_time_to_minutes(ANALYSIS_JOB_SETTINGS["time"])
+    base_mem = mem_to_mb(ANALYSIS_JOB_SETTINGS["mem"])
+    assert slurm_time_to_minutes(tois[2]["time"]) == pytest.approx(
+        base_time * 1.5, abs=1
+    )
+    assert mem_to_mb(tois[3]["mem"]) == pytest.approx(base_mem * 1.5, abs=1)
+    assert tois[4] == tois[7]
+
+
+def test_resubmit_makes_jobs(tmpdir, jobstats):
+    resubmit(tmpdir, jobstats, module_loads="mod 1")
+    submit_dir = tmpdir / "submit"
+    assert os.path.isfile(submit_dir / "submit.sh")
+    # the timeout, oom and failed TOIs each need different resources
+    assert len([f for f in os.listdir(submit_dir) if "pe" in f]) == 3
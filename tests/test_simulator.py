@@ -0,0 +1,88 @@
+import pytest
+from conftest import make_jobstats
+from tess_atlas_slurm_utils.simulator import (
+    SimConfig,
+    config_grid,
+    load_runtime_history,
+    simulate,
+)
+
+# generation: 10 min at 1 CPU, analysis: 60 min at 2 CPUs (TOI 4's last
+# analysis ran out of mem with 1500MB)
+JOBSTATS = """JobID,JobName,Submit,CPUTimeRAW,State,MaxRSS,ReqMem,AllocCPUS,TOI
+1_0,toi_gen,2023-01-01,600,COMPLETED,1e8,1e9,1,1
+1_1,toi_gen,2023-01-01,600,COMPLETED,1e8,1e9,1,2
+1_2,toi_gen,2023-01-01,600,COMPLETED,1e8,1e9,1,3
+1_3,toi_gen,2023-01-01,600,COMPLETED,1e8,1e9,1,4
+2_0,toi_pe,2023-01-01,7200,COMPLETED,1e9,1.6e9,2,1
+2_1,toi_pe,2023-01-01,7200,COMPLETED,1e9,1.6e9,2,2
+2_2,toi_pe,2023-01-01,7200,COMPLETED,1e9,1.6e9,2,3
+2_3,toi_pe,2023-01-01,7200,COMPLETED,1e9,1.6e9,2,4
+3_0,toi_pe,2023-01-02,7200,OUT_OF_MEMORY,1.4e9,1.6e9,2,4
+4_0,toi_pe,2023-01-02,0,RUNNING,,,2,1
+"""
+# one node: 2 analysis tasks at once
+CLUSTER = dict(nodes=1, cores_per_node=4, queue_wait=0)
+
+
+@pytest.fixture
+def history(tmpdir):
+    fname = tmpdir / "jobstats.csv"
+    fname.write(JOBSTATS)
+    return load_runtime_history(str(fname))
+
+
+def test_load_runtime_history(history):
+    assert len(history) == 9  # (not the running job)
+    assert list(history.stage.unique()) == ["generation", "analysis"]
+    oom = history[history.state == "OUT_OF_MEMORY"].iloc[0]
+    assert oom.mem_mb > 1.6e9 / 1024**2
+
+
+def test_simulate(history):
+    configs = [
+        SimConfig(**CLUSTER),
+        SimConfig(**CLUSTER, mem="2GB"),
+        SimConfig(**CLUSTER, mem="2GB", time="30:00"),
+        SimConfig(**CLUSTER, mem="2GB", analysis_throttle=1),
+    ]
+    results = simulate([1, 2, 3, 4], history, configs)
+    # 4 generations at once, then 2 rounds of 2 analyses
+    assert list(results.makespan_hrs * 60) == pytest.approx(
+        [130, 130, 70, 250]
+    )
+    assert list(results.oom) == [1, 0, 0, 0]
+    assert list(results.timeout) == [0, 0, 4, 0]
+    assert list(results.completed) == [3, 4, 0, 4]
+    gen_core_hrs = 4 * 10 / 60
+    assert results.core_hrs[1] == pytest.approx(gen_core_hrs + 4 * 2)
+    assert results.core_hrs[2] == pytest.approx(gen_core_hrs + 4 * 2 / 2)
+
+
+def test_simulate_bundles_and_node_layout(history):
+    cluster = {k: [v] for k, v in CLUSTER.items()}
+    configs = config_grid(
+        bundle_size=[2], mem=["2GB"], max_array_size=[1], **cluster
+    )
+    configs += [SimConfig(**CLUSTER, mem="2GB", layout="node")]
+    results = simulate([1, 2, 3, 4], history, configs)
+    # 2 arrays of a task of 2 TOIs (one after the other, in both stages)
+    assert len(results) == 2
+    assert results.makespan_hrs[0] * 60 == pytest.approx(20 + 120)
+    # a node task running 2 TOIs at once (after the generation array)
+    assert results.makespan_hrs[1] * 60 == pytest.approx(130)
+    assert results.completed[1] == 4
+
+
+def test_oom_simulated_from_the_steps_max_rss(tmpdir, fake_slurm):
+    # (sacct leaves the MaxRSS of the allocation rows blank)
+    jobs = [
+        ("1_0", "toi_gen", 600, "COMPLETED", "100M", "1000M", 1, 1),
+        ("1_1", "toi_gen", 600, "COMPLETED", "100M", "1000M", 1, 2),
+        ("2_0", "toi_pe", 7200, "COMPLETED", "2000M", "2500M", 2, 1),
+        ("2_1", "toi_pe", 7200, "COMPLETED", "500M", "2500M", 2, 2),
+    ]
+    history = load_runtime_history(make_jobstats(fake_slurm, tmpdir, jobs))
+    assert list(history.mem_mb) == [100, 100, 2000, 500]
+    results = simulate([1, 2], history, [SimConfig(**CLUSTER, mem="1500MB")])
+    assert list(results.oom) == [1]
@@ -1,9 +1,16 @@
 import os
+import subprocess
+
 import pytest
 from tess_atlas_slurm_utils import slurm_job_generator
 from tess_atlas_slurm_utils.slurm_job_generator import setup_jobs
 from tess_atlas_slurm_utils import cli
-from conftest import generate_toi_files
+from tess_atlas_slurm_utils.resource_classes import (
+    assign_resource_classes,
+    predict_toi_costs,
+)
+from tess_atlas_slurm_utils.utils import slurm_time_to_minutes
+from conftest import generate_toi_files, make_fake_executable, make_jobstats
 
 TEST_ARRAY_SIZE = 15
 
@@ -104,3 +111,206 @@ def test_cli(outdir, monkeypatch):
         ],
     )
     cli.main()
+
+
+def test_resource_classes_from_jobstats(outdir):
+    jobstats = outdir / "jobstats.csv"
+    jobstats.write(
+        "JobID,JobName,Submit,CPUTimeRAW,State,MaxRSS,TOI\n"
+        "1_0,toi_pe,2023-01-01,1200,COMPLETED,104857600,1\n"
+        "1_1,toi_pe,2023-01-01,36000,TIMEOUT,,2\n"
+    )
+    setup_jobs(
+        toi_numbers=[1, 2, 3],
+        outdir=outdir,
+        module_loads="mod 1",
+        submit=False,
+        clean=True,
+        jobstats=str(jobstats),
+    )
+    scripts = {}
+    for fn in os.listdir(outdir / "submit"):
+        if fn.startswith("slurm_pe"):
+            with open(outdir / "submit" / fn) as f:
+                txt = f.read()
+            scripts[txt.split("ARRAY_ARGS=(")[1].split(")")[0]] = txt
+    assert set(scripts) == {"1", "2", "3"}
+    assert "--time=60:00" in scripts["1"]  # short TOI
+    assert "--time=600:00" in scripts["2"]  # timed out -> largest class
+    default_time = slurm_job_generator.ANALYSIS_JOB_SETTINGS["time"]
+    assert f"--time={default_time}" in scripts["3"]  # no history -> default
+
+
+def test_mem_classes_from_the_steps_max_rss(outdir, fake_slurm):
+    # (sacct leaves the MaxRSS of the allocation rows blank)
+    jobs = [
+        ("1_0", "toi_pe", 1200, "COMPLETED", "3000M", "1500M", 2, 1),
+        ("1_1", "toi_pe", 1200, "COMPLETED", "500M", "1500M", 2, 2),
+    ]
+    jobstats = make_jobstats(fake_slurm, outdir, jobs)
+    costs = predict_toi_costs(jobstats, cpu_per_task=2)
+    assert list(costs.mem_mb) == [3000, 500]
+    groups = assign_resource_classes(
+        [1, 2, 3], costs, dict(time="300:00", mem="1500MB")
+    )
+    assert sorted((g["mem"], tois) for g, tois in groups) == [
+        ("1000MB", [2]),
+        ("1500MB", [3]),  # no history -> default
+        ("4000MB", [1]),
+    ]
+
+
+def test_bundled_tasks_record_per_toi_exit_codes(outdir, monkeypatch):
+    setup_jobs(
+        toi_numbers=[1, 2, 3, 4, 5],
+        outdir=outdir,
+        module_loads="mod 1",
+        submit=False,
+        clean=True,
+        bundle_size=3,
+    )
+    slurm_file = str(outdir / "submit" / "slurm_pe_0_job.sh")
+    with open(slurm_file) as f:
+        txt = f.read()
+    assert "#SBATCH --array=0-1" in txt
+    time = slurm_job_generator.ANALYSIS_JOB_SETTINGS["time"]
+    bundle_time = int(slurm_time_to_minutes(time) * 3)
+    assert f"#SBATCH --time={bundle_time}:00" in txt
+
+    # run the 2nd task ([4, 5]) with a fake srun that fails for TOI 5
+    bindir = str(outdir / "bin")
+    make_fake_executable(bindir, "srun", '[ "$2" != 5 ]\n')
+    make_fake_executable(bindir, "module", "")
+    env = dict(
+        os.environ,
+        PATH=bindir + os.pathsep + os.environ["PATH"],
+        SLURM_ARRAY_JOB_ID="10",
+        SLURM_ARRAY_TASK_ID="1",
+    )
+    result = subprocess.run(["bash", slurm_file], env=env)
+    assert result.returncode != 0
+    with open(outdir / "log_pe" / "pe_10_1.exit_codes") as f:
+        assert f.read().split("\n")[:2] == ["4 0", "5 1"]
+
+    # a rerun of the task (e.g. requeued) only reports its own exit codes
+    make_fake_executable(bindir, "srun", "")
+    assert subprocess.run(["bash", slurm_file], env=env).returncode == 0
+    with open(outdir / "log_pe" / "pe_10_1.exit_codes") as f:
+        assert f.read().splitlines() == ["4 0", "5 0"]
+
+
+def test_parallel_bundles_request_mem_per_toi(outdir):
+    setup_jobs(
+        toi_numbers=[1, 2, 3, 4],
+        outdir=outdir,
+        module_loads="mod 1",
+        submit=False,
+        clean=True,
+        bundle_size=4,
+        bundle_parallel=True,
+        staging=True,
+    )
+    with open(outdir / "submit" / "slurm_pe_0_job.sh") as f:
+        txt = f.read()
+    # 2 TOIs (cpu_per_task) at once, each with the single-TOI mem/tmp_mem
+    settings = slurm_job_generator.ANALYSIS_JOB_SETTINGS
+    assert settings["cpu_per_task"] == 2
+    assert "#SBATCH --mem=3000M" in txt
+    assert "#SBATCH --tmp=2000M" in txt  # (2 * (500M + 500M staged))
+    assert (
+        "srun --exact --ntasks=1 --cpus-per-task=1 --mem=1500MB "
+        "--export=ALL,OMP_NUM_THREADS=1 run_toi $TOI --outdir "
+        "$JOBFS/stage_$TOI"
+    ) in txt
+
+
+def test_node_pool_layout(outdir):
+    setup_jobs(
+        toi_numbers=list(range(1, 12)),
+        outdir=outdir,
+        module_loads="mod 1",
+        submit=False,
+        clean=True,
+        layout="node",
+        node_cores=4,
+        node_mem="100GB",
+    )
+    slurm_file = str(outdir / "submit" / "slurm_pe_0_job.sh")
+    with open(slurm_file) as f:
+        txt = f.read()
+    cpus = slurm_job_generator.ANALYSIS_JOB_SETTINGS["cpu_per_task"]
+    slots = 4 // cpus
+    n_tasks = -(-11 // (slots * slurm_job_generator.NODE_ROUNDS))
+    assert "#SBATCH --exclusive" in txt
+    assert f"#SBATCH --ntasks={slots}" in txt
+    assert f"#SBATCH --array=0-{n_tasks - 1}" in txt
+    with open(outdir / "submit" / "slurm_gen_0_job.sh") as f:
+        assert "#SBATCH --array=0-10" in f.read()  # one task per TOI
+    with open(outdir / "submit" / "submit.sh") as f:
+        assert "afterany:$GEN_ID" in f.read()
+
+    # run the 1st task with a fake srun that fails for TOI 3
+    bindir = str(outdir / "bin")
+    make_fake_executable(
+        bindir, "srun", 'echo "running $6"\n[ "$6" != 3 ]\n'
+    )
+    make_fake_executable(bindir, "module", "")
+    env = dict(
+        os.environ,
+        PATH=bindir + os.pathsep + os.environ["PATH"],
+        SLURM_ARRAY_JOB_ID="10",
+        SLURM_ARRAY_TASK_ID="0",
+    )
+    result = subprocess.run(["bash", slurm_file], env=env)
+    assert result.returncode != 0
+    with open(outdir / "log_pe" / "pe_10_0.exit_codes") as f:
+        exit_codes = dict(line.split() for line in f.read().splitlines())
+    assert len(exit_codes) == slots * slurm_job_generator.NODE_ROUNDS
+    assert exit_codes["3"] == "1" and exit_codes["1"] == "0"
+    with open(outdir / "log_pe" / "pe_10_0_toi2.log") as f:
+        assert f.read() == "running 2\n"
+
+
+def test_dry_run(outdir, monkeypatch, capsys):
+    monkeypatch.setattr(slurm_job_generator, "MAX_ARRAY_SIZE", TEST_ARRAY_SIZE)
+    setup_jobs(
+        toi_numbers=list(range(1, 21)),
+        outdir=outdir,
+        module_loads="mod 1",
+        submit=False,
+        clean=True,
+        dry_run=True,
+    )
+    assert os.listdir(outdir) == []
+    lines = capsys.readouterr().out.splitlines()
+    assert [line.split()[:3] for line in lines[1:5]] == [
+        ["gen_0", "15", "1-15"],
+        ["gen_1", "5", "16-20"],
+        ["pe_0", "15", "1-15"],
+        ["pe_1", "5", "16-20"],
+    ]
+    # 20 TOIs * 2 cpus * 5 hrs of analysis + 20 * 1/3 hr of generation
+    assert lines[-1] == "Max CPU-hrs requested: 207"
+
+
+def test_cli_lazy_imports(tmpdir):
+    code = (
+        "import sys, tess_atlas_slurm_utils.cli; "
+        "print(sorted({'pandas', 'numpy', 'matplotlib'} & set(sys.modules)))"
+    )
+    result = subprocess.run(
+        ["python", "-c", code], capture_output=True, text=True, check=True
+    )
+    assert result.stdout.strip() == "[]"
+
+    # making (a dry run of) the jobs of a single TOI doesn't need them either
+    code = (
+        "import sys; from tess_atlas_slurm_utils import cli; "
+        "sys.argv = ['make_slurm_job', '--toi_number', '5', '--outdir', "
+        f"'{tmpdir}', '--submit', '--dry-run']; cli.main(); "
+        "print(sorted({'pandas', 'numpy', 'matplotlib'} & set(sys.modules)))"
+    )
+    result = subprocess.run(
+        ["python", "-c", code], capture_output=True, text=True, check=True
+    )
+    assert result.stdout.splitlines()[-1] == "[]"
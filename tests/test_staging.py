@@ -0,0 +1,110 @@
+import os
+import shutil
+import subprocess
+
+from tess_atlas_slurm_utils import staging
+from tess_atlas_slurm_utils.slurm_job_generator import setup_jobs
+from conftest import generate_toi_files, make_fake_executable
+
+# 'srun run_toi $TOI --outdir $DIR': needs the TOI's generation outputs,
+# writes a netcdf and a notebook, and fails for TOI 6
+FAKE_SRUN = """
+TOI=$2 OUTDIR=$4
+[ -f $OUTDIR/toi_${TOI}_files/data.csv ] || exit 2
+echo "posterior" > $OUTDIR/toi_${TOI}_files/toi_${TOI}.netcdf
+echo "{}" > $OUTDIR/toi_${TOI}.ipynb
+[ $TOI != 6 ]
+"""
+
+
+def run_task(slurm_file, bindir, jobfs, task_id):
+    env = dict(
+        os.environ,
+        PATH=bindir + os.pathsep + os.environ["PATH"],
+        JOBFS=jobfs,
+        SLURM_JOB_ID="11",
+        SLURM_ARRAY_JOB_ID="10",
+        SLURM_ARRAY_TASK_ID=str(task_id),
+    )
+    return subprocess.run(["bash", slurm_file], env=env).returncode
+
+
+def test_staged_analysis(tmpdir):
+    outdir = tmpdir / "out"
+    generate_toi_files(str(outdir), [1, 2])
+    with open(outdir / "toi_1_files" / "trace.netcdf", "wb") as f:
+        f.write(b"0" * 2 * 1024**2)  # the largest outputs: 2MB
+    for toi in [5, 6]:
+        (outdir / f"toi_{toi}_files").ensure("data.csv").write("data")
+    setup_jobs(
+        toi_numbers=[5, 6],
+        outdir=str(outdir),
+        module_loads="mod 1",
+        submit=False,
+        clean=True,
+        staging=True,
+    )
+    slurm_file = str(outdir / "submit" / "slurm_pe_0_job.sh")
+    with open(slurm_file) as f:
+        txt = f.read()
+    assert "#SBATCH --tmp=503M" in txt  # 500M + 1.5 * 2MB
+    assert "--outdir $JOBFS/stage_$TOI" in txt
+
+    bindir = str(tmpdir / "bin")
+    make_fake_executable(bindir, "srun", FAKE_SRUN)
+    make_fake_executable(bindir, "module", "")
+    jobfs = str(tmpdir.mkdir("jobfs"))
+    assert run_task(slurm_file, bindir, jobfs, 0) == 0
+    assert sorted(os.listdir(outdir / "toi_5_files")) == [
+        "data.csv",
+        "toi_5.netcdf",
+    ]
+    assert os.path.exists(outdir / "toi_5.ipynb")
+    # a failed TOI leaves the outdir untouched
+    assert run_task(slurm_file, bindir, jobfs, 1) != 0
+    assert os.listdir(outdir / "toi_6_files") == ["data.csv"]
+    assert not os.path.exists(outdir / "toi_6.ipynb")
+    assert not [f for f in os.listdir(jobfs) if f.startswith("stage_")]
+    assert not [f for f in os.listdir(outdir) if f.startswith(".toi_")]
+
+
+def test_failed_stage_out_restores_outputs(tmpdir):
+    outdir = tmpdir / "out"
+    (outdir / "toi_5_files").ensure("data.csv").write("data")
+    setup_jobs(
+        toi_numbers=[5],
+        outdir=str(outdir),
+        module_loads="mod 1",
+        submit=False,
+        clean=True,
+        staging=True,
+    )
+    bindir = str(tmpdir / "bin")
+    make_fake_executable(bindir, "srun", FAKE_SRUN)
+    make_fake_executable(bindir, "module", "")
+    # renaming the new results into place fails
+    make_fake_executable(
+        bindir,
+        "mv",
+        'if [ "$1" = -T ] && [[ "$2" == *.new ]]; then exit 1; fi\n'
+        f'exec {shutil.which("mv")} "$@"\n',
+    )
+    jobfs = str(tmpdir.mkdir("jobfs"))
+    slurm_file = str(outdir / "submit" / "slurm_pe_0_job.sh")
+    assert run_task(slurm_file, bindir, jobfs, 0) != 0
+    assert os.listdir(outdir / "toi_5_files") == ["data.csv"]
+    assert not [f for f in os.listdir(outdir) if f.startswith(".toi_")]
+    # (the results are kept in $JOBFS)
+    assert os.path.exists(os.path.join(jobfs, "stage_5", "toi_5.ipynb"))
+
+
+def test_stage_mb_measures_the_newest_results(tmpdir, monkeypatch):
+    outdir = str(tmpdir)
+    generate_toi_files(outdir, [1, 2])
+    netcdf = os.path.join(outdir, "toi_1_files", "toi_1.netcdf")
+    with open(netcdf, "wb") as f:
+        f.write(b"0" * 2 * 1024**2)
+    # TOI 1 was analysed after TOI 2
+    os.utime(os.path.join(outdir, "toi_2_files", "toi_2.netcdf"), (0, 0))
+    monkeypatch.setattr(staging, "STAGE_SAMPLE", 1)
+    assert staging.stage_mb(outdir) == 3  # 1.5 * 2MB
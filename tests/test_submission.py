@@ -0,0 +1,154 @@
+import json
+import os
+
+import pytest
+from tess_atlas_slurm_utils import submission
+from tess_atlas_slurm_utils.slurm_job_generator import setup_jobs
+
+SOCKET_TIMEOUT = (
+    "sbatch: error: Batch job submission failed: "
+    "Socket timed out on send/recv operation"
+)
+
+
+def test_submission_record(tmpdir, fake_slurm):
+    fake_slurm.fail_sbatch(message=SOCKET_TIMEOUT, once=True)
+    outdir = tmpdir / "out"
+    setup_jobs(
+        toi_numbers=[1, 2, 3],
+        outdir=outdir,
+        module_loads="mod 1",
+        submit=False,
+        clean=True,
+    )
+    submit_dir = str(outdir / "submit")
+    gen_fn = os.path.join(submit_dir, "slurm_gen_0_job.sh")
+    anlys_fn = os.path.join(submit_dir, "slurm_pe_0_job.sh")
+    record_fn = submission.submit_jobs(
+        [gen_fn], [anlys_fn], submit_dir, backoff=0.01
+    )
+    with open(record_fn) as f:
+        batch = json.load(f)["batches"][0]
+    gen_id = batch["generation"]["job_id"]
+    assert batch["analysis"]["dependency"] == f"aftercorr:{gen_id}"
+    calls = fake_slurm.sbatch_calls()
+    assert len(calls) == 3  # 1 retry after the 'Socket timed out'
+    assert calls[0][0] == "failed"
+    assert f"--dependency=aftercorr:{gen_id}" in calls[-1][1]
+    with open(os.path.join(submit_dir, "submitted_jobs.txt")) as f:
+        assert f.read().split()[:2] == [gen_id, gen_fn]
+
+
+def test_sbatch_raises_on_other_errors(tmpdir, fake_slurm):
+    fake_slurm.fail_sbatch()
+    with pytest.raises(RuntimeError):
+        submission.submit_jobs([None], ["job.sh"], str(tmpdir))
+
+
+def test_max_array_size_from_slurm_config(tmpdir, fake_slurm):
+    fake_slurm.add("scontrol", "echo 'MaxArraySize            = 3'\n")
+    submission.get_max_array_size.cache_clear()
+    try:
+        setup_jobs(
+            toi_numbers=list(range(1, 8)),
+            outdir=tmpdir / "out",
+            module_loads="mod 1",
+            submit=False,
+            clean=True,
+            analysis_throttle=2,
+        )
+    finally:
+        submission.get_max_array_size.cache_clear()
+    submit_dir = tmpdir / "out" / "submit"
+    # 7 TOIs -> arrays of 3, 3 and 1 tasks
+    pe_files = [f for f in os.listdir(submit_dir) if f.startswith("slurm_pe")]
+    assert len(pe_files) == 3
+    pe_file = (submit_dir / "slurm_pe_0_job.sh").read()
+    gen_file = (submit_dir / "slurm_gen_0_job.sh").read()
+    assert "#SBATCH --array=0-2%2\n" in pe_file
+    assert "#SBATCH --array=0-2\n" in gen_file  # (not throttled)
+
+
+def test_paced_submission_waits_for_headroom(
+    tmpdir, fake_slurm, monkeypatch
+):
+    # the queue has 5, 3 then 0 tasks (one multi-column line per task)
+    fake_slurm.fail_sbatch(message=SOCKET_TIMEOUT, once=True)
+    fake_slurm.add(
+        "squeue",
+        'DIR=$(dirname "$0")\n'
+        'N=$(cat "$DIR/queued" 2>/dev/null || echo 5)\n'
+        'echo $(( N > 2 ? N - 2 : 0 )) > "$DIR/queued"\n'
+        'for i in $(seq 1 $N); do echo "  10_$i  skylake  toi_pe  user PD'
+        '  0:00  1 (Priority)"; done\n',
+    )
+    waits = []
+    monkeypatch.setattr(submission.time, "sleep", waits.append)
+    outdir = tmpdir / "out"
+    setup_jobs(
+        toi_numbers=[1, 2, 3],
+        outdir=outdir,
+        module_loads="mod 1",
+        submit=False,
+        clean=True,
+    )
+    submit_dir = str(outdir / "submit")
+    submission.submit_jobs(
+        [os.path.join(submit_dir, "slurm_gen_0_job.sh")],
+        [os.path.join(submit_dir, "slurm_pe_0_job.sh")],
+        submit_dir,
+        max_queued=10,
+        poll_interval=30,
+    )
+    # 6 tasks only fit once 3 are queued (+ the sbatch retry's backoff)
+    assert waits[0] == 30
+    assert len(waits) == 2
+
+
+def submit_with_failing_sbatch(tmpdir, fake_slurm, failing):
+    """Submit 2 batches (+ the cache job) with an sbatch that fails for the
+    slurm files matching `failing` -> the submission record's batches"""
+    fake_slurm.fail_sbatch(failing)
+    outdir = tmpdir / "out"
+    setup_jobs(
+        toi_numbers=[1, 2, 3],
+        outdir=outdir,
+        module_loads="mod 1",
+        submit=False,
+        clean=True,
+        theano_cache=True,
+    )
+    submit_dir = str(outdir / "submit")
+    with pytest.raises(RuntimeError, match="batch 0: invalid"):
+        submission.submit_jobs(
+            [os.path.join(submit_dir, "slurm_gen_0_job.sh")] * 2,
+            [os.path.join(submit_dir, "slurm_pe_0_job.sh")] * 2,
+            submit_dir,
+            cache_fn=os.path.join(submit_dir, "slurm_cache_job.sh"),
+        )
+    with open(os.path.join(submit_dir, "submitted_jobs.txt")) as f:
+        ledger = [line.split()[0] for line in f]
+    (record_fn,) = [f for f in os.listdir(submit_dir) if f.endswith(".json")]
+    with open(os.path.join(submit_dir, record_fn)) as f:
+        return json.load(f)["batches"], ledger
+
+
+def test_failed_analysis_submission_keeps_submitted_jobs(tmpdir, fake_slurm):
+    batches, ledger = submit_with_failing_sbatch(
+        tmpdir, fake_slurm, "slurm_pe_"
+    )
+    assert [b["generation"]["job_id"] for b in batches] == ["101", "103"]
+    assert batches[0]["cache"]["job_id"] == "102"
+    assert all("analysis" not in b for b in batches)
+    assert ledger == ["101", "102", "103"]
+
+
+def test_failed_cache_submission_records_unsubmitted_batches(
+    tmpdir, fake_slurm
+):
+    batches, ledger = submit_with_failing_sbatch(
+        tmpdir, fake_slurm, "slurm_cache_"
+    )
+    assert batches[0]["generation"]["job_id"] == "101"
+    assert "not submitted" in batches[1]["error"]
+    assert ledger == ["101"]
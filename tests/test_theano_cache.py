@@ -0,0 +1,88 @@
+import json
+import os
+import subprocess
+
+from tess_atlas_slurm_utils.slurm_job_generator import setup_jobs
+from tess_atlas_slurm_utils.submission import submit_jobs
+
+
+def test_analysis_jobs_depend_on_cache_job(tmpdir, fake_slurm):
+    outdir = str(tmpdir / "out")
+    kwargs = dict(
+        toi_numbers=[1, 2, 3],
+        outdir=outdir,
+        module_loads="mod 1",
+        submit=False,
+        clean=True,
+        theano_cache=True,
+    )
+    setup_jobs(**kwargs)
+    submit_dir = os.path.join(outdir, "submit")
+    cache_fn = os.path.join(submit_dir, "slurm_cache_job.sh")
+    anlys_fn = os.path.join(submit_dir, "slurm_pe_0_job.sh")
+    with open(anlys_fn) as f:
+        anlys = f.read()
+    tarball = anlys.split("tar -xzf ")[1].split()[0]
+    assert tarball.startswith(os.path.join(outdir, "theano_cache"))
+    with open(cache_fn) as f:
+        assert f"mv {tarball}.$SLURM_JOB_ID {tarball}" in f.read()
+
+    record = submit_jobs(
+        [os.path.join(submit_dir, "slurm_gen_0_job.sh")],
+        [anlys_fn],
+        submit_dir,
+        cache_fn=cache_fn,
+    )
+    with open(record) as f:
+        batch = json.load(f)["batches"][0]
+    gen_id = batch["generation"]["job_id"]
+    cache_id = batch["cache"]["job_id"]
+    assert batch["analysis"]["dependency"] == (
+        f"aftercorr:{gen_id},afterany:{cache_id}"
+    )
+    calls = dict(fake_slurm.sbatch_calls())
+    assert f"--dependency=afterany:{gen_id}_0" in calls[cache_id]
+    with open(os.path.join(submit_dir, "submit.sh")) as f:
+        assert "afterok" not in f.read()
+
+    # once the cache is built, no cache job is made
+    os.remove(cache_fn)
+    open(tarball, "w").close()
+    setup_jobs(**kwargs)
+    assert not os.path.exists(cache_fn)
+
+
+def run_task(slurm_file, jobfs):
+    env = dict(
+        os.environ,  # (with the fake slurm commands on the PATH)
+        JOBFS=jobfs,
+        SLURM_JOB_ID="11",
+        SLURM_ARRAY_TASK_ID="0",
+    )
+    return subprocess.run(["bash", slurm_file], env=env).returncode
+
+
+def test_analyses_run_if_cache_job_fails(tmpdir, fake_slurm):
+    outdir = str(tmpdir / "out")
+    setup_jobs(
+        toi_numbers=[1],
+        outdir=outdir,
+        module_loads="mod 1",
+        submit=False,
+        clean=True,
+        theano_cache=True,
+    )
+    submit_dir = os.path.join(outdir, "submit")
+    fake_slurm.add("module", "")
+    jobfs = str(tmpdir.mkdir("jobfs"))
+    # the warm-up fails: no tarball
+    fake_slurm.add("srun", "exit 1\n")
+    cache_fn = os.path.join(submit_dir, "slurm_cache_job.sh")
+    assert run_task(cache_fn, jobfs) != 0
+    assert not os.listdir(os.path.join(outdir, "theano_cache"))
+    # (afterany: the analysis still starts) and runs without the cache
+    fake_slurm.add("srun", 'echo "$@" > "$JOBFS/ran"\n')
+    anlys_fn = os.path.join(submit_dir, "slurm_pe_0_job.sh")
+    assert run_task(anlys_fn, jobfs) == 0
+    with open(os.path.join(jobfs, "ran")) as f:
+        assert f.read().startswith("run_toi 1 ")
@@ -0,0 +1,125 @@
+import functools
+import http.server
+import socket
+import threading
+import time
+
+import pytest
+from tess_atlas_slurm_utils.toi_catalogue import (
+    get_catalogue_path,
+    load_toi_catalogue,
+    seed_catalogue_cache,
+)
+from tess_atlas_slurm_utils.toi_data_interface import (
+    parse_toi_numbers,
+    select_toi_numbers,
+)
+
+CATALOGUE = """TOI,TOI int,Lightcurve Available,TESS Mag
+101.01,101,True,9.1
+102.01,102,False,10.2
+103.01,103,True,11.3
+103.02,103,True,11.3
+"""
+
+
+class _Handler(http.server.SimpleHTTPRequestHandler):
+    statuses = []
+
+    def send_response(self, code, message=None):
+        self.statuses.append(code)
+        super().send_response(code, message)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def catalogue_url(tmpdir):
+    (tmpdir / "catalogue.csv").write(CATALOGUE)
+    _Handler.statuses = []
+    handler = functools.partial(_Handler, directory=str(tmpdir))
+    server = http.server.HTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}/catalogue.csv"
+    server.shutdown()
+
+
+@pytest.fixture
+def cache_dir(tmpdir, monkeypatch):
+    cache_dir = str(tmpdir / "cache")
+    monkeypatch.setenv("TESS_ATLAS_CACHE", cache_dir)
+    return cache_dir
+
+
+def test_catalogue_cache_revalidation(catalogue_url, cache_dir):
+    data = load_toi_catalogue(url=catalogue_url)
+    assert list(data.columns) == ["TOI int", "Lightcurve Available"]
+    assert _Handler.statuses == [200]
+    # within the TTL the cache is used without any request
+    get_catalogue_path(url=catalogue_url)
+    assert _Handler.statuses == [200]
+    # once stale, an unchanged catalogue is revalidated with a 304
+    get_catalogue_path(url=catalogue_url, ttl=0)
+    assert _Handler.statuses == [200, 304]
+
+
+def test_unresponsive_server_falls_back_to_the_cache(tmpdir, cache_dir):
+    # a server that accepts the connection but never answers
+    server = socket.socket()
+    server.bind(("127.0.0.1", 0))
+    server.listen(1)
+    url = f"http://127.0.0.1:{server.getsockname()[1]}/catalogue.csv"
+    with pytest.raises(OSError):  # (nothing cached yet)
+        get_catalogue_path(url=url, timeout=0.2)
+    (tmpdir / "seed.csv").write(CATALOGUE)
+    seed_catalogue_cache(str(tmpdir / "seed.csv"), url=url)
+    start = time.time()
+    fname = get_catalogue_path(url=url, ttl=0, timeout=0.2)
+    assert time.time() - start < 5
+    with open(fname) as f:
+        assert f.read() == CATALOGUE
+    server.close()
+
+
+def test_offline_catalogue(tmpdir, cache_dir, monkeypatch):
+    with pytest.raises(FileNotFoundError):
+        get_catalogue_path(offline=True)
+    (tmpdir / "seed.csv").write(CATALOGUE)
+    seed_catalogue_cache(str(tmpdir / "seed.csv"))
+    monkeypatch.setenv("TESS_ATLAS_OFFLINE", "1")
+    assert sorted(parse_toi_numbers(outdir=str(tmpdir))) == [101, 103]
+
+
+SELECTION_CATALOGUE = """TOI,TOI int,Lightcurve Available,TFOPWG Disposition,TESS Mag,Period (days),Date TOI Updated (UTC)
+105.01,105,True,PC,9.5,3.2,2024-05-01
+101.01,101,True,CP,8.0,1.1,2021-01-01
+101.02,101,True,PC,8.0,7.5,2024-06-01
+102.01,102,False,PC,9.0,2.0,2024-01-01
+103.01,103,True,fp,12.0,,2024-02-01
+104.01,104,True,,10.5,20.0,
+"""
+
+
+def test_select_toi_numbers(tmpdir, cache_dir):
+    (tmpdir / "seed.csv").write(SELECTION_CATALOGUE)
+    seed_catalogue_cache(str(tmpdir / "seed.csv"))
+    select = functools.partial(select_toi_numbers, offline=True)
+    tois = select()
+    assert tois.dtype.kind == "i"
+    assert tois.tolist() == [101, 103, 104, 105]
+    assert select(toi_range=(102, None)).tolist() == [103, 104, 105]
+    assert select(dispositions=["pc", "FP"]).tolist() == [101, 103, 105]
+    assert select(mag_range=(None, 10)).tolist() == [101, 105]
+    assert select(period_range=(3, 10)).tolist() == [101, 105]
+    assert select(updated_since="2024-03-01").tolist() == [101, 105]
+    assert select(lk_available=False, dispositions=["PC"]).tolist() == [
+        101,
+        102,
+        105,
+    ]
+    # filters of TOIs from a CSV/TOI number
+    toi_numbers = parse_toi_numbers(
+        toi_number=104, offline=True, mag_range=(None, 10)
+    )
+    assert toi_numbers == []
@@ -0,0 +1,100 @@
+import os
+import shutil
+
+import pytest
+from tess_atlas_slurm_utils.file_generators import read_array_args
+from tess_atlas_slurm_utils.slurm_job_generator import setup_jobs
+from tess_atlas_slurm_utils.toi_catalogue import seed_catalogue_cache
+from tess_atlas_slurm_utils.toi_data_interface import (
+    COMPLETION_INDEX,
+    get_delta_toi_numbers,
+    get_unprocessed_toi_numbers,
+)
+from conftest import generate_toi_files
+
+
+@pytest.fixture
+def outdir(tmpdir):
+    return tmpdir
+
+
+def test_completion_index_is_incremental(outdir):
+    generate_toi_files(outdir, [1, 2])
+    assert get_unprocessed_toi_numbers([1, 2, 3], outdir) == [3]
+    assert os.path.isfile(outdir / COMPLETION_INDEX)
+
+    # a new result in a new dir, and a removed dir, are both picked up
+    generate_toi_files(outdir, [3])
+    os.remove(outdir / "toi_1_files" / "toi_1.netcdf")
+    os.rmdir(outdir / "toi_1_files")
+    assert get_unprocessed_toi_numbers([1, 2, 3], outdir) == [1]
+
+
+def test_rescan_rebuilds_index(outdir):
+    generate_toi_files(outdir, [1])
+    assert get_unprocessed_toi_numbers([1], outdir) == []
+    # a result removed without touching the dir mtime is only seen on rescan
+    toi_dir = outdir / "toi_1_files"
+    stat = os.stat(toi_dir)
+    os.remove(toi_dir / "toi_1.netcdf")
+    os.utime(toi_dir, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert get_unprocessed_toi_numbers([1], outdir) == []
+    assert get_unprocessed_toi_numbers([1], outdir, rescan=True) == [1]
+
+
+CATALOGUE = """TOI,TOI int,Period (days),Sectors,TESS Mag
+101.01,101,1.5,"1,2",9.0
+102.01,102,2.5,3,9.0
+103.01,103,3.5,4,9.0
+"""
+
+
+def test_delta(outdir, monkeypatch):
+    monkeypatch.setenv("TESS_ATLAS_CACHE", str(outdir / "cache"))
+    catalogue = outdir / "catalogue.csv"
+
+    def update_catalogue(txt):
+        catalogue.write(txt)
+        seed_catalogue_cache(str(catalogue))
+
+    update_catalogue(CATALOGUE)
+    generate_toi_files(outdir, [101, 102, 103])
+    delta = lambda: get_delta_toi_numbers([101, 102, 103, 104], outdir)
+    assert delta() == [104]  # (first run: only records the snapshot)
+    # new sector, new planet, a new TOI, and a change of an ignored field
+    update_catalogue(
+        CATALOGUE.replace('"1,2"', '"1,2,3"').replace("2.5,3,9.0", "2.5,3,9.9")
+        + "103.02,103,9.5,4,9.0\n104.01,104,1.0,5,9.0\n"
+    )
+    assert delta() == [101, 103, 104]
+    # (104 isn't completed, and 101/103 stay changed until re-analysed)
+    assert delta() == [101, 103, 104]
+    netcdf = outdir / "toi_101_files" / "toi_101.netcdf"
+    os.utime(netcdf, ns=(0, os.stat(netcdf).st_mtime_ns + 10**9))
+    assert delta() == [103, 104]
+
+
+def test_delta_jobs_made_twice_without_submitting(outdir, monkeypatch):
+    monkeypatch.setenv("TESS_ATLAS_CACHE", str(outdir / "cache"))
+    catalogue = outdir / "catalogue.csv"
+    catalogue.write(CATALOGUE)
+    seed_catalogue_cache(str(catalogue))
+    results = outdir / "out"
+    generate_toi_files(results, [101, 102, 103])
+    kwargs = dict(
+        toi_numbers=[101, 102, 103],
+        outdir=str(results),
+        module_loads="mod 1",
+        submit=False,
+        clean=False,
+        delta=True,
+        offline=True,
+    )
+    setup_jobs(**kwargs)  # (records the snapshot, no jobs)
+    catalogue.write(CATALOGUE.replace('"1,2"', '"1,2,3"'))
+    seed_catalogue_cache(str(catalogue))
+    for _ in range(2):
+        shutil.rmtree(results / "submit")
+        setup_jobs(**kwargs)
+        pe_fn = results / "submit" / "slurm_pe_0_job.sh"
+        assert read_array_args(str(pe_fn)) == [[101]]